@@ -42,8 +42,13 @@ import uvicorn
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 if PROJECT_ROOT not in sys.path:
     sys.path.append(PROJECT_ROOT)
-from ava_dep.routers.qc_router import router as qc_router
+import logging
+from ava_dep.routers.qc_router import router as qc_router, DEFAULT_DB_PARAMS
 from ava_dep.routers.task_creator_router import router as cvat_router
+from processing_pipeline.services.migrations import check_schema
+from processing_pipeline.services.batch_qc import shutdown_shared_executor
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="AVA-Kinetics Pipeline Backend",
@@ -63,6 +68,18 @@ app.include_router(
     tags=["CVAT Task Creator"]
 )
 
+@app.on_event("startup")
+def check_database_schema():
+    # The QC endpoints fall back to stub data without a database, so don't refuse to start here.
+    try:
+        check_schema(DEFAULT_DB_PARAMS)
+    except Exception as e:
+        logger.error(f"Database schema check failed: {e}")
+
+@app.on_event("shutdown")
+def stop_batch_qc_workers():
+    shutdown_shared_executor()
+
 @app.get("/")
 def read_root():
     return {"message": "AVA-Kinetics Pipeline Backend is running. Check /docs for API details."}
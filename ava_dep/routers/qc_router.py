@@ -149,9 +149,9 @@
 
 
 # services/qc_router.py (Complete)
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, BackgroundTasks, HTTPException
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from fastapi.responses import JSONResponse, FileResponse
 import os
 from pathlib import Path
@@ -159,6 +159,7 @@ from dotenv import load_dotenv
 import sys
 import logging
 import json
+import uuid
 
 # =========================
 # Setup logging
@@ -173,6 +174,7 @@ logger = logging.getLogger(__name__)
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from ava_dep.db_utils import get_projects, get_pending_tasks, update_all_pending_to_approved
 from processing_pipeline.services.dataset_generator import DatasetGenerator
+from processing_pipeline.services.batch_qc import BatchQCEngine, shared_executor
 
 # =========================
 # Load environment variables
@@ -189,6 +191,9 @@ DEFAULT_DB_PARAMS = {
 
 router = APIRouter()
 
+# Batch QC runs in the background; results are kept here by job id until the process restarts
+batch_qc_jobs: Dict[str, Dict[str, Any]] = {}
+
 # =========================
 # Schemas
 # =========================
@@ -205,6 +210,12 @@ class GenerateRequest(BaseModel):
     manifest_path: str
     output_filename: str
 
+class BatchQCRequest(BaseModel):
+    db_params: DBParams = DBParams()
+    pending_only: bool = True
+    kappa_weights: Optional[str] = None
+    write_results: bool = True
+
 # =========================
 # Endpoints
 # =========================
@@ -300,4 +311,35 @@ def generate_dataset_endpoint(request: GenerateRequest):
         raise HTTPException(
             status_code=500,
             detail=f"Dataset generation failed. Error: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+def run_batch_qc_job(job_id: str, project_id: int, request: BatchQCRequest):
+    """Background body of /batch_qc: scores on the shared process pool and stores the summary."""
+    try:
+        engine = BatchQCEngine(request.db_params.model_dump(), kappa_weights=request.kappa_weights,
+                               executor=shared_executor())
+        summary = engine.run(project_id, pending_only=request.pending_only, write_results=request.write_results)
+        # Per-pair details are in quality_metrics; the job keeps the group summaries
+        summary["results"] = [{k: v for k, v in r.items() if k not in ("pairs", "flip_rates")}
+                              for r in summary["results"]]
+        batch_qc_jobs[job_id] = {"job_id": job_id, "status": "done", **summary}
+    except Exception as e:
+        logger.error(f"Batch QC failed: {str(e)}", exc_info=True)
+        batch_qc_jobs[job_id] = {"job_id": job_id, "status": "failed", "project_id": project_id,
+                                 "error": f"Batch QC failed. Error: {str(e)}"}
+
+@router.post("/batch_qc/{project_id}", status_code=202)
+def run_batch_qc(project_id: int, background_tasks: BackgroundTasks, request: BatchQCRequest = BatchQCRequest()):
+    """Starts scoring every overlap group of a project; poll /batch_qc/jobs/{job_id} for the summary."""
+    job_id = uuid.uuid4().hex
+    batch_qc_jobs[job_id] = {"job_id": job_id, "status": "running", "project_id": project_id}
+    background_tasks.add_task(run_batch_qc_job, job_id, project_id, request)
+    return batch_qc_jobs[job_id]
+
+@router.get("/batch_qc/jobs/{job_id}")
+def get_batch_qc_job(job_id: str):
+    """Status of a batch QC job, with its group summaries once done."""
+    job = batch_qc_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown batch QC job {job_id}.")
+    return job
@@ -1,4 +1,7 @@
-
 python /app/processing_pipeline/webhook_listener.py &
 
-uvicorn ava_dep.backend:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+for i in $(seq 1 "${SYNC_WORKERS:-2}"); do
+    python /app/processing_pipeline/services/sync_queue.py &
+done
+
+uvicorn ava_dep.backend:app --host 0.0.0.0 --port 8000
@@ -2,18 +2,20 @@ import streamlit as st
 import psycopg2
 import psycopg2.pool
 import pandas as pd
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List
 from collections import defaultdict
 import time
 import os
+import itertools
 import numpy as np
-import json
-from sklearn.metrics import cohen_kappa_score
 import logging
 
 # Import all of your backend services
 from metrics_logging.quality_service import QualityService
 from services.dataset_generator import DatasetGenerator
+from services.qc_metrics import EnhancedQualityMetrics
+from services.agreement_metrics import KAPPA_WEIGHTS
+from services.reliability import AnnotatorReliability
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,290 +26,6 @@ st.set_page_config(page_title="AVA QC Dashboard", layout="wide")
 st.title("Annotation Quality Control Dashboard")
 
 
-# --- Enhanced Quality Metrics Calculator ---
-class EnhancedQualityMetrics:
-    """Enhanced quality metrics calculator for E2 Agreement & Quality requirements"""
-
-    def __init__(self, db_params: Dict[str, Any]):
-        self.db_params = db_params
-
-    def get_connection(self):
-        """Get database connection"""
-        return psycopg2.connect(**self.db_params)
-
-    def calculate_frame_level_metrics(self, task1_id: int, task2_id: int) -> Dict[str, Any]:
-        """Calculate frame-level box agreement metrics"""
-        try:
-            with self.get_connection() as conn:
-                # Get annotations for both tasks
-                query = """
-                        SELECT a.frame, \
-                               a.track_id, \
-                               a.xtl, \
-                               a.ytl, \
-                               a.xbr, \
-                               a.ybr,
-                               a.outside, \
-                               a.attributes, \
-                               t.task_id, \
-                               t.assignee
-                        FROM annotations a
-                                 JOIN tasks t ON a.task_id = t.task_id
-                        WHERE a.task_id IN (%s, %s)
-                        ORDER BY a.frame, a.track_id \
-                        """
-                df = pd.read_sql(query, conn, params=(task1_id, task2_id))
-
-            if df.empty:
-                return {"error": "No annotations found for the specified tasks"}
-
-            # Group by task
-            task1_data = df[df['task_id'] == task1_id]
-            task2_data = df[df['task_id'] == task2_id]
-
-            # Calculate IoU for matched frames
-            ious = []
-            frames_with_iou_gte_05 = 0
-            total_matched_frames = 0
-
-            # Get common frames
-            common_frames = set(task1_data['frame']) & set(task2_data['frame'])
-
-            for frame in common_frames:
-                frame1_boxes = task1_data[task1_data['frame'] == frame]
-                frame2_boxes = task2_data[task2_data['frame'] == frame]
-
-                if not frame1_boxes.empty and not frame2_boxes.empty:
-                    # Calculate IoU for each pair of boxes in the frame
-                    frame_ious = []
-                    for _, box1 in frame1_boxes.iterrows():
-                        for _, box2 in frame2_boxes.iterrows():
-                            iou = self._calculate_iou(box1, box2)
-                            frame_ious.append(iou)
-
-                    if frame_ious:
-                        max_iou = max(frame_ious)
-                        ious.append(max_iou)
-                        if max_iou >= 0.5:
-                            frames_with_iou_gte_05 += 1
-                        total_matched_frames += 1
-
-            mean_iou = np.mean(ious) if ious else 0.0
-            percent_iou_gte_05 = (frames_with_iou_gte_05 / total_matched_frames) if total_matched_frames > 0 else 0.0
-
-            return {
-                "mean_iou": mean_iou,
-                "percent_iou_gte_05": percent_iou_gte_05,
-                "total_matched_frames": total_matched_frames,
-                "ious": ious
-            }
-
-        except Exception as e:
-            logger.error(f"Error calculating frame-level metrics: {e}")
-            return {"error": str(e)}
-
-    def calculate_tube_level_metrics(self, task1_id: int, task2_id: int) -> Dict[str, Any]:
-        """Calculate tube-level action agreement metrics (Cohen's κ and flip-rates)"""
-        try:
-            with self.get_connection() as conn:
-                query = """
-                        SELECT a.frame, a.track_id, a.attributes, t.task_id, t.assignee
-                        FROM annotations a
-                                 JOIN tasks t ON a.task_id = t.task_id
-                        WHERE a.task_id IN (%s, %s)
-                        ORDER BY a.frame, a.track_id \
-                        """
-                df = pd.read_sql(query, conn, params=(task1_id, task2_id))
-
-            if df.empty:
-                return {"error": "No annotations found for the specified tasks"}
-
-            # Parse attributes and calculate metrics
-            task1_data = df[df['task_id'] == task1_id].copy()
-            task2_data = df[df['task_id'] == task2_id].copy()
-
-            # Parse JSON attributes
-            for data in [task1_data, task2_data]:
-                data['parsed_attributes'] = data['attributes'].apply(
-                    lambda x: json.loads(x) if isinstance(x, str) else (x if isinstance(x, dict) else {})
-                )
-
-            # Get all unique action attributes
-            all_actions = set()
-            for _, row in pd.concat([task1_data, task2_data]).iterrows():
-                attrs = row['parsed_attributes']
-                all_actions.update(attrs.keys())
-
-            # Remove non-action attributes (like person_id, etc.)
-            action_attributes = [attr for attr in all_actions if not attr.startswith('person')]
-
-            kappa_scores = {}
-            flip_rates = {"annotator_1": {}, "annotator_2": {}}
-
-            # Calculate Cohen's κ for each action
-            for action in action_attributes:
-                task1_labels, task2_labels = self._align_labels_for_action(
-                    task1_data, task2_data, action
-                )
-
-                if len(task1_labels) > 0 and len(set(task1_labels + task2_labels)) > 1:
-                    try:
-                        kappa = cohen_kappa_score(task1_labels, task2_labels)
-                        kappa_scores[action] = kappa
-                    except Exception as e:
-                        logger.warning(f"Could not calculate kappa for {action}: {e}")
-                        kappa_scores[action] = 0.0
-                else:
-                    kappa_scores[action] = 0.0
-
-            # Calculate flip-rates for each annotator
-            flip_rates["annotator_1"] = self._calculate_flip_rates(task1_data, action_attributes)
-            flip_rates["annotator_2"] = self._calculate_flip_rates(task2_data, action_attributes)
-
-            # Calculate macro-average kappa
-            macro_avg_kappa = np.mean(list(kappa_scores.values())) if kappa_scores else 0.0
-
-            return {
-                "kappa_scores": kappa_scores,
-                "macro_avg_kappa": macro_avg_kappa,
-                "flip_rates": flip_rates,
-                "action_attributes": action_attributes
-            }
-
-        except Exception as e:
-            logger.error(f"Error calculating tube-level metrics: {e}")
-            return {"error": str(e)}
-
-    def run_comprehensive_quality_check(self, task1_id: int, task2_id: int) -> Dict[str, Any]:
-        """Run comprehensive quality check combining frame and tube level metrics"""
-
-        # Get task information
-        try:
-            with self.get_connection() as conn:
-                query = "SELECT task_id, name, assignee FROM tasks WHERE task_id IN (%s, %s)"
-                task_info = pd.read_sql(query, conn, params=(task1_id, task2_id))
-        except Exception as e:
-            return {"error": f"Failed to get task information: {e}"}
-
-        if len(task_info) != 2:
-            return {"error": "Could not find both tasks in database"}
-
-        # Calculate frame-level metrics
-        frame_metrics = self.calculate_frame_level_metrics(task1_id, task2_id)
-        if "error" in frame_metrics:
-            return frame_metrics
-
-        # Calculate tube-level metrics
-        tube_metrics = self.calculate_tube_level_metrics(task1_id, task2_id)
-        if "error" in tube_metrics:
-            return tube_metrics
-
-        # Combine results
-        results = {
-            "task_info": {
-                "task1": {"id": task1_id, "name": task_info[task_info['task_id'] == task1_id].iloc[0]['name'],
-                          "assignee": task_info[task_info['task_id'] == task1_id].iloc[0]['assignee']},
-                "task2": {"id": task2_id, "name": task_info[task_info['task_id'] == task2_id].iloc[0]['name'],
-                          "assignee": task_info[task_info['task_id'] == task2_id].iloc[0]['assignee']}
-            },
-            # Frame-level metrics
-            "average_iou": frame_metrics["mean_iou"],
-            "percent_iou_gte_05": frame_metrics["percent_iou_gte_05"],
-            "total_matched_frames": frame_metrics["total_matched_frames"],
-
-            # Tube-level metrics
-            "kappa_scores": tube_metrics["kappa_scores"],
-            "macro_avg_kappa": tube_metrics["macro_avg_kappa"],
-            "flip_rates": tube_metrics["flip_rates"],
-            "action_attributes": tube_metrics["action_attributes"]
-        }
-
-        return results
-
-    def _calculate_iou(self, box1: pd.Series, box2: pd.Series) -> float:
-        """Calculate IoU between two bounding boxes"""
-        # Convert to float to avoid issues
-        x1_1, y1_1, x2_1, y2_1 = float(box1['xtl']), float(box1['ytl']), float(box1['xbr']), float(box1['ybr'])
-        x1_2, y1_2, x2_2, y2_2 = float(box2['xtl']), float(box2['ytl']), float(box2['xbr']), float(box2['ybr'])
-
-        # Calculate intersection
-        xi1 = max(x1_1, x1_2)
-        yi1 = max(y1_1, y1_2)
-        xi2 = min(x2_1, x2_2)
-        yi2 = min(y2_1, y2_2)
-
-        if xi2 <= xi1 or yi2 <= yi1:
-            return 0.0
-
-        intersection = (xi2 - xi1) * (yi2 - yi1)
-
-        # Calculate union
-        area1 = (x2_1 - x1_1) * (y2_1 - y1_1)
-        area2 = (x2_2 - x1_2) * (y2_2 - y1_2)
-        union = area1 + area2 - intersection
-
-        return intersection / union if union > 0 else 0.0
-
-    def _align_labels_for_action(self, task1_data: pd.DataFrame, task2_data: pd.DataFrame,
-                                 action: str) -> Tuple[List[str], List[str]]:
-        """Align labels for a specific action across two tasks"""
-
-        # Get common frames and tracks
-        task1_frames = set(zip(task1_data['frame'], task1_data['track_id']))
-        task2_frames = set(zip(task2_data['frame'], task2_data['track_id']))
-        common_frames = task1_frames & task2_frames
-
-        labels1, labels2 = [], []
-
-        for frame, track in common_frames:
-            # Get labels for this frame/track combination
-            task1_row = task1_data[(task1_data['frame'] == frame) & (task1_data['track_id'] == track)]
-            task2_row = task2_data[(task2_data['frame'] == frame) & (task2_data['track_id'] == track)]
-
-            if not task1_row.empty and not task2_row.empty:
-                attrs1 = task1_row.iloc[0]['parsed_attributes']
-                attrs2 = task2_row.iloc[0]['parsed_attributes']
-
-                label1 = attrs1.get(action, 'unknown')
-                label2 = attrs2.get(action, 'unknown')
-
-                labels1.append(str(label1))
-                labels2.append(str(label2))
-
-        return labels1, labels2
-
-    def _calculate_flip_rates(self, task_data: pd.DataFrame, action_attributes: List[str]) -> Dict[str, float]:
-        """Calculate flip rates for temporal stability"""
-        flip_rates = {}
-
-        for action in action_attributes:
-            total_flips = 0
-            total_transitions = 0
-
-            # Group by track to analyze temporal stability
-            for track_id in task_data['track_id'].unique():
-                track_data = task_data[task_data['track_id'] == track_id].sort_values('frame')
-
-                if len(track_data) < 2:
-                    continue
-
-                prev_label = None
-                for _, row in track_data.iterrows():
-                    attrs = row['parsed_attributes']
-                    current_label = attrs.get(action, 'unknown')
-
-                    if prev_label is not None:
-                        total_transitions += 1
-                        if current_label != prev_label:
-                            total_flips += 1
-
-                    prev_label = current_label
-
-            flip_rates[action] = (total_flips / total_transitions) if total_transitions > 0 else 0.0
-
-        return flip_rates
-
-
 # --- Database Connection Pool ---
 @st.cache_resource
 def init_connection_pool(db_params: Dict[str, Any]) -> psycopg2.pool.SimpleConnectionPool:
@@ -337,6 +55,14 @@ def get_tasks_for_project(_pool, project_id):
     return df
 
 
+@st.cache_data
+def get_annotator_reliability(_pool):
+    if not _pool: return pd.DataFrame()
+    with _pool.getconn() as conn:
+        df = pd.DataFrame(AnnotatorReliability(conn).scoreboard())
+    return df
+
+
 def update_qc_status(_pool, task_ids: List[int], new_status: str):
     if not _pool: return
     with _pool.getconn() as conn:
@@ -379,6 +105,13 @@ if pool:
         else:
             st.dataframe(tasks_df, use_container_width=True)
 
+            with st.expander("Annotator reliability (all scored overlaps)"):
+                reliability_df = get_annotator_reliability(pool)
+                if reliability_df.empty:
+                    st.caption("No overlap pairs have been scored yet.")
+                else:
+                    st.dataframe(reliability_df, use_container_width=True)
+
             # --- Enhanced QC Section ---
             st.header("3. Enhanced Quality Control Workflow")
             eligible_tasks = tasks_df[(tasks_df['status'] == 'completed') & (tasks_df['qc_status'] == 'pending')]
@@ -407,11 +140,46 @@ if pool:
                         task_row = tasks_df[tasks_df['task_id'] == task_id].iloc[0]
                         st.write(f"  - Task {i}: ID {task_id} by {task_row['assignee']} ('{task_row['name']}')")
 
-                    if st.button("🔍 Run Enhanced Quality Check"):
+                    kappa_weights = st.selectbox(
+                        "Cohen's κ weighting:", KAPPA_WEIGHTS, format_func=lambda w: w or "unweighted",
+                        help="Linear/quadratic weights give partial credit for neighbouring options of ordinal attributes"
+                    )
+
+                    enhanced_qc = EnhancedQualityMetrics(db_params)
+
+                    # Clips with three or more annotators: agreement across all of them, plus a chosen pair in detail
+                    pair_tasks = selected_tasks
+                    if len(selected_tasks) > 2:
+                        if st.button(f"👥 Run Multi-Annotator Agreement ({len(selected_tasks)} annotators)"):
+                            with st.spinner("Computing agreement across all annotators..."):
+                                st.session_state['multi_rater_results'] = enhanced_qc.run_multi_annotator_check(
+                                    selected_tasks)
+                                st.rerun()
+                        pair_tasks = list(st.selectbox(
+                            "Pair for the detailed comparison:", list(itertools.combinations(selected_tasks, 2)),
+                            format_func=lambda p: f"Task {p[0]} vs Task {p[1]}"
+                        ))
+
+                    # Show stored results for an already-analysed pair straight away (once per selection)
+                    selection = (tuple(pair_tasks), kappa_weights)
+                    if st.session_state.get('qc_cache_checked') != selection:
+                        st.session_state['qc_cache_checked'] = selection
+                        cached = enhanced_qc.get_cached_results(pair_tasks[0], pair_tasks[1], kappa_weights)
+                        if cached:
+                            st.session_state['enhanced_qc_results'] = cached
+                            st.session_state['tasks_to_update'] = selected_tasks
+
+                    run_col, recompute_col = st.columns(2)
+                    run_clicked = run_col.button("🔍 Run Enhanced Quality Check")
+                    recompute_clicked = recompute_col.button("♻️ Recompute (ignore cache)")
+                    if run_clicked or recompute_clicked:
                         with st.spinner("Running comprehensive quality analysis..."):
-                            # Use enhanced quality metrics
-                            enhanced_qc = EnhancedQualityMetrics(db_params)
-                            results = enhanced_qc.run_comprehensive_quality_check(selected_tasks[0], selected_tasks[1])
+                            results = enhanced_qc.run_comprehensive_quality_check(pair_tasks[0], pair_tasks[1],
+                                                                                  kappa_weights,
+                                                                                  use_cache=not recompute_clicked)
+                            # A fresh run records the pair on the annotator scoreboard
+                            if not results.get('cached', True):
+                                get_annotator_reliability.clear()
                             st.session_state['enhanced_qc_results'] = results
                             st.session_state['tasks_to_update'] = selected_tasks
                             st.rerun()
@@ -428,6 +196,34 @@ if pool:
                             time.sleep(1)
                             st.rerun()
 
+    # 👥 Multi-Annotator Agreement Display
+    if 'multi_rater_results' in st.session_state:
+        multi = st.session_state['multi_rater_results']
+        st.header("👥 Multi-Annotator Agreement")
+        if "error" in multi:
+            st.error(f"Multi-annotator check failed: {multi['error']}")
+        else:
+            st.write(f"**Tasks:** {', '.join(f'{t} ({a})' for t, a in zip(multi['task_ids'], multi['assignees']))}")
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Macro Fleiss' κ", f"{multi['macro_fleiss_kappa']:.3f}",
+                        help="Chance-corrected label agreement across all annotators")
+            col2.metric("Macro Krippendorff's α", f"{multi['macro_krippendorff_alpha']:.3f}",
+                        help="Like Fleiss' κ, but tolerant of boxes some annotators did not draw")
+            col3.metric("Mean Pairwise IoU", f"{multi['mean_pairwise_iou']:.3f}",
+                        help=f"{multi['units_all_raters']} of {multi['units']} boxes were drawn by every annotator")
+            st.dataframe(pd.DataFrame({
+                "Action Attribute": multi['action_attributes'],
+                "Fleiss' κ": [f"{multi['fleiss_kappa'][a]:.3f}" for a in multi['action_attributes']],
+                "Krippendorff's α": [f"{multi['krippendorff_alpha'][a]:.3f}" for a in multi['action_attributes']],
+            }), use_container_width=True)
+            with st.expander("Pairwise IoU between annotators"):
+                labels = [f"{t} ({a})" for t, a in zip(multi['task_ids'], multi['assignees'])]
+                st.dataframe(pd.DataFrame(multi['pairwise_iou'], index=labels, columns=labels).round(3),
+                             use_container_width=True)
+        if st.button("Clear Multi-Annotator Results"):
+            del st.session_state['multi_rater_results']
+            st.rerun()
+
     # ✨ Enhanced QC Results Display
     if 'enhanced_qc_results' in st.session_state:
         results = st.session_state['enhanced_qc_results']
@@ -438,6 +234,10 @@ if pool:
         if "error" in results:
             st.error(f"Quality check failed: {results['error']}")
         else:
+            if results.get('cached'):
+                st.caption(f"Loaded from the QC cache (computed {results['computed_at']}); "
+                           "recomputed automatically when either task is re-synced.")
+
             # Task Information
             st.subheader("🎯 Task Comparison Summary")
             task_info = results['task_info']
@@ -451,11 +251,20 @@ if pool:
             st.subheader("📐 Frame-Level Box Agreement")
             col1, col2, col3 = st.columns(3)
             col1.metric("Mean IoU", f"{results['average_iou']:.3f}",
-                        help="Average Intersection over Union for matched bounding boxes")
-            col2.metric("% Frames IoU ≥ 0.5", f"{results['percent_iou_gte_05']:.1%}",
-                        help="Percentage of frames with IoU ≥ 0.5")
+                        help="Average Intersection over Union for one-to-one matched bounding boxes")
+            col2.metric("% Matched Boxes IoU ≥ 0.5", f"{results['percent_iou_gte_05']:.1%}",
+                        help="Percentage of matched box pairs with IoU ≥ 0.5")
             col3.metric("Total Matched Frames", results['total_matched_frames'],
-                        help="Number of frames compared between annotators")
+                        help="Number of frames with at least one matched box pair")
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Matched Box Pairs", results['matched_pairs'])
+            col2.metric(f"Unmatched ({task_info['task1']['assignee']})", results['unmatched_task1'],
+                        help="Boxes with no overlapping counterpart from the other annotator")
+            col3.metric(f"Unmatched ({task_info['task2']['assignee']})", results['unmatched_task2'],
+                        help="Boxes with no overlapping counterpart from the other annotator")
+            if results['pairs']:
+                with st.expander("Per-pair IoU"):
+                    st.dataframe(pd.DataFrame(results['pairs']), use_container_width=True)
 
             # Tube-Level Action Agreement
             st.subheader("🎬 Tube-Level Action Agreement")
@@ -516,9 +325,30 @@ if pool:
 
 
                 st.dataframe(report_df.style.applymap(color_kappa), use_container_width=True)
+
+                with st.expander("Label confusion per action"):
+                    confusion_action = st.selectbox("Action attribute:", list(results['confusion'].keys()))
+                    confusion = results['confusion'][confusion_action]
+                    st.dataframe(pd.DataFrame(confusion['matrix'], index=confusion['labels'],
+                                              columns=confusion['labels']), use_container_width=True)
+                    st.caption(f"Rows: {task_info['task1']['assignee']}, columns: {task_info['task2']['assignee']}")
             else:
                 st.warning("No action attributes found for comparison.")
 
+            # Tracks whose labels flip, so reviewers can jump straight to them
+            if any(results['unstable_tracks'].values()):
+                st.subheader("🔀 Unstable Tracks")
+                for annotator, task_key in (("annotator_1", "task1"), ("annotator_2", "task2")):
+                    tracks = results['unstable_tracks'][annotator]
+                    if not tracks:
+                        continue
+                    with st.expander(f"{task_info[task_key]['assignee']}: {len(tracks)} track(s) with label flips"):
+                        st.dataframe(pd.DataFrame(tracks).drop(columns='locations'), use_container_width=True)
+                        flip_track = st.selectbox("Show flips for track:", [t['track_id'] for t in tracks],
+                                                  key=f"flip_track_{annotator}")
+                        st.dataframe(pd.DataFrame(next(t['locations'] for t in tracks if t['track_id'] == flip_track)),
+                                     use_container_width=True)
+
             # Quality Assessment
             st.subheader("🎯 Quality Assessment")
 
@@ -528,7 +358,7 @@ if pool:
                 quality_issues.append(
                     f"⚠️ Low mean IoU ({results['average_iou']:.3f}) indicates poor bounding box agreement")
             if results['percent_iou_gte_05'] < 0.7:
-                quality_issues.append(f"⚠️ Only {results['percent_iou_gte_05']:.1%} of frames have IoU ≥ 0.5")
+                quality_issues.append(f"⚠️ Only {results['percent_iou_gte_05']:.1%} of matched boxes have IoU ≥ 0.5")
             if results['macro_avg_kappa'] < 0.4:
                 quality_issues.append(
                     f"⚠️ Low action agreement (κ = {results['macro_avg_kappa']:.3f}) indicates inconsistent labeling")
@@ -0,0 +1,613 @@
+# services/agreement_metrics.py
+
+# Vectorized agreement math shared by the QC services.
+# Boxes are float arrays of shape (n, 4) in (xtl, ytl, xbr, ybr) order.
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # scipy is in requirements.txt; without it, fall back to greedy matching
+    linear_sum_assignment = None
+
+try:
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+except ImportError:  # without scipy, fall back to label propagation
+    connected_components = None
+
+IOU_THRESHOLDS = (0.5, 0.75)
+IOU_HISTOGRAM_BINS = 10
+# Frames with fewer box pairs than this are matched on the dense IoU matrix without pruning
+SWEEP_MIN_PAIRS = 256
+
+
+def track_frame_keys(track_ids: np.ndarray, frames: np.ndarray) -> np.ndarray:
+    """Packs (track_id, frame) pairs into single int64 keys so they can be joined with array set operations."""
+    return (np.asarray(track_ids, dtype=np.int64) << 32) | (np.asarray(frames, dtype=np.int64) & 0xFFFFFFFF)
+
+
+def last_per_key(keys: np.ndarray) -> np.ndarray:
+    """Sorted indices of the last row of every distinct key, i.e. later rows replace earlier ones."""
+    keys = np.asarray(keys)
+    _, last = np.unique(keys[::-1], return_index=True)
+    return np.sort(keys.size - 1 - last)
+
+
+def align_by_key(keys_a: np.ndarray, keys_b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns index arrays (idx_a, idx_b) selecting the rows whose keys appear in both inputs, in key order."""
+    _, idx_a, idx_b = np.intersect1d(keys_a, keys_b, assume_unique=False, return_indices=True)
+    return idx_a, idx_b
+
+
+def aligned_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """IoU of each row of `boxes_a` with the same row of `boxes_b`."""
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    inter_w = np.clip(np.minimum(boxes_a[:, 2], boxes_b[:, 2]) - np.maximum(boxes_a[:, 0], boxes_b[:, 0]), 0, None)
+    inter_h = np.clip(np.minimum(boxes_a[:, 3], boxes_b[:, 3]) - np.maximum(boxes_a[:, 1], boxes_b[:, 1]), 0, None)
+    inter = inter_w * inter_h
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a + area_b - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def iou_summary(ious: np.ndarray, thresholds: Sequence[float] = IOU_THRESHOLDS,
+                bins: int = IOU_HISTOGRAM_BINS) -> Dict[str, Any]:
+    """Mean IoU, share of pairs at or above each threshold and a fixed-range histogram, all from one array."""
+    ious = np.asarray(ious, dtype=np.float64)
+    counts, edges = np.histogram(ious, bins=bins, range=(0.0, 1.0))
+    summary = {
+        "average_iou": float(ious.mean()) if ious.size else 0.0,
+        "iou_histogram": {"counts": counts.tolist(), "bin_edges": edges.tolist()},
+    }
+    for t in thresholds:
+        summary[_threshold_key(t)] = float((ious >= t).mean()) if ious.size else 0.0
+    return summary
+
+
+def iou_summary_from_counts(n_pairs: int, iou_sum: float, threshold_counts: Sequence[int],
+                            histogram_counts: Sequence[int], thresholds: Sequence[float] = IOU_THRESHOLDS,
+                            bins: int = IOU_HISTOGRAM_BINS) -> Dict[str, Any]:
+    """The `iou_summary` layout from pre-aggregated counts, e.g. when IoU was summarised in SQL."""
+    summary = {
+        "average_iou": iou_sum / n_pairs if n_pairs else 0.0,
+        "iou_histogram": {"counts": [int(c) for c in histogram_counts],
+                          "bin_edges": np.linspace(0.0, 1.0, bins + 1).tolist()},
+    }
+    for t, count in zip(thresholds, threshold_counts):
+        summary[_threshold_key(t)] = count / n_pairs if n_pairs else 0.0
+    return summary
+
+
+def _threshold_key(threshold: float) -> str:
+    return f"percent_iou_gte_{str(threshold).replace('0.', '0')}"
+
+
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """All-pairs IoU of shape (len(boxes_a), len(boxes_b)), computed with broadcasting."""
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(1, -1, 4)
+    inter_w = np.clip(np.minimum(boxes_a[..., 2], boxes_b[..., 2]) - np.maximum(boxes_a[..., 0], boxes_b[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(boxes_a[..., 3], boxes_b[..., 3]) - np.maximum(boxes_a[..., 1], boxes_b[..., 1]), 0, None)
+    inter = inter_w * inter_h
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    union = area_a + area_b - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def greedy_match(ious: np.ndarray, min_iou: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+    """One-to-one matching that repeatedly takes the highest remaining IoU."""
+    rows, cols = np.nonzero(ious > min_iou)
+    order = np.argsort(-ious[rows, cols], kind="stable")
+    used_rows, used_cols = set(), set()
+    matched_rows, matched_cols = [], []
+    for r, c in zip(rows[order], cols[order]):
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        matched_rows.append(r)
+        matched_cols.append(c)
+    return np.array(matched_rows, dtype=np.intp), np.array(matched_cols, dtype=np.intp)
+
+
+def match_boxes(ious: np.ndarray, min_iou: float = 0.0, method: str = "hungarian") -> Tuple[np.ndarray, np.ndarray]:
+    """
+    One-to-one assignment between the rows and columns of an IoU matrix, maximising total IoU.
+    Uses the Hungarian algorithm when scipy is installed, greedy matching otherwise.
+    Pairs with IoU <= `min_iou` are never reported as matches.
+    """
+    if ious.size == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    if method == "hungarian" and linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(ious, maximize=True)
+        keep = ious[rows, cols] > min_iou
+        return rows[keep], cols[keep]
+    return greedy_match(ious, min_iou)
+
+
+def _expand_ranges(lo: np.ndarray, hi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(owner, position) for every position in the half-open ranges [lo[i], hi[i])."""
+    counts = np.maximum(hi - lo, 0)
+    owners = np.repeat(np.arange(lo.size), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.repeat(lo, counts) + offsets
+
+
+def overlap_candidates(boxes_a: np.ndarray, boxes_b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Index pairs (rows, cols) of the boxes that can have positive IoU, found by sort-and-sweep on x:
+    two x-intervals overlap exactly when one starts inside the other, and with both sides sorted by
+    xtl those starts are contiguous ranges found with searchsorted. The x-overlapping pairs are then
+    filtered on y. Cost grows with the number of overlapping pairs rather than len(a) * len(b).
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    order_a = np.argsort(boxes_a[:, 0], kind="stable")
+    order_b = np.argsort(boxes_b[:, 0], kind="stable")
+    starts_a, starts_b = boxes_a[order_a, 0], boxes_b[order_b, 0]
+
+    # b starts inside a: xtl_a <= xtl_b < xbr_a
+    rows_1, pos = _expand_ranges(np.searchsorted(starts_b, boxes_a[:, 0], "left"),
+                                 np.searchsorted(starts_b, boxes_a[:, 2], "left"))
+    cols_1 = order_b[pos]
+    # a starts strictly inside b: xtl_b < xtl_a < xbr_b
+    cols_2, pos = _expand_ranges(np.searchsorted(starts_a, boxes_b[:, 0], "right"),
+                                 np.searchsorted(starts_a, boxes_b[:, 2], "left"))
+    rows_2 = order_a[pos]
+
+    rows, cols = np.concatenate([rows_1, rows_2]), np.concatenate([cols_1, cols_2])
+    y_overlap = np.maximum(boxes_a[rows, 1], boxes_b[cols, 1]) < np.minimum(boxes_a[rows, 3], boxes_b[cols, 3])
+    return rows[y_overlap], cols[y_overlap]
+
+
+def _components(n_nodes: int, u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """Connected-component label of every node of an undirected graph given as edge arrays."""
+    if connected_components is not None:
+        graph = coo_matrix((np.ones(u.size), (u, v)), shape=(n_nodes, n_nodes))
+        return connected_components(graph, directed=False)[1]
+    labels = np.arange(n_nodes)
+    while True:
+        low = np.minimum(labels[u], labels[v])
+        updated = labels.copy()
+        np.minimum.at(updated, u, low)
+        np.minimum.at(updated, v, low)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def match_boxes_pruned(boxes_a: np.ndarray, boxes_b: np.ndarray, min_iou: float = 0.0,
+                       method: str = "hungarian") -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    `match_boxes` for crowded frames: IoU is computed only for `overlap_candidates`, and boxes
+    linked by a positive IoU are split into connected components that are matched independently,
+    each on its own small dense matrix. Non-overlapping pairs can never be matched, so the result
+    equals dense matching (up to ties). Returns (rows, cols, ious) of the matched pairs.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    n_a, n_b = len(boxes_a), len(boxes_b)
+    if n_a * n_b < SWEEP_MIN_PAIRS:
+        ious = iou_matrix(boxes_a, boxes_b)
+        rows, cols = match_boxes(ious, min_iou, method)
+        return rows, cols, ious[rows, cols]
+
+    rows, cols = overlap_candidates(boxes_a, boxes_b)
+    ious = aligned_iou(boxes_a[rows], boxes_b[cols])
+    keep = ious > min_iou
+    rows, cols, ious = rows[keep], cols[keep], ious[keep]
+    if not rows.size:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+
+    labels = _components(n_a + n_b, rows, n_a + cols)[rows]
+    order = np.argsort(labels, kind="stable")
+    rows, cols, ious, labels = rows[order], cols[order], ious[order], labels[order]
+    bounds = np.flatnonzero(np.diff(labels)) + 1
+    matched_rows, matched_cols = [], []
+    for comp_rows, comp_cols, comp_ious in zip(np.split(rows, bounds), np.split(cols, bounds), np.split(ious, bounds)):
+        local_rows, row_index = np.unique(comp_rows, return_inverse=True)
+        local_cols, col_index = np.unique(comp_cols, return_inverse=True)
+        dense = np.zeros((local_rows.size, local_cols.size))
+        dense[row_index, col_index] = comp_ious
+        r, c = match_boxes(dense, min_iou, method)
+        matched_rows.append(local_rows[r])
+        matched_cols.append(local_cols[c])
+    matched_rows, matched_cols = np.concatenate(matched_rows), np.concatenate(matched_cols)
+    return matched_rows, matched_cols, aligned_iou(boxes_a[matched_rows], boxes_b[matched_cols])
+
+
+def untracked_unit_keys(keys_list: Sequence[np.ndarray], boxes_list: Sequence[np.ndarray],
+                        min_iou: float = 0.0) -> List[np.ndarray]:
+    """
+    Copies of each rater's `track_frame_keys` in which untracked boxes (negative track id), which
+    all share one key per frame, get a key of their own: within each frame every rater's untracked
+    boxes are matched one-to-one by IoU against the units of the raters before it, and matched boxes
+    share a unit key (track id -2, -3, ...). Tracked keys are returned unchanged.
+    """
+    keys_list = [np.array(k, dtype=np.int64) for k in keys_list]
+    untracked = [np.flatnonzero((k >> 32) < 0) for k in keys_list]
+    if not any(rows.size for rows in untracked):
+        return keys_list
+    boxes_list = [np.asarray(b, dtype=np.float64).reshape(-1, 4) for b in boxes_list]
+
+    frames = np.concatenate([k[rows] & 0xFFFFFFFF for k, rows in zip(keys_list, untracked)])
+    raters = np.concatenate([np.full(rows.size, r) for r, rows in enumerate(untracked)])
+    rows = np.concatenate(untracked)
+    order = np.lexsort((raters, frames))
+    frames, raters, rows = frames[order], raters[order], rows[order]
+    bounds = np.flatnonzero(np.diff(frames)) + 1
+    for frame, frame_raters, frame_rows in zip(frames[np.r_[0, bounds]], np.split(raters, bounds),
+                                               np.split(rows, bounds)):
+        unit_boxes = np.empty((0, 4))
+        for r in np.unique(frame_raters):
+            positions = frame_rows[frame_raters == r]
+            boxes = boxes_list[r][positions]
+            units, cols, _ = match_boxes_pruned(unit_boxes, boxes, min_iou)
+            labels = np.empty(positions.size, dtype=np.int64)
+            labels[cols] = units
+            unmatched = np.setdiff1d(np.arange(positions.size), cols)
+            labels[unmatched] = len(unit_boxes) + np.arange(unmatched.size)
+            unit_boxes = np.vstack([unit_boxes, boxes[unmatched]])
+            keys_list[r][positions] = track_frame_keys(-2 - labels, np.full(positions.size, frame))
+    return keys_list
+
+
+# --------------------- Categorical Agreement ---------------------
+# Attribute labels are encoded once into an (n, n_attributes) integer array; MISSING_CODE marks
+# absent or out-of-vocabulary labels, which are left out of every confusion matrix.
+MISSING_CODE = -1
+KAPPA_WEIGHTS = (None, "linear", "quadratic")
+
+
+def build_vocabulary(attribute_dicts: Sequence[Dict[str, Any]], names: Sequence[str],
+                     default: Optional[str] = None) -> Dict[str, List[Any]]:
+    """Per-attribute option lists taken from the observed labels (plus `default`), for data without a fixed schema."""
+    vocabulary = {}
+    for name in names:
+        values = {attrs[name] for attrs in attribute_dicts if name in attrs}
+        if default is not None:
+            values.add(default)
+        vocabulary[name] = sorted(values, key=str)
+    return vocabulary
+
+
+def encode_attributes(attribute_dicts: Sequence[Dict[str, Any]], vocabulary: Dict[str, Sequence[Any]],
+                      default: Optional[str] = None) -> np.ndarray:
+    """
+    Encodes each row's label for every attribute in `vocabulary` as its option index.
+    Rows without the attribute take `default` when given, otherwise MISSING_CODE.
+    """
+    codes = np.full((len(attribute_dicts), len(vocabulary)), MISSING_CODE, dtype=np.int16)
+    for j, (name, options) in enumerate(vocabulary.items()):
+        index = {option: i for i, option in enumerate(options)}
+        codes[:, j] = [index.get(attrs.get(name, default), MISSING_CODE) for attrs in attribute_dicts]
+    return codes
+
+
+def confusion_matrices(codes_a: np.ndarray, codes_b: np.ndarray, n_categories: int,
+                       n_attrs: Optional[int] = None) -> np.ndarray:
+    """
+    Confusion matrix of every attribute column at once, shape (n_attributes, K, K), from a single
+    bincount over the combined (attribute, label_a, label_b) index. Rows must already be aligned.
+    `n_attrs` defaults to the column count of 2-D inputs (1 for 1-D).
+    """
+    codes_a, codes_b = np.asarray(codes_a), np.asarray(codes_b)
+    if n_attrs is None:
+        n_attrs = codes_a.shape[1] if codes_a.ndim > 1 else 1
+    codes_a = codes_a.reshape(len(codes_a), n_attrs)
+    codes_b = codes_b.reshape(len(codes_b), n_attrs)
+    valid = (codes_a >= 0) & (codes_b >= 0)
+    attr_idx = np.broadcast_to(np.arange(n_attrs), codes_a.shape)
+    flat = (attr_idx[valid].astype(np.int64) * n_categories + codes_a[valid]) * n_categories + codes_b[valid]
+    counts = np.bincount(flat, minlength=n_attrs * n_categories * n_categories)
+    return counts.reshape(n_attrs, n_categories, n_categories).astype(np.float64)
+
+
+def agreement_weights(sizes: Sequence[int], weights: Optional[str] = None) -> np.ndarray:
+    """
+    Agreement weight matrices of shape (n_attributes, K, K): identity for plain kappa, or
+    1 - |i-j|/(k-1) (linear) and 1 - (|i-j|/(k-1))**2 (quadratic) for ordinal options.
+    """
+    if weights not in KAPPA_WEIGHTS:
+        raise ValueError(f"Unknown kappa weighting '{weights}'; expected one of {KAPPA_WEIGHTS}.")
+    sizes = np.asarray(sizes, dtype=np.float64)
+    k = int(sizes.max()) if sizes.size else 0
+    diff = np.abs(np.subtract.outer(np.arange(k), np.arange(k)))[None, :, :].astype(np.float64)
+    if weights is None:
+        return np.broadcast_to(diff == 0, (sizes.size, k, k)).astype(np.float64)
+    scaled = diff / np.maximum(sizes - 1, 1)[:, None, None]
+    return 1.0 - (scaled if weights == "linear" else scaled ** 2)
+
+
+def kappa_from_confusion(matrices: np.ndarray, weights: Optional[np.ndarray] = None,
+                         degenerate: float = 1.0) -> np.ndarray:
+    """
+    Cohen's kappa for a stack of confusion matrices (..., K, K), optionally weighted.
+    Empty matrices and matrices with chance agreement of 1 get `degenerate`.
+    """
+    if weights is None:
+        weights = np.eye(matrices.shape[-1])
+    total = matrices.sum(axis=(-2, -1))
+    safe_total = np.where(total > 0, total, 1.0)
+    observed = (weights * matrices).sum(axis=(-2, -1)) / safe_total
+    expected_counts = matrices.sum(axis=-1)[..., :, None] * matrices.sum(axis=-2)[..., None, :]
+    expected = (weights * expected_counts).sum(axis=(-2, -1)) / safe_total ** 2
+    undefined = (total == 0) | np.isclose(expected, 1.0)
+    kappa = np.divide(observed - expected, 1.0 - expected, out=np.zeros_like(observed), where=~undefined)
+    return np.where(undefined, degenerate, kappa)
+
+
+def cohen_kappa(codes_a: np.ndarray, codes_b: np.ndarray, sizes: Sequence[int], weights: Optional[str] = None,
+                degenerate: float = 1.0) -> np.ndarray:
+    """
+    Per-attribute Cohen's kappa between two aligned code arrays. No aligned rows at all scores
+    0.0 (nothing was compared); `degenerate` covers tables that exist but carry no information.
+    """
+    sizes = list(sizes)
+    if not len(codes_a):
+        return np.zeros(len(sizes))
+    k = max(sizes) if sizes else 1
+    matrices = confusion_matrices(codes_a, codes_b, k, len(sizes))
+    return kappa_from_confusion(matrices, agreement_weights(sizes, weights), degenerate)
+
+
+def pairwise_kappa(code_sets: Sequence[np.ndarray], sizes: Sequence[int], weights: Optional[str] = None,
+                   degenerate: float = 1.0) -> np.ndarray:
+    """
+    Multi-rater agreement as the mean Cohen's kappa over every pair of raters (Light's kappa).
+    `code_sets` holds one aligned (n, n_attributes) array per rater; all pairs share one bincount.
+    """
+    sizes = list(sizes)
+    n_attrs, k = len(sizes), (max(sizes) if sizes else 1)
+    pairs = [(i, j) for i in range(len(code_sets)) for j in range(i + 1, len(code_sets))]
+    if not pairs:
+        return np.full(n_attrs, degenerate)
+    stacked_a = np.hstack([code_sets[i] for i, _ in pairs])
+    stacked_b = np.hstack([code_sets[j] for _, j in pairs])
+    matrices = confusion_matrices(stacked_a, stacked_b, k, len(pairs) * n_attrs).reshape(len(pairs), n_attrs, k, k)
+    return kappa_from_confusion(matrices, agreement_weights(sizes, weights), degenerate).mean(axis=0)
+
+
+# --------------------- Temporal Stability ---------------------
+def flip_statistics(track_ids: np.ndarray, frames: np.ndarray, codes: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Label flips between consecutive frames of the same track, for every attribute column of `codes`
+    at once: one lexsort by (track, frame), then a comparison of the array with itself shifted by one.
+    Rows with a negative track id are untracked boxes and belong to no track.
+
+    Returns per-attribute `flips`/`transitions`/`rates`; per-track `track_ids`, `track_transitions`
+    and `track_flips` (n_tracks, n_attributes); and one entry per flip in `flip_track`, `flip_frame`,
+    `flip_attribute`, `flip_from` and `flip_to`.
+    """
+    track_ids = np.asarray(track_ids, dtype=np.int64)
+    frames = np.asarray(frames, dtype=np.int64)
+    codes = np.asarray(codes)
+    if codes.ndim == 1:
+        codes = codes[:, None]
+    tracked = track_ids >= 0
+    order = np.lexsort((frames[tracked], track_ids[tracked]))
+    tracks, frames, codes = track_ids[tracked][order], frames[tracked][order], codes[tracked][order]
+
+    # Transition i links sorted row i to row i + 1 when both belong to the same track
+    same_track = tracks[1:] == tracks[:-1]
+    changed = (codes[1:] != codes[:-1]) & same_track[:, None]
+    transitions = int(same_track.sum())
+    flips = changed.sum(axis=0)
+
+    unique_tracks, track_index = np.unique(tracks, return_inverse=True)
+    n_tracks, n_attrs = unique_tracks.size, codes.shape[1]
+    to_track = track_index[1:]
+    track_transitions = np.bincount(to_track, weights=same_track, minlength=n_tracks).astype(np.int64)
+    flat = (np.repeat(to_track, n_attrs) * n_attrs + np.tile(np.arange(n_attrs), to_track.size))
+    track_flips = np.bincount(flat, weights=changed.ravel(), minlength=n_tracks * n_attrs)
+    track_flips = track_flips.reshape(n_tracks, n_attrs).astype(np.int64)
+
+    rows, attrs = np.nonzero(changed)
+    return {
+        "flips": flips,
+        "transitions": transitions,
+        "rates": flips / transitions if transitions else np.zeros(n_attrs),
+        "track_ids": unique_tracks,
+        "track_transitions": track_transitions,
+        "track_flips": track_flips,
+        "flip_track": tracks[rows + 1],
+        "flip_frame": frames[rows + 1],
+        "flip_attribute": attrs,
+        "flip_from": codes[rows, attrs],
+        "flip_to": codes[rows + 1, attrs],
+    }
+
+
+def unstable_tracks(stats: Dict[str, np.ndarray], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Tracks with at least one flip, most flips first, as plain dicts for reporting."""
+    total = stats["track_flips"].sum(axis=1)
+    order = np.argsort(-total, kind="stable")
+    order = order[total[order] > 0][:limit]
+    return [
+        {
+            "track_id": int(stats["track_ids"][i]),
+            "transitions": int(stats["track_transitions"][i]),
+            "flips": int(total[i]),
+            "flip_rate": float(total[i] / (stats["track_transitions"][i] * stats["track_flips"].shape[1]))
+            if stats["track_transitions"][i] else 0.0,
+        }
+        for i in order
+    ]
+
+
+# --------------------- Multi-Rater Agreement ---------------------
+def stack_raters(keys_list: Sequence[np.ndarray], codes_list: Sequence[np.ndarray],
+                 boxes_list: Sequence[np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Aligns any number of raters on the union of their (track, frame) keys. Each rater's codes are
+    (n, n_attributes). Returns `keys` (U,), `codes` (R, U, n_attributes) with MISSING_CODE where a
+    rater has no box, and `boxes` (R, U, 4) with NaN there. Untracked boxes are matched into units
+    by IoU (`untracked_unit_keys`); a duplicated tracked key keeps its first row.
+    """
+    keys_list = untracked_unit_keys(keys_list, boxes_list)
+    keys = np.unique(np.concatenate(keys_list))
+    n_attrs = np.asarray(codes_list[0]).shape[1]
+    codes = np.full((len(keys_list), keys.size, n_attrs), MISSING_CODE, dtype=np.int16)
+    boxes = np.full((len(keys_list), keys.size, 4), np.nan)
+    for r, (rater_keys, rater_codes, rater_boxes) in enumerate(zip(keys_list, codes_list, boxes_list)):
+        unique_keys, first = np.unique(rater_keys, return_index=True)
+        slots = np.searchsorted(keys, unique_keys)
+        codes[r, slots] = np.asarray(rater_codes)[first]
+        boxes[r, slots] = np.asarray(rater_boxes, dtype=np.float64)[first]
+    return {"keys": keys, "codes": codes, "boxes": boxes}
+
+
+def category_counts(codes: np.ndarray, n_categories: int) -> np.ndarray:
+    """Per-unit label counts of shape (n_attributes, U, K) from stacked (R, U, n_attributes) codes, one bincount."""
+    n_raters, n_units, n_attrs = codes.shape
+    valid = codes >= 0
+    attr_idx = np.broadcast_to(np.arange(n_attrs), codes.shape)
+    unit_idx = np.broadcast_to(np.arange(n_units)[:, None], codes.shape)
+    flat = (attr_idx[valid].astype(np.int64) * n_units + unit_idx[valid]) * n_categories + codes[valid]
+    counts = np.bincount(flat, minlength=n_attrs * n_units * n_categories)
+    return counts.reshape(n_attrs, n_units, n_categories).astype(np.float64)
+
+
+def fleiss_kappa(counts: np.ndarray, degenerate: float = 1.0) -> np.ndarray:
+    """
+    Fleiss' kappa per attribute from (n_attributes, U, K) counts. Units rated fewer than twice are
+    skipped; units with differing numbers of raters are weighted by their own pair count.
+    """
+    raters = counts.sum(axis=-1)
+    pairable = raters >= 2
+    agreeing_pairs = (counts * (counts - 1)).sum(axis=-1)
+    unit_agreement = np.divide(agreeing_pairs, raters * (raters - 1), out=np.zeros_like(raters), where=pairable)
+    n_units = pairable.sum(axis=-1)
+    observed = np.divide(unit_agreement.sum(axis=-1), n_units, out=np.zeros(counts.shape[0]), where=n_units > 0)
+    totals = (counts * pairable[..., None]).sum(axis=1)
+    shares = np.divide(totals, totals.sum(axis=-1, keepdims=True), out=np.zeros_like(totals),
+                       where=totals.sum(axis=-1, keepdims=True) > 0)
+    expected = (shares ** 2).sum(axis=-1)
+    undefined = (n_units == 0) | np.isclose(expected, 1.0)
+    kappa = np.divide(observed - expected, 1.0 - expected, out=np.zeros_like(observed), where=~undefined)
+    return np.where(undefined, degenerate, kappa)
+
+
+def krippendorff_alpha(counts: np.ndarray, degenerate: float = 1.0) -> np.ndarray:
+    """Krippendorff's alpha (nominal) per attribute from (n_attributes, U, K) counts; tolerates missing ratings."""
+    raters = counts.sum(axis=-1)
+    pairable = raters >= 2
+    scale = np.divide(1.0, raters - 1, out=np.zeros_like(raters), where=pairable)
+    # Coincidence matrix: sum over units of (n_u n_u^T - diag(n_u)) / (m_u - 1)
+    coincidence = np.einsum("aui,auj,au->aij", counts, counts, scale)
+    coincidence -= np.einsum("aui,au->ai", counts, scale)[..., None] * np.eye(counts.shape[-1])
+    n = coincidence.sum(axis=(-2, -1))
+    marginals = coincidence.sum(axis=-1)
+    observed = n - np.trace(coincidence, axis1=-2, axis2=-1)
+    expected = n ** 2 - (marginals ** 2).sum(axis=-1)
+    undefined = (n < 2) | (expected <= 0)
+    alpha = 1.0 - np.divide((n - 1) * observed, expected, out=np.zeros_like(n), where=~undefined)
+    return np.where(undefined, degenerate, alpha)
+
+
+def pairwise_rater_iou(boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Mean IoU for every rater pair from stacked (R, U, 4) boxes (NaN = missing), over the units both
+    raters boxed. Returns an (R, R) matrix of means and the matching (R, R) unit counts.
+    """
+    n_raters = boxes.shape[0]
+    rows, cols = np.triu_indices(n_raters, k=1)
+    ious = aligned_iou(boxes[rows].reshape(-1, 4), boxes[cols].reshape(-1, 4)).reshape(rows.size, -1)
+    both = ~(np.isnan(boxes[rows]).any(axis=-1) | np.isnan(boxes[cols]).any(axis=-1))
+    counts = both.sum(axis=-1)
+    means = np.divide(np.where(both, ious, 0.0).sum(axis=-1), counts, out=np.zeros(rows.size), where=counts > 0)
+    matrix, units = np.eye(n_raters), np.zeros((n_raters, n_raters), dtype=np.int64)
+    matrix[rows, cols] = matrix[cols, rows] = means
+    units[rows, cols] = units[cols, rows] = counts
+    return matrix, units
+
+
+def multi_rater_agreement(keys_list: Sequence[np.ndarray], codes_list: Sequence[np.ndarray],
+                          boxes_list: Sequence[np.ndarray], sizes: Sequence[int],
+                          degenerate: float = 1.0) -> Dict[str, Any]:
+    """
+    Fleiss' kappa, Krippendorff's alpha and mean pairwise IoU for N raters in one pass over
+    the stacked rater arrays.
+    """
+    stacked = stack_raters(keys_list, codes_list, boxes_list)
+    counts = category_counts(stacked["codes"], max(sizes, default=1))
+    iou_by_pair, units_by_pair = pairwise_rater_iou(stacked["boxes"])
+    pair_rows, pair_cols = np.triu_indices(len(keys_list), k=1)
+    weights = units_by_pair[pair_rows, pair_cols]
+    present = ~np.isnan(stacked["boxes"]).any(axis=-1)
+    return {
+        "fleiss_kappa": fleiss_kappa(counts, degenerate),
+        "krippendorff_alpha": krippendorff_alpha(counts, degenerate),
+        "pairwise_iou": iou_by_pair,
+        "mean_pairwise_iou": float(np.average(iou_by_pair[pair_rows, pair_cols], weights=weights))
+        if weights.sum() else 0.0,
+        "units": int(stacked["keys"].size),
+        "units_all_raters": int(present.all(axis=0).sum()),
+    }
+
+
+# --------------------- Bootstrap Intervals ---------------------
+BOOTSTRAP_RESAMPLES = 1000
+BOOTSTRAP_CONFIDENCE = 0.95
+
+
+def cluster_bootstrap(clusters: np.ndarray, ious: np.ndarray, codes_a: np.ndarray, codes_b: np.ndarray,
+                      sizes: Sequence[int], weights: Optional[str] = None, n_resamples: int = BOOTSTRAP_RESAMPLES,
+                      seed: Optional[int] = None, confidence: float = BOOTSTRAP_CONFIDENCE,
+                      degenerate: float = 1.0) -> Dict[str, Any]:
+    """
+    Percentile bootstrap intervals for mean IoU and per-attribute kappa over aligned box pairs,
+    resampling whole clusters (tracks) since boxes of one track are not independent. Negative
+    cluster ids are untracked boxes and form one cluster each.
+
+    Every cluster is reduced once to its IoU sum, box count and confusion counts; all resamples
+    are drawn as one (n_resamples, n_clusters) index matrix, turned into cluster multiplicities,
+    and each statistic is a single matrix product over the cluster totals.
+    """
+    clusters = np.asarray(clusters, dtype=np.int64)
+    untracked = clusters < 0
+    clusters = np.where(untracked, clusters.max(initial=0) + 1 + np.arange(clusters.size), clusters)
+    cluster_ids, cluster_index = np.unique(clusters, return_inverse=True)
+    n_clusters = cluster_ids.size
+    sizes = list(sizes)
+    n_attrs, k = len(sizes), max(sizes, default=1)
+    if not n_clusters:
+        return {"average_iou": (0.0, 0.0), "kappa": np.zeros((n_attrs, 2)), "macro_avg_kappa": (0.0, 0.0),
+                "n_resamples": 0, "clusters": 0}
+
+    iou_sums = np.bincount(cluster_index, weights=ious, minlength=n_clusters)
+    box_counts = np.bincount(cluster_index, minlength=n_clusters).astype(np.float64)
+    # Confusion counts per cluster, (n_clusters, n_attrs * k * k), from one bincount
+    codes_a = np.asarray(codes_a).reshape(clusters.size, -1)
+    codes_b = np.asarray(codes_b).reshape(clusters.size, -1)
+    valid = (codes_a >= 0) & (codes_b >= 0)
+    cell = (np.arange(n_attrs) * k + codes_a.astype(np.int64)) * k + codes_b
+    flat = np.broadcast_to(cluster_index[:, None], cell.shape)[valid] * (n_attrs * k * k) + cell[valid]
+    cluster_confusion = np.bincount(flat, minlength=n_clusters * n_attrs * k * k).reshape(n_clusters, -1)
+
+    rng = np.random.default_rng(seed)
+    draws = rng.integers(0, n_clusters, size=(n_resamples, n_clusters))
+    offsets = (np.arange(n_resamples) * n_clusters)[:, None]
+    multiplicity = np.bincount((draws + offsets).ravel(), minlength=n_resamples * n_clusters)
+    multiplicity = multiplicity.reshape(n_resamples, n_clusters).astype(np.float64)
+
+    resampled_counts = multiplicity @ box_counts
+    mean_ious = np.divide(multiplicity @ iou_sums, resampled_counts,
+                          out=np.zeros(n_resamples), where=resampled_counts > 0)
+    matrices = (multiplicity @ cluster_confusion).reshape(n_resamples, n_attrs, k, k)
+    kappas = kappa_from_confusion(matrices, agreement_weights(sizes, weights), degenerate)
+
+    tail = (1.0 - confidence) / 2 * 100
+    bounds = [tail, 100 - tail]
+    return {
+        "average_iou": tuple(np.percentile(mean_ious, bounds).tolist()),
+        "kappa": np.percentile(kappas, bounds, axis=0).T,
+        "macro_avg_kappa": tuple(np.percentile(kappas.mean(axis=1), bounds).tolist()),
+        "n_resamples": int(n_resamples),
+        "clusters": int(n_clusters),
+    }
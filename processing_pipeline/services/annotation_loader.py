@@ -0,0 +1,203 @@
+# services/annotation_loader.py
+import csv
+import io
+import logging
+import os
+import sys
+import hashlib
+from typing import Dict, Iterable, Iterator, List, Tuple
+import psycopg2.extras
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.annotation_parser import ANNOTATION_COLUMNS
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Tasks with fewer rows than this are written with a plain execute_values INSERT.
+COPY_THRESHOLD = int(os.getenv("ANNOTATION_COPY_THRESHOLD", "2000"))
+
+STORED_COLUMNS = ANNOTATION_COLUMNS + ["project_id", "row_hash"]
+
+# Identity of a stored box: tracked boxes are keyed by track, untracked ones by their per-frame person_id.
+_ROW_KEY_MATCH = (
+    "a.task_id = s.task_id AND a.frame = s.frame AND a.track_id IS NOT DISTINCT FROM s.track_id "
+    "AND (s.track_id IS NOT NULL OR a.person_id = s.person_id)"
+)
+
+
+_PERSON_ID = ANNOTATION_COLUMNS.index("person_id")
+_TRACK_ID = ANNOTATION_COLUMNS.index("track_id")
+
+
+def _content_hash(row: Tuple) -> str:
+    """
+    MD5 of every parsed column except task_id. Tracked boxes are identified by (track_id, frame),
+    so their per-frame person_id is left out: renumbering a frame does not change their content.
+    """
+    fields = row[1:] if row[_TRACK_ID] is None else row[1:_PERSON_ID] + row[_PERSON_ID + 1:]
+    return hashlib.md5("\x1f".join(map(str, fields)).encode("utf-8")).hexdigest()
+
+
+def with_project_and_hash(batch: List[Tuple], project_id: int) -> List[Tuple]:
+    """
+    Appends the project id and the content hash; the hash is used to detect boxes that
+    changed between syncs.
+    """
+    return [row + (project_id, _content_hash(row)) for row in batch]
+
+
+class _CsvRowStream(io.TextIOBase):
+    """File-like view over row batches that renders CSV lazily, so COPY never needs the whole task in memory."""
+
+    def __init__(self, row_batches: Iterable[List[Tuple]]):
+        self._batches = iter(row_batches)
+        self._buffer = ""
+        self.rows_written = 0
+
+    def _render_next_batch(self) -> bool:
+        batch = next(self._batches, None)
+        if batch is None:
+            return False
+        out = io.StringIO()
+        # None -> unquoted empty field, which COPY ... CSV reads as NULL
+        csv.writer(out, lineterminator="\n").writerows(batch)
+        self._buffer += out.getvalue()
+        self.rows_written += len(batch)
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            if not self._render_next_batch():
+                break
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+class AnnotationLoader:
+    """
+    Syncs a task's annotations inside the caller's transaction by diffing against what is stored.
+
+    Incoming rows are staged in a temporary table (COPY for large tasks, execute_values
+    for small ones) together with a content hash. Rows are matched on
+    (task_id, track_id or person_id, frame) and only rows whose hash changed are updated;
+    new rows are inserted and rows that disappeared are deleted. An empty export deletes
+    every stored row of the task.
+    """
+
+    def __init__(self, conn, copy_threshold: int = COPY_THRESHOLD):
+        self.conn = conn
+        self.copy_threshold = copy_threshold
+        self.columns = ", ".join(STORED_COLUMNS)
+
+    def sync_task_annotations(self, task_id: int, project_id: int, row_batches: Iterable[List[Tuple]]) -> Dict[str, int]:
+        """Returns counts of inserted, updated, deleted, unchanged and renumbered rows for `task_id`."""
+        batches = (with_project_and_hash(batch, project_id) for batch in row_batches)
+        head = []
+        head_rows = 0
+        for batch in batches:
+            head.append(batch)
+            head_rows += len(batch)
+            if head_rows >= self.copy_threshold:
+                break
+        else:
+            total = self._stage_small([row for batch in head for row in batch])
+            return self._apply_diff(task_id, project_id, total)
+        total = self._stage_copy(self._chain(head, batches))
+        logger.info(f"✓ COPY-staged {total} rows for task {task_id}.")
+        return self._apply_diff(task_id, project_id, total)
+
+    @staticmethod
+    def _chain(head: List[List[Tuple]], rest: Iterator[List[Tuple]]) -> Iterator[List[Tuple]]:
+        yield from head
+        yield from rest
+
+    def _create_stage(self, cur):
+        # Only the staged columns and no constraints: LIKE would copy annotation_id's NOT NULL without its default
+        cur.execute(f"CREATE TEMP TABLE annotations_stage ON COMMIT DROP AS SELECT {self.columns} FROM annotations WITH NO DATA;")
+
+    def _stage_small(self, rows: List[Tuple]) -> int:
+        with self.conn.cursor() as cur:
+            self._create_stage(cur)
+            if rows:
+                psycopg2.extras.execute_values(
+                    cur, f"INSERT INTO annotations_stage ({self.columns}) VALUES %s;", rows, page_size=len(rows)
+                )
+        return len(rows)
+
+    def _stage_copy(self, row_batches: Iterable[List[Tuple]]) -> int:
+        stream = _CsvRowStream(row_batches)
+        with self.conn.cursor() as cur:
+            self._create_stage(cur)
+            cur.copy_expert(f"COPY annotations_stage ({self.columns}) FROM STDIN WITH (FORMAT csv)", stream)
+        return stream.rows_written
+
+    def _apply_diff(self, task_id: int, project_id: int, total: int) -> Dict[str, int]:
+        counts = {"total": total, "inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0, "renumbered": 0}
+        update_set = ", ".join(f"{col} = s.{col}" for col in STORED_COLUMNS if col not in ("task_id", "project_id"))
+        with self.conn.cursor() as cur:
+            cur.execute(
+                f"""
+                DELETE FROM annotations a WHERE a.project_id = %s AND a.task_id = %s
+                AND NOT EXISTS (SELECT 1 FROM annotations_stage s WHERE {_ROW_KEY_MATCH});
+                """,
+                (project_id, task_id)
+            )
+            counts["deleted"] = cur.rowcount
+            cur.execute(
+                f"""
+                UPDATE annotations a SET {update_set}
+                FROM annotations_stage s
+                WHERE a.project_id = %s AND a.task_id = %s AND {_ROW_KEY_MATCH}
+                  AND a.row_hash IS DISTINCT FROM s.row_hash;
+                """,
+                (project_id, task_id)
+            )
+            counts["updated"] = cur.rowcount
+            # Unchanged tracked boxes whose per-frame number moved: refresh person_id only, so numbers
+            # stay unique within a frame without counting the box as changed
+            cur.execute(
+                f"""
+                UPDATE annotations a SET person_id = s.person_id
+                FROM annotations_stage s
+                WHERE a.project_id = %s AND a.task_id = %s AND {_ROW_KEY_MATCH}
+                  AND a.row_hash = s.row_hash AND a.person_id IS DISTINCT FROM s.person_id;
+                """,
+                (project_id, task_id)
+            )
+            counts["renumbered"] = cur.rowcount
+            cur.execute(
+                f"""
+                INSERT INTO annotations ({self.columns})
+                SELECT {", ".join(f"s.{col}" for col in STORED_COLUMNS)} FROM annotations_stage s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM annotations a WHERE a.project_id = %s AND a.task_id = %s AND {_ROW_KEY_MATCH}
+                );
+                """,
+                (project_id, task_id)
+            )
+            counts["inserted"] = cur.rowcount
+        counts["unchanged"] = total - counts["inserted"] - counts["updated"]
+        return counts
+
+    def stamp_annotation_version(self, task_id: int, project_id: int) -> str:
+        """Stores an order-independent digest of the task's row hashes in tasks.annotation_version."""
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE tasks SET annotation_version = (
+                    SELECT md5(string_agg(row_hash, '' ORDER BY row_hash)) FROM annotations
+                    WHERE project_id = %s AND task_id = %s
+                )
+                WHERE task_id = %s
+                RETURNING annotation_version;
+                """,
+                (project_id, task_id, task_id)
+            )
+            row = cur.fetchone()
+        return row[0] if row else None
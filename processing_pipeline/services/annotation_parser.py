@@ -0,0 +1,207 @@
+# services/annotation_parser.py
+import json
+import logging
+import os
+import sys
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from itertools import islice
+from typing import Dict, List, Any, Tuple, Iterable, Iterator, Optional, IO, Sequence
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.shared_config import attribute_codes
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Column order of every row produced here; matches the INSERT in post_annotation_service.
+ANNOTATION_COLUMNS = ["task_id", "keyframe_name", "person_id", "track_id", "frame", "xtl", "ytl", "xbr", "ybr",
+                      "attributes", "attribute_codes"]
+
+# How box attributes are stored: "json" (JSONB only), "codes" (SMALLINT[] option codes from the
+# shared_config index only; attributes outside that index are dropped) or "both".
+ATTRIBUTE_STORAGE = os.getenv("ANNOTATION_ATTRIBUTE_STORAGE", "json").lower()
+
+# Rows handed to the DB writer per batch.
+BATCH_SIZE = 5000
+
+# Both ingest paths derive ids the same way, so switching between them leaves the diff sync idle:
+# - track_id: interpolation tasks use the "CVAT for video" export numbering (tracks in id order, then
+#   every standalone shape as a single-frame track); annotation tasks export as images and have none.
+# - person_id: per frame from 1, tracked boxes by track_id, then untracked boxes by coordinates.
+# - coordinates: two decimals, as the XML export writes them.
+COORDINATE_DECIMALS = 2
+
+
+def batched(rows: Iterable[Tuple], batch_size: int = BATCH_SIZE) -> Iterator[List[Tuple]]:
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _attribute_fields(attributes: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """(attributes JSON, attribute_codes array literal) according to ATTRIBUTE_STORAGE."""
+    as_json = json.dumps(attributes) if ATTRIBUTE_STORAGE != "codes" else None
+    # A Postgres array literal, so the value is the same for execute_values, COPY and the row hash
+    as_codes = "{" + ",".join(map(str, attribute_codes(attributes))) + "}" if ATTRIBUTE_STORAGE != "json" else None
+    return as_json, as_codes
+
+
+def _box_order(track_id: Optional[int], box: Sequence[float], attributes: Dict[str, Any]) -> Tuple:
+    """Sort key that fixes person_id within a frame (see the notes above BATCH_SIZE)."""
+    return track_id is None, track_id or 0, *box, json.dumps(attributes, sort_keys=True)
+
+
+def _xml_box(box_tag: ET.Element) -> Tuple[List[float], Dict[str, Any]]:
+    box = [float(box_tag.get(k)) for k in ("xtl", "ytl", "xbr", "ybr")]
+    return box, {attr.get("name"): attr.text for attr in box_tag.iter("attribute")}
+
+
+def _row(task_id: int, keyframe_name: Optional[str], person_id: int, track_id: Optional[int], frame: int,
+         box: Sequence[float], attributes: Dict[str, Any]) -> Tuple:
+    return (task_id, keyframe_name, person_id, track_id, frame, *box, *_attribute_fields(attributes))
+
+
+def iter_xml_rows(source: IO[bytes], task_id: int, frame_names: Optional[List[str]] = None) -> Iterator[Tuple]:
+    """
+    Streams annotation rows out of a CVAT 1.1 XML export with `iterparse`.
+
+    Handles both the `<image>/<box>` layout ("CVAT for images") and the
+    `<track>/<box frame=...>` layout ("CVAT for video", interpolation tasks).
+    Each top-level element is cleared once consumed, so memory stays bounded by
+    a single image or track rather than by the whole document.
+    Track boxes marked `outside` are not visible and are skipped. `frame_names`
+    resolves track frame numbers to image names when given. Image boxes are
+    numbered in `_box_order`, like the API path.
+    """
+    context = ET.iterparse(source, events=("start", "end"))
+    _, root = next(context)
+    boxes_per_frame = defaultdict(int)
+
+    for event, elem in context:
+        if event != "end" or elem.tag not in ("image", "track", "meta"):
+            continue
+
+        if elem.tag == "image":
+            frame = int(elem.get("id", 0))
+            keyframe_name = elem.get("name")
+            boxes = sorted((_xml_box(box_tag) for box_tag in elem.findall("box")),
+                           key=lambda b: _box_order(None, *b))
+            for person_id, (box, attributes) in enumerate(boxes, start=1):
+                yield _row(task_id, keyframe_name, person_id, None, frame, box, attributes)
+
+        elif elem.tag == "track":
+            track_id = int(elem.get("id"))
+            for box_tag in elem.findall("box"):
+                if box_tag.get("outside") == "1":
+                    continue
+                frame = int(box_tag.get("frame"))
+                keyframe_name = frame_names[frame] if frame_names and frame < len(frame_names) else None
+                # Tracks arrive in id order, so counting per frame numbers boxes by track_id
+                boxes_per_frame[frame] += 1
+                yield _row(task_id, keyframe_name, boxes_per_frame[frame], track_id, frame, *_xml_box(box_tag))
+
+        # Drop everything parsed so far; only the root element survives.
+        root.clear()
+
+
+def attribute_names_by_spec_id(labels: List[Dict[str, Any]]) -> Dict[int, str]:
+    """Maps CVAT attribute spec ids to attribute names for every label of a task."""
+    return {attr["id"]: attr["name"] for label in labels for attr in label.get("attributes", [])}
+
+
+def _named_attributes(raw_attributes: List[Dict[str, Any]], spec_names: Dict[int, str]) -> Dict[str, str]:
+    return {spec_names[a["spec_id"]]: a.get("value") for a in raw_attributes if a.get("spec_id") in spec_names}
+
+
+def _expand_track(track: Dict[str, Any], stop_frame: int, spec_names: Dict[int, str]) -> Iterable[Tuple[int, List[float], Dict[str, str]]]:
+    """
+    Yields (frame, box, attributes) for every visible frame of a CVAT track, linearly
+    interpolating between keyframes the same way the dataset export does.
+    """
+    shapes = sorted((s for s in track.get("shapes", []) if s.get("type", "rectangle") == "rectangle"),
+                    key=lambda s: s["frame"])
+    track_attrs = _named_attributes(track.get("attributes", []), spec_names)
+    shape_attrs = {}
+
+    for i, shape in enumerate(shapes):
+        shape_attrs.update(_named_attributes(shape.get("attributes", []), spec_names))
+        if shape.get("outside"):
+            continue
+        next_shape = shapes[i + 1] if i + 1 < len(shapes) else None
+        end_frame = next_shape["frame"] if next_shape else stop_frame + 1
+        attributes = {**track_attrs, **shape_attrs}
+        start_points = shape["points"]
+        for frame in range(shape["frame"], end_frame):
+            if next_shape is None or frame == shape["frame"]:
+                points = start_points
+            else:
+                alpha = (frame - shape["frame"]) / (next_shape["frame"] - shape["frame"])
+                points = [p0 + (p1 - p0) * alpha for p0, p1 in zip(start_points, next_shape["points"])]
+            yield frame, points, attributes
+
+
+def track_numbering(track_ids: Iterable[int], shape_ids: Iterable[int], mode: str) -> Dict[Tuple[str, int], int]:
+    """
+    {("track" | "shape", CVAT id): track_id} as the dataset export numbers them: "CVAT for video"
+    counts the task's tracks in id order, then every standalone shape as a single-frame track.
+    Annotation-mode tasks export as images, which carry no track ids, so the mapping is empty.
+    """
+    if mode != "interpolation":
+        return {}
+    tracks, shapes = sorted(set(track_ids)), sorted(set(shape_ids))
+    numbering = {("track", t): i for i, t in enumerate(tracks)}
+    numbering.update({("shape", s): len(tracks) + i for i, s in enumerate(shapes)})
+    return numbering
+
+
+def _complete_frames(task_id: int, boxes_by_frame: Dict[int, List], frame_names: List[str],
+                     before: Optional[int] = None) -> Iterator[Tuple]:
+    """Emits and forgets every buffered frame below `before` (all of them when None), numbered in `_box_order`."""
+    for frame in sorted(f for f in boxes_by_frame if before is None or f < before):
+        boxes = sorted(boxes_by_frame.pop(frame), key=lambda b: _box_order(*b))
+        if frame >= len(frame_names):
+            logger.warning(f"Task {task_id}: frame {frame} has no entry in the task's frame list; skipping.")
+            continue
+        for person_id, (track_id, box, attributes) in enumerate(boxes, start=1):
+            yield _row(task_id, frame_names[frame], person_id, track_id, frame, box, attributes)
+
+
+def rows_from_job_annotations(task_id: int, jobs: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]],
+                              frame_names: List[str], spec_names: Dict[int, str],
+                              numbering: Dict[Tuple[str, int], int]) -> Iterator[Tuple]:
+    """
+    Converts CVAT JSON annotations (one (job, annotations) pair per job) into annotation rows with
+    the same ids as the export path; `numbering` comes from `track_numbering`.
+
+    `jobs` is consumed lazily in start_frame order. Later jobs cannot add boxes before their own
+    start frame, so each frame is emitted once the job starting after it is read, and memory holds
+    the boxes of about one job rather than of the whole task.
+    """
+    boxes_by_frame = defaultdict(list)
+    seen_shapes, seen_tracks = set(), set()
+
+    def box_of(points):
+        return [round(float(p), COORDINATE_DECIMALS) for p in points[:4]]
+
+    for job, annotations in jobs:
+        yield from _complete_frames(task_id, boxes_by_frame, frame_names, before=job.get("start_frame", 0))
+        stop_frame = job.get("stop_frame", len(frame_names) - 1)
+        for shape in annotations.get("shapes", []):
+            if shape.get("type") != "rectangle" or shape["id"] in seen_shapes:
+                continue
+            seen_shapes.add(shape["id"])
+            boxes_by_frame[shape["frame"]].append((numbering.get(("shape", shape["id"])), box_of(shape["points"]),
+                                                   _named_attributes(shape.get("attributes", []), spec_names)))
+        for track in annotations.get("tracks", []):
+            if track["id"] in seen_tracks:
+                continue
+            seen_tracks.add(track["id"])
+            track_id = numbering.get(("track", track["id"]))
+            for frame, points, attributes in _expand_track(track, stop_frame, spec_names):
+                boxes_by_frame[frame].append((track_id, box_of(points), attributes))
+
+    yield from _complete_frames(task_id, boxes_by_frame, frame_names)
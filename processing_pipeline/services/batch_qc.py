@@ -0,0 +1,273 @@
+# services/batch_qc.py
+import argparse
+import itertools
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, Any, List, Optional
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.qc_data_loader import load_qc_bundles
+from processing_pipeline.services.qc_metrics import EnhancedQualityMetrics
+from processing_pipeline.services.reliability import AnnotatorReliability, pair_contribution
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --------------------- Settings ---------------------
+BATCH_QC_WORKERS = int(os.getenv("BATCH_QC_WORKERS", str(os.cpu_count() or 2)))
+# Overlap groups whose annotations are fetched per query; bounds memory on large projects
+GROUPS_PER_FETCH = int(os.getenv("BATCH_QC_GROUPS_PER_FETCH", "50"))
+
+
+# Process pool shared by every run in a long-lived server (see shared_executor)
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+
+def shared_executor() -> ProcessPoolExecutor:
+    """One process pool for the whole server, so concurrent requests do not each spawn BATCH_QC_WORKERS processes."""
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ProcessPoolExecutor(max_workers=max(BATCH_QC_WORKERS, 1))
+        return _shared_executor
+
+
+def shutdown_shared_executor():
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is not None:
+            _shared_executor.shutdown(wait=False, cancel_futures=True)
+            _shared_executor = None
+
+
+# --------------------- Group Scoring ---------------------
+def score_group(clip: str, bundles: List[Dict[str, Any]], kappa_weights: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Agreement for one overlap group: frame- and tube-level metrics for a pair, or Fleiss' kappa,
+    Krippendorff's alpha and mean pairwise IoU in one pass for three or more annotators.
+    Module-level so it can run in a worker process.
+    """
+    metrics = EnhancedQualityMetrics(db_params={})
+    task_ids = [b["task_id"] for b in bundles]
+    if len(bundles) < 2:
+        return {"clip": clip, "task_ids": task_ids, "error": "fewer than two annotated tasks"}
+    if len(bundles) > 2:
+        multi = metrics.calculate_multi_rater_metrics(bundles)
+        if "error" in multi:
+            return {"clip": clip, "task_ids": task_ids, "error": multi["error"]}
+        return {
+            "clip": clip,
+            "task_ids": task_ids,
+            "mean_iou": multi["mean_pairwise_iou"],
+            "macro_avg_kappa": multi["macro_fleiss_kappa"],
+            "mean_flip_rate": float(np.mean([np.mean(list(rates.values())) if rates else 0.0
+                                             for rates in multi["flip_rates"].values()])),
+            "multi_rater": {k: multi[k] for k in ("fleiss_kappa", "krippendorff_alpha", "macro_krippendorff_alpha",
+                                                  "pairwise_iou", "units", "units_all_raters")},
+            "flip_rates": {t: {"rates": rates} for t, rates in multi["flip_rates"].items()},
+        }
+
+    pairs, flip_rates = [], {}
+    for data1, data2 in itertools.combinations(bundles, 2):
+        frame = metrics.calculate_frame_level_metrics(data1, data2)
+        tube = metrics.calculate_tube_level_metrics(data1, data2, kappa_weights)
+        if "error" in frame or "error" in tube:
+            return {"clip": clip, "task_ids": task_ids, "error": frame.get("error") or tube.get("error")}
+        pairs.append({
+            "task_ids": [data1["task_id"], data2["task_id"]],
+            "assignees": [data1["assignee"], data2["assignee"]],
+            "versions": [data1["annotation_version"], data2["annotation_version"]],
+            "mean_iou": frame["mean_iou"],
+            "percent_iou_gte_05": frame["percent_iou_gte_05"],
+            "matched_pairs": frame["matched_pairs"],
+            "unmatched": [frame["unmatched_task1"], frame["unmatched_task2"]],
+            "kappa_scores": tube["kappa_scores"],
+            "macro_avg_kappa": float(tube["macro_avg_kappa"]),
+        })
+        # A task's flip rates do not depend on the pair; keep the first computed
+        for data, annotator in ((data1, "annotator_1"), (data2, "annotator_2")):
+            flip_rates.setdefault(data["task_id"], {
+                "rates": tube["flip_rates"][annotator],
+                "unstable_tracks": len(tube["unstable_tracks"][annotator]),
+            })
+
+    return {
+        "clip": clip,
+        "task_ids": task_ids,
+        "mean_iou": float(np.mean([p["mean_iou"] for p in pairs])),
+        "macro_avg_kappa": float(np.mean([p["macro_avg_kappa"] for p in pairs])),
+        "mean_flip_rate": float(np.mean([np.mean(list(f["rates"].values())) if f["rates"] else 0.0
+                                         for f in flip_rates.values()])),
+        "pairs": pairs,
+        "flip_rates": flip_rates,
+    }
+
+
+# --------------------- BatchQCEngine ---------------------
+class BatchQCEngine:
+    """
+    Runs QC for every overlap group of a project in one job: overlap groups are found with one
+    query, annotations are fetched in bulk per chunk of groups, groups are scored in a process
+    pool and the results are written to `quality_metrics`. Pass `executor` to score on an existing
+    pool (e.g. `shared_executor()`); otherwise each run starts and stops its own.
+    """
+
+    def __init__(self, db_params: Dict[str, Any], workers: int = BATCH_QC_WORKERS,
+                 kappa_weights: Optional[str] = None, executor: Optional[ProcessPoolExecutor] = None):
+        self.db_params = db_params
+        self.workers = workers
+        self.kappa_weights = kappa_weights
+        self.executor = executor
+        self.conn = None
+
+    def connect_db(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.db_params)
+        return self.conn
+
+    def close_db(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def find_overlap_groups(self, project_id: int, pending_only: bool = True) -> Dict[str, List[int]]:
+        """Tasks of the same clip (task name minus its annotator prefix) annotated more than once."""
+        status_filter = "AND status = 'completed' AND qc_status = 'pending'" if pending_only else ""
+        with self.connect_db().cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT regexp_replace(name, '^[^_]*_', '') AS clip, array_agg(task_id ORDER BY task_id)
+                FROM tasks
+                WHERE project_id = %s AND position('_' IN name) > 0 {status_filter}
+                GROUP BY clip
+                HAVING COUNT(*) > 1
+                ORDER BY clip;
+                """,
+                (project_id,)
+            )
+            return {clip: list(task_ids) for clip, task_ids in cur.fetchall()}
+
+    def run(self, project_id: int, pending_only: bool = True, write_results: bool = True) -> Dict[str, Any]:
+        groups = self.find_overlap_groups(project_id, pending_only)
+        logger.info(f"Batch QC: {len(groups)} overlap group(s) in project {project_id}.")
+        results, skipped = [], []
+        try:
+            clips = list(groups)
+            pool_context = (nullcontext(self.executor) if self.executor is not None
+                            else ProcessPoolExecutor(max_workers=max(self.workers, 1)))
+            with pool_context as pool:
+                for start in range(0, len(clips), GROUPS_PER_FETCH):
+                    chunk = clips[start:start + GROUPS_PER_FETCH]
+                    bundles = load_qc_bundles(self.connect_db(), [t for clip in chunk for t in groups[clip]])
+                    futures = []
+                    for clip in chunk:
+                        group = [bundles[t] for t in groups[clip] if t in bundles]
+                        # Tasks without annotations leave nothing to compare against
+                        if len(group) < 2:
+                            skipped.append(clip)
+                            continue
+                        futures.append(pool.submit(score_group, clip, group, self.kappa_weights))
+                    results.extend(f.result() for f in futures)
+            if skipped:
+                logger.info(f"Batch QC: skipped {len(skipped)} group(s) with fewer than two annotated tasks.")
+            scored = [r for r in results if "error" not in r]
+            for r in results:
+                if "error" in r:
+                    logger.warning(f"✗ Batch QC failed for clip {r['clip']}: {r['error']}")
+            if write_results and scored:
+                self._write_results(project_id, scored)
+        finally:
+            self.close_db()
+
+        logger.info(f"✓ Batch QC scored {len(scored)} of {len(results)} group(s) for project {project_id}.")
+        return {
+            "project_id": project_id,
+            "groups": len(groups),
+            "scored": len(scored),
+            "skipped": skipped,
+            "results": results,
+        }
+
+    def _write_results(self, project_id: int, results: List[Dict[str, Any]]):
+        rows = []
+        for r in results:
+            task_group = min(r["task_ids"])
+            base = {"clip": r["clip"], "task_ids": r["task_ids"]}
+            if "multi_rater" in r:
+                multi = r["multi_rater"]
+                rows.append((project_id, task_group, "iou", r["mean_iou"], psycopg2.extras.Json({
+                    **base, "pairwise_iou": multi["pairwise_iou"], "units": multi["units"],
+                    "units_all_raters": multi["units_all_raters"]
+                })))
+                rows.append((project_id, task_group, "fleiss_kappa", r["macro_avg_kappa"], psycopg2.extras.Json({
+                    **base, "per_attribute": multi["fleiss_kappa"]
+                })))
+                rows.append((project_id, task_group, "krippendorff_alpha", multi["macro_krippendorff_alpha"],
+                             psycopg2.extras.Json({**base, "per_attribute": multi["krippendorff_alpha"]})))
+            else:
+                rows.append((project_id, task_group, "iou", r["mean_iou"], psycopg2.extras.Json({
+                    **base, "pairs": [{k: p[k] for k in ("task_ids", "mean_iou", "percent_iou_gte_05",
+                                                          "matched_pairs", "unmatched")} for p in r["pairs"]]
+                })))
+                rows.append((project_id, task_group, "kappa", r["macro_avg_kappa"], psycopg2.extras.Json({
+                    **base, "pairs": [{k: p[k] for k in ("task_ids", "kappa_scores", "macro_avg_kappa")}
+                                      for p in r["pairs"]]
+                })))
+            rows.append((project_id, task_group, "flip_rate", r["mean_flip_rate"], psycopg2.extras.Json({
+                **base, "per_task": {str(t): f for t, f in r["flip_rates"].items()}
+            })))
+        with self.connect_db().cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO quality_metrics (project_id, task_group, metric_type, metric_value, details) VALUES %s;",
+                rows
+            )
+        self.conn.commit()
+        logger.info(f"✓ Wrote {len(rows)} quality_metrics rows.")
+
+        # Annotator scoreboard: scored pairs only, and only with plain kappa
+        if self.kappa_weights is None:
+            reliability = AnnotatorReliability(self.conn)
+            recorded = 0
+            for r in results:
+                for p in r.get("pairs", []):
+                    (t1, t2), (a1, a2) = p["task_ids"], p["assignees"]
+                    recorded += reliability.record_pair(t1, t2, *p["versions"], pair_contribution(
+                        a1, a2, p["matched_pairs"], p["mean_iou"], p["kappa_scores"],
+                        r["flip_rates"][t1]["rates"], r["flip_rates"][t2]["rates"]
+                    ))
+            logger.info(f"✓ Recorded {recorded} pair(s) in the annotator scoreboard.")
+
+
+# --------------------- CLI ---------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run QC for every overlap group of a project.")
+    parser.add_argument("--project-id", type=int, required=True, help="Project to score.")
+    parser.add_argument("--workers", type=int, default=BATCH_QC_WORKERS, help="Worker processes.")
+    parser.add_argument("--all-tasks", action="store_true", help="Include tasks already through QC.")
+    parser.add_argument("--kappa-weights", choices=["linear", "quadratic"], help="Weighted Cohen's kappa.")
+    parser.add_argument("--dry-run", action="store_true", help="Print results without writing quality_metrics.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    from processing_pipeline.services.post_annotation_service import DB_PARAMS
+    from processing_pipeline.services.migrations import check_schema
+
+    args = parse_args()
+    check_schema(DB_PARAMS)
+    engine = BatchQCEngine(DB_PARAMS, workers=args.workers, kappa_weights=args.kappa_weights)
+    summary = engine.run(args.project_id, pending_only=not args.all_tasks, write_results=not args.dry_run)
+    for r in summary["results"]:
+        if "error" in r:
+            print(f"{r['clip']}: error: {r['error']}")
+        else:
+            print(f"{r['clip']} {r['task_ids']}: IoU={r['mean_iou']:.3f} κ={r['macro_avg_kappa']:.3f} "
+                  f"flip={r['mean_flip_rate']:.2%}")
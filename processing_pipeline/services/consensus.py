@@ -0,0 +1,168 @@
+# services/consensus.py
+
+# Consensus for clips annotated by more than one annotator: boxes of the same person are
+# grouped across tasks, coordinates are fused by weighted averaging and every attribute is
+# decided by a (optionally reliability-weighted) vote, so each clip exports one row set.
+import logging
+import os
+import sys
+from typing import Dict, Any, List, Optional
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.agreement_metrics import match_boxes_pruned
+from processing_pipeline.services.reliability import AnnotatorReliability
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --------------------- Settings ---------------------
+# Untracked boxes of different annotators are the same person only above this IoU
+CONSENSUS_MIN_IOU = float(os.getenv("CONSENSUS_MIN_IOU", "0.3"))
+# Floor for reliability weights, so a poorly scored annotator still breaks ties among equals
+CONSENSUS_MIN_WEIGHT = 0.05
+VOTE_MODES = ("majority", "reliability")
+
+BOX_COLUMNS = ["xtl", "ytl", "xbr", "ybr"]
+
+
+def reliability_weights(conn, annotators: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    {annotator: {"box": w, "attributes": {attribute: w}}} from the annotator scoreboard: mean IoU
+    against peers for coordinates and mean kappa per attribute for labels, floored at CONSENSUS_MIN_WEIGHT.
+    Annotators without a score are left out and get weight 1.
+    """
+    board = AnnotatorReliability(conn)
+    weights = {}
+    for annotator in annotators:
+        stats = board.get(annotator)
+        if stats is None:
+            continue
+        weights[annotator] = {
+            "box": max(stats["mean_iou"], CONSENSUS_MIN_WEIGHT),
+            "attributes": {a: max(k, CONSENSUS_MIN_WEIGHT) for a, k in stats["kappa"].items()},
+        }
+    return weights
+
+
+def _match_untracked(frame_rows: pd.DataFrame, min_iou: float) -> np.ndarray:
+    """Local cluster labels for one frame's untracked boxes: each task is matched against the clusters so far."""
+    labels = np.empty(len(frame_rows), dtype=np.int64)
+    all_boxes = frame_rows[BOX_COLUMNS].to_numpy(dtype=np.float64)
+    cluster_boxes = np.empty((0, 4))
+    for _, task_positions in sorted(frame_rows.groupby("task_id").indices.items()):
+        boxes = all_boxes[task_positions]
+        rows, cols, _ = match_boxes_pruned(cluster_boxes, boxes, min_iou=min_iou)
+        labels[task_positions[cols]] = rows
+        unmatched = np.setdiff1d(np.arange(len(boxes)), cols)
+        labels[task_positions[unmatched]] = len(cluster_boxes) + np.arange(unmatched.size)
+        cluster_boxes = np.vstack([cluster_boxes, boxes[unmatched]])
+    return labels
+
+
+def _frame_key(df: pd.DataFrame) -> pd.Series:
+    """Frame number as text, or the keyframe file name for rows without one."""
+    return df["frame"].astype("Int64").astype(str).where(df["frame"].notna(), df["keyframe_name"].map(os.path.basename))
+
+
+def _renumber_people(df: pd.DataFrame) -> pd.Series:
+    """
+    person_id per row, unique within each (clip, frame): the first box holding an id keeps it
+    (tracked boxes by track_id, then left to right) and repeats get the next ids above the frame's largest.
+    """
+    ordered = df.assign(frame_key=_frame_key(df)).sort_values(["track_id", "xtl"], na_position="last", kind="stable")
+    group_keys = [ordered["clip"], ordered["frame_key"]]
+    repeated = ordered.duplicated(["clip", "frame_key", "person_id"])
+    largest = ordered["person_id"].groupby(group_keys).transform("max").fillna(0)
+    person_ids = ordered["person_id"].where(~repeated, largest + repeated.astype(int).groupby(group_keys).cumsum())
+    return person_ids.reindex(df.index)
+
+
+def assign_clusters(df: pd.DataFrame, min_iou: float = CONSENSUS_MIN_IOU) -> np.ndarray:
+    """
+    Cluster id per row: tracked boxes share a cluster when clip, frame and track_id agree (tracks
+    come from the shared pre-annotation, as in QC); untracked boxes are matched by IoU per frame.
+    """
+    clusters = np.empty(len(df), dtype=np.int64)
+    tracked = df["track_id"].notna().to_numpy()
+    frame_key = _frame_key(df)
+    clusters[tracked] = pd.DataFrame({
+        "clip": df["clip"][tracked], "frame": frame_key[tracked], "track_id": df["track_id"][tracked]
+    }).groupby(["clip", "frame", "track_id"], sort=False).ngroup().to_numpy()
+
+    offset = clusters[tracked].max() + 1 if tracked.any() else 0
+    untracked = df[~tracked].assign(frame_key=frame_key[~tracked])
+    untracked_positions = np.flatnonzero(~tracked)
+    for _, index in untracked.groupby(["clip", "frame_key"], sort=False).indices.items():
+        local = _match_untracked(untracked.iloc[index], min_iou)
+        clusters[untracked_positions[index]] = offset + local
+        offset += local.max() + 1
+    return clusters
+
+
+def build_consensus(df: pd.DataFrame, attribute_definitions: Dict[str, Dict[str, Any]],
+                    weights: Optional[Dict[str, Dict[str, Any]]] = None,
+                    min_iou: float = CONSENSUS_MIN_IOU) -> pd.DataFrame:
+    """
+    One row per person and frame from the rows of every task of every clip. `df` needs clip,
+    task_id, assignee, keyframe_name, person_id, track_id, frame, the box columns and decoded
+    `attributes` dicts. A cluster is kept when at least half of its clip's tasks boxed it; its box
+    is the weighted mean of the members' boxes and each attribute takes the option with the
+    largest summed weight (ties to the earlier option); person_id is made unique per (clip, frame).
+    `weights` as from `reliability_weights`; without it every annotator counts once. Clips with
+    one task pass through unchanged.
+    """
+    if df.empty:
+        return df.assign(support=pd.Series(dtype=np.int64))
+    df = df.reset_index(drop=True)
+    weights = weights or {}
+    clusters = assign_clusters(df, min_iou)
+    cluster_ids, cluster_index = np.unique(clusters, return_inverse=True)
+    n_clusters = cluster_ids.size
+
+    # Support: distinct tasks per cluster against the clip's task count
+    support = pd.Series(df["task_id"].to_numpy()).groupby(cluster_index).nunique().to_numpy()
+    clip_tasks = df.groupby("clip")["task_id"].transform("nunique").to_numpy()
+    clip_tasks = np.bincount(cluster_index, weights=clip_tasks, minlength=n_clusters) / np.bincount(cluster_index)
+    keep = 2 * support >= clip_tasks
+
+    # Boxes: weighted average per cluster, one bincount per coordinate
+    box_weight = df["assignee"].map(lambda a: weights.get(a, {}).get("box", 1.0)).to_numpy(dtype=np.float64)
+    weight_sum = np.bincount(cluster_index, weights=box_weight, minlength=n_clusters)
+    boxes = df[BOX_COLUMNS].to_numpy(dtype=np.float64)
+    fused = np.column_stack([
+        np.bincount(cluster_index, weights=boxes[:, j] * box_weight, minlength=n_clusters) / weight_sum
+        for j in range(4)
+    ])
+
+    # Attributes: encoded once, then one weighted bincount over (cluster, attribute, option)
+    names = list(attribute_definitions)
+    k = max((len(info["options"]) for info in attribute_definitions.values()), default=1)
+    codes = np.full((len(df), len(names)), -1, dtype=np.int64)
+    vote_weight = np.ones((len(df), len(names)))
+    for j, name in enumerate(names):
+        index = {option: i for i, option in enumerate(attribute_definitions[name]["options"])}
+        codes[:, j] = [index.get(attrs.get(name), -1) for attrs in df["attributes"]]
+        vote_weight[:, j] = [weights.get(a, {}).get("attributes", {}).get(name, 1.0) for a in df["assignee"]]
+    valid = codes >= 0
+    cell = (cluster_index[:, None] * len(names) + np.arange(len(names))) * k + codes
+    votes = np.bincount(cell[valid], weights=vote_weight[valid], minlength=n_clusters * len(names) * k)
+    votes = votes.reshape(n_clusters, len(names), k)
+    winners = np.where(votes.max(axis=-1) > 0, votes.argmax(axis=-1), -1)
+
+    # Identity columns from each cluster's first row (lowest task id first)
+    first = np.lexsort((df["task_id"].to_numpy(), cluster_index))
+    first = first[np.r_[True, np.diff(cluster_index[first]) != 0]]
+    result = df.loc[first, ["clip", "keyframe_name", "person_id", "track_id", "frame"]].reset_index(drop=True)
+    result[BOX_COLUMNS] = fused
+    result["attributes"] = [
+        {name: attribute_definitions[name]["options"][code] for name, code in zip(names, row) if code >= 0}
+        for row in winners
+    ]
+    result["support"] = support
+    result = result[keep].reset_index(drop=True)
+    # Clusters fused in one frame can carry the same person_id from their first rows
+    result["person_id"] = _renumber_people(result)
+    logger.info(f"✓ Consensus: {len(df)} boxes → {len(result)} ({n_clusters - len(result)} cluster(s) below support).")
+    return result
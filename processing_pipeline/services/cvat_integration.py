@@ -127,6 +127,37 @@ class CVATClient:
         logger.info(f"✓ Assigned task {task_id} to '{username}'")
         return True
 
+    # -------------------------
+    # Annotation Retrieval
+    # -------------------------
+    def _get_all_pages(self, url: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        params = dict(params or {}, page_size=100)
+        results = []
+        while url:
+            resp = self._make_authenticated_request("GET", url, params=params)
+            resp.raise_for_status()
+            data = resp.json()
+            results.extend(data.get("results", []))
+            # 'next' already carries the query string
+            url, params = data.get("next"), None
+        return results
+
+    def list_task_jobs(self, task_id: int) -> List[Dict[str, Any]]:
+        return self._get_all_pages(f"{self.host}/api/jobs", params={"task_id": task_id})
+
+    def list_task_labels(self, task_id: int) -> List[Dict[str, Any]]:
+        return self._get_all_pages(f"{self.host}/api/labels", params={"task_id": task_id})
+
+    def get_task_frame_names(self, task_id: int) -> List[str]:
+        resp = self._make_authenticated_request("GET", f"{self.host}/api/tasks/{task_id}/data/meta")
+        resp.raise_for_status()
+        return [frame.get("name") for frame in resp.json().get("frames", [])]
+
+    def get_job_annotations(self, job_id: int) -> Dict[str, Any]:
+        resp = self._make_authenticated_request("GET", f"{self.host}/api/jobs/{job_id}/annotations")
+        resp.raise_for_status()
+        return resp.json()
+
     # -------------------------
     # S3 Methods
     # -------------------------
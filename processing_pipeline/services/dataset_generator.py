@@ -5,9 +5,13 @@ import logging
 import json
 import boto3
 import os
+import sys
 from urllib.parse import urlparse
-from typing import Dict, Any
-from tqdm import tqdm
+from typing import Dict, Any, Tuple
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.qc_data_loader import decode_attributes
+from processing_pipeline.services.consensus import VOTE_MODES, build_consensus, reliability_weights
 
 # =============================
 # Logging Configuration
@@ -50,6 +54,66 @@ def calculate_action_mapping() -> Dict[str, int]:
         cumulative_count += len(ATTRIBUTE_DEFINITIONS[attr_name]["options"])
     return mapping
 
+def calculate_action_values(action_id_map: Dict[str, int]) -> Dict[str, Dict[str, int]]:
+    """Map each attribute's options to their final action IDs (base offset + option index + 1)."""
+    return {
+        attr_name: {option: base_id + i + 1 for i, option in enumerate(ATTRIBUTE_DEFINITIONS[attr_name]["options"])}
+        for attr_name, base_id in action_id_map.items()
+    }
+
+def manifest_frame(manifest_data: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Manifest as a DataFrame indexed by keyframe name, with video_id and frame_timestamp columns.
+    Timestamps stay Python objects until the output rows are known (see build_ava_rows).
+    """
+    entries = {k: v for k, v in manifest_data.items() if v}
+    return pd.DataFrame({
+        "video_id": [v.get("source_video", "").replace(".mp4", "") for v in entries.values()],
+        "frame_timestamp": pd.Series([v.get("source_frame", 0) for v in entries.values()], dtype=object),
+    }).set_axis(pd.Index(list(entries), dtype=object))
+
+AVA_COLUMNS = ["video_id", "frame_timestamp", "x1", "y1", "x2", "y2", "action_id", "person_id"]
+
+def build_ava_rows(df: pd.DataFrame, manifest: pd.DataFrame, action_values: Dict[str, Dict[str, int]],
+                   image_width=1280, image_height=720) -> Tuple[pd.DataFrame, int, int]:
+    """
+    AVA rows for boxes with keyframe_name, person_id, box columns and decoded `attributes` dicts,
+    as column operations: one manifest merge, whole-column normalisation, and one row per
+    (box, action) from the option → action_id tables. Returns (rows, matched, missing).
+    """
+    # Manifest join: raw keyframe name first, then its basename
+    raw_match = df["keyframe_name"].isin(manifest.index)
+    df = df.assign(manifest_key=df["keyframe_name"].where(raw_match, df["keyframe_name"].map(os.path.basename)))
+    df = df.merge(manifest, left_on="manifest_key", right_index=True, how="left")
+    found = df["video_id"].notna()
+    matched, missing = int(found.sum()), int((~found).sum())
+    if missing:
+        logger.debug(f"❌ No match for keyframes: {df.loc[~found, 'keyframe_name'].unique().tolist()}")
+    df = df[found].reset_index(drop=True)
+
+    # Coordinates normalised as whole columns, written with six decimals; timestamps are left as-is
+    df["x1"], df["x2"] = df["xtl"] / image_width, df["xbr"] / image_width
+    df["y1"], df["y2"] = df["ytl"] / image_height, df["ybr"] / image_height
+    for column in ("x1", "y1", "x2", "y2"):
+        df[column] = df[column].map("{:.6f}".format)
+
+    # Attributes exploded to one row per (box, action): one column per attribute mapped
+    # through its option → action_id table; unknown attributes and options drop out
+    attribute_table = pd.DataFrame.from_records(df["attributes"].tolist(), index=df.index)
+    action_ids = pd.DataFrame({
+        name: attribute_table[name].map(values)
+        for name, values in action_values.items() if name in attribute_table
+    }, index=df.index)
+    if action_ids.columns.empty:
+        return pd.DataFrame(columns=AVA_COLUMNS), matched, missing
+    action_ids = action_ids.stack().dropna().astype(int).rename("action_id").reset_index(level=1, drop=True)
+
+    ava_df = df.join(action_ids, how="inner")[AVA_COLUMNS].astype({"person_id": "Int64"})
+    # Timestamp dtype inferred from the emitted rows only, as a row-built frame would (ints + floats → float)
+    ava_df["frame_timestamp"] = ava_df["frame_timestamp"].infer_objects()
+    ava_df = ava_df.sort_values(by=["video_id", "frame_timestamp", "person_id", "action_id"], kind="stable")
+    return ava_df.reset_index(drop=True), matched, missing
+
 # =============================
 # Dataset Generator Class
 # =============================
@@ -135,8 +199,15 @@ class DatasetGenerator:
     # =============================
     # Main CSV Generation
     # =============================
-    def generate_ava_csv(self, output_path: str, image_width=1280, image_height=720):
-        """Generate AVA-Kinetics CSV from annotations + manifest."""
+    def generate_ava_csv(self, output_path: str, image_width=1280, image_height=720,
+                         consensus: bool = True, vote: str = "majority"):
+        """
+        Generate AVA-Kinetics CSV from annotations + manifest. With `consensus`, clips annotated
+        more than once are fused into one row set; `vote` is "majority" or "reliability"
+        (weights from the annotator scoreboard).
+        """
+        if vote not in VOTE_MODES:
+            raise ValueError(f"Unknown vote '{vote}'; expected one of {VOTE_MODES}.")
         self.connect_db()
         if not self.conn:
             logger.error("❌ Database connection failed. Aborting CSV generation.")
@@ -144,77 +215,40 @@ class DatasetGenerator:
 
         try:
             query = """
-                SELECT a.keyframe_name, a.person_id, a.xtl, a.ytl, a.xbr, a.ybr, a.attributes
+                SELECT regexp_replace(t.name, '^[^_]*_', '') AS clip, a.task_id, t.assignee,
+                       a.keyframe_name, a.person_id, a.track_id, a.frame,
+                       a.xtl, a.ytl, a.xbr, a.ybr, a.attributes, a.attribute_codes
                 FROM annotations a
                 JOIN tasks t ON a.task_id = t.task_id
                 WHERE t.qc_status = 'approved'
-                AND t.project_id = %s;
+                AND t.project_id = %s
+                AND a.project_id = %s;
             """
-            df = pd.read_sql(query, self.conn, params=(self.project_id,))
+            # Filtering annotations by project as well lets a partitioned table prune to one partition
+            df = pd.read_sql(query, self.conn, params=(self.project_id, self.project_id))
             logger.info(f"📊 Retrieved {len(df)} approved annotations for Project ID {self.project_id}")
 
             if df.empty:
                 logger.warning(f"⚠️ No approved annotations found for project {self.project_id}.")
                 return
 
-            matched, missing = 0, 0
-            ava_rows = []
-
-            for _, row in tqdm(df.iterrows(), total=df.shape[0], desc="Formatting AVA CSV"):
-                keyframe_name_raw = row["keyframe_name"]
-                keyframe_name = os.path.basename(keyframe_name_raw)
-
-                # ✅ Match raw or basename against manifest
-                origin_data = self.manifest_data.get(keyframe_name_raw) or self.manifest_data.get(keyframe_name)
-                if not origin_data:
-                    missing += 1
-                    logger.debug(f"❌ No match for keyframe: {keyframe_name_raw} / {keyframe_name}")
-                    continue
-                matched += 1
-
-                video_id = origin_data.get("source_video", "").replace(".mp4", "")
-                frame_timestamp = origin_data.get("source_frame", 0)
-
-                x1_norm = row["xtl"] / image_width
-                y1_norm = row["ytl"] / image_height
-                x2_norm = row["xbr"] / image_width
-                y2_norm = row["ybr"] / image_height
-
-                attributes = row["attributes"]
-                if isinstance(attributes, str):
-                    try:
-                        attributes = json.loads(attributes)
-                    except json.JSONDecodeError:
-                        continue
-
-                person_id = row["person_id"]
-
-                for attr_name, attr_value in attributes.items():
-                    base_id = self.action_id_map.get(attr_name)
-                    if base_id is None:
-                        continue
-                    try:
-                        options_list = ATTRIBUTE_DEFINITIONS[attr_name]["options"]
-                        option_index = options_list.index(attr_value)
-                        final_action_id = base_id + option_index + 1
-                        ava_rows.append([
-                            video_id, frame_timestamp,
-                            f"{x1_norm:.6f}", f"{y1_norm:.6f}",
-                            f"{x2_norm:.6f}", f"{y2_norm:.6f}",
-                            final_action_id, person_id
-                        ])
-                    except ValueError:
-                        continue
+            # Rows ingested in codes-only mode carry attribute_codes instead of JSON
+            df["attributes"] = [decode_attributes(a, c) for a, c in zip(df["attributes"], df["attribute_codes"])]
+            if consensus:
+                weights = reliability_weights(self.conn, df["assignee"].dropna().unique().tolist()) \
+                    if vote == "reliability" else None
+                df = build_consensus(df, ATTRIBUTE_DEFINITIONS, weights)
 
+            ava_df, matched, missing = build_ava_rows(
+                df, manifest_frame(self.manifest_data), calculate_action_values(self.action_id_map),
+                image_width, image_height
+            )
             logger.info(f"✅ Matched frames: {matched}, Missing frames: {missing}")
-            header = ["video_id", "frame_timestamp", "x1", "y1", "x2", "y2", "action_id", "person_id"]
-            ava_df = pd.DataFrame(ava_rows, columns=header)
 
             if ava_df.empty:
                 logger.warning("⚠️ Final dataset is empty. Check keyframe name matching between DB and manifest.")
                 return
 
-            ava_df.sort_values(by=["video_id", "frame_timestamp", "person_id"], inplace=True)
             ava_df.to_csv(output_path, index=False)
             logger.info(f"💾 Dataset saved successfully at: {output_path}")
 
@@ -0,0 +1,379 @@
+# services/migrations.py
+import argparse
+import logging
+import os
+import re
+import sys
+from typing import Dict, Any, List
+import psycopg2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Apply pending migrations at service startup; set to "false" to only check and refuse to start.
+AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() == "true"
+
+# Arbitrary constant shared by every process that migrates this database.
+MIGRATION_LOCK_ID = 727_031
+
+# Ordered list of schema changes. Versions are never renumbered or edited once shipped;
+# add a new entry instead. Statements use IF NOT EXISTS so they also apply cleanly to
+# databases created before this module existed. Entries with "transactional": False run
+# in autocommit mode (needed for CREATE INDEX CONCURRENTLY).
+MIGRATIONS: List[Dict[str, Any]] = [
+    {
+        "version": 1,
+        "name": "base_schema",
+        "transactional": True,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS projects (
+                project_id INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                organization_slug VARCHAR(255),
+                total_tasks INTEGER,
+                completed_tasks INTEGER DEFAULT 0
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id INTEGER PRIMARY KEY,
+                project_id INTEGER REFERENCES projects(project_id),
+                name VARCHAR(255) NOT NULL,
+                status VARCHAR(50) DEFAULT 'annotation',
+                assignee VARCHAR(255),
+                video_clip VARCHAR(255),
+                retrieved_at TIMESTAMP WITH TIME ZONE,
+                qc_status VARCHAR(50) DEFAULT 'pending',
+                overlap_group INTEGER
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS annotations (
+                annotation_id SERIAL PRIMARY KEY,
+                task_id INTEGER REFERENCES tasks(task_id),
+                keyframe_name VARCHAR(255),
+                person_id INTEGER,
+                track_id INTEGER,
+                frame INTEGER,
+                xtl REAL NOT NULL,
+                ytl REAL NOT NULL,
+                xbr REAL NOT NULL,
+                ybr REAL NOT NULL,
+                outside BOOLEAN DEFAULT FALSE,
+                attributes JSONB,
+                annotator VARCHAR(255),
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            # Older databases predate the track/frame columns written by the ingest parser
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS keyframe_name VARCHAR(255);",
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS person_id INTEGER;",
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS track_id INTEGER;",
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS frame INTEGER;",
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS outside BOOLEAN DEFAULT FALSE;",
+            """
+            CREATE TABLE IF NOT EXISTS quality_metrics (
+                metric_id SERIAL PRIMARY KEY,
+                project_id INTEGER REFERENCES projects(project_id),
+                task_group INTEGER,
+                metric_type VARCHAR(50),
+                metric_value REAL,
+                calculated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                details JSONB
+            );
+            """,
+        ],
+    },
+    {
+        "version": 2,
+        "name": "sync_jobs_queue",
+        "transactional": True,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS sync_jobs (
+                job_id BIGSERIAL PRIMARY KEY,
+                task_id INTEGER NOT NULL,
+                assignee VARCHAR(255),
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 5,
+                run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                locked_by VARCHAR(255),
+                locked_at TIMESTAMP WITH TIME ZONE,
+                last_error TEXT,
+                result JSONB,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP WITH TIME ZONE
+            );
+            """,
+            "ALTER TABLE sync_jobs ADD COLUMN IF NOT EXISTS result JSONB;",
+            "CREATE UNIQUE INDEX IF NOT EXISTS sync_jobs_one_pending_per_task ON sync_jobs (task_id) WHERE status = 'pending';",
+            "CREATE INDEX IF NOT EXISTS sync_jobs_claim_idx ON sync_jobs (run_after, job_id) WHERE status = 'pending';",
+        ],
+    },
+    {
+        "version": 3,
+        "name": "annotation_row_hash",
+        "transactional": True,
+        "statements": [
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS row_hash CHAR(32);",
+        ],
+    },
+    {
+        "version": 4,
+        "name": "hot_path_indexes",
+        "transactional": False,
+        "statements": [
+            # QualityService / QC loaders: task_id = ANY(...), and the diff sync's (task, track, frame) match
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS annotations_task_track_frame_idx ON annotations (task_id, track_id, frame);",
+            # Diff sync match for untracked boxes (<image> layout), keyed by per-frame person_id
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS annotations_task_person_frame_idx ON annotations (task_id, person_id, frame) WHERE track_id IS NULL;",
+            # DatasetGenerator join on tasks(project_id, qc_status) and admin task listings
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS tasks_project_qc_status_idx ON tasks (project_id, qc_status);",
+            # db_utils.get_pending_tasks / approve-all: the pending slice stays small as projects grow
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS tasks_pending_by_project_idx ON tasks (project_id) WHERE qc_status = 'pending';",
+        ],
+    },
+    {
+        "version": 5,
+        "name": "annotation_project_id",
+        "transactional": True,
+        "statements": [
+            # Denormalised so annotations can be partitioned and pruned by project (services/partitioning.py)
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS project_id INTEGER;",
+            "UPDATE annotations a SET project_id = t.project_id FROM tasks t WHERE a.task_id = t.task_id AND a.project_id IS NULL;",
+        ],
+    },
+    {
+        "version": 6,
+        "name": "qc_results_cache",
+        "transactional": True,
+        "statements": [
+            # Digest of a task's row hashes, rewritten by every sync; QC cache entries are keyed on it
+            "ALTER TABLE tasks ADD COLUMN IF NOT EXISTS annotation_version CHAR(32);",
+            """
+            UPDATE tasks t SET annotation_version = v.version
+            FROM (
+                SELECT task_id, md5(string_agg(COALESCE(row_hash, annotation_id::TEXT), '' ORDER BY COALESCE(row_hash, annotation_id::TEXT))) AS version
+                FROM annotations GROUP BY task_id
+            ) v
+            WHERE t.task_id = v.task_id AND t.annotation_version IS NULL;
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS qc_results (
+                task_id_1 INTEGER NOT NULL,
+                task_id_2 INTEGER NOT NULL,
+                options VARCHAR(50) NOT NULL DEFAULT '',
+                version_1 CHAR(32) NOT NULL,
+                version_2 CHAR(32) NOT NULL,
+                results JSONB NOT NULL,
+                computed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (task_id_1, task_id_2, options)
+            );
+            """,
+        ],
+    },
+    {
+        "version": 7,
+        "name": "annotation_attribute_codes",
+        "transactional": True,
+        "statements": [
+            # Option codes in shared_config.ATTRIBUTE_NAMES order (see ANNOTATION_ATTRIBUTE_STORAGE)
+            "ALTER TABLE annotations ADD COLUMN IF NOT EXISTS attribute_codes SMALLINT[];",
+        ],
+    },
+    {
+        "version": 8,
+        "name": "annotator_reliability",
+        "transactional": True,
+        "statements": [
+            # Running sums per annotator, updated additively by services/reliability.py
+            """
+            CREATE TABLE IF NOT EXISTS annotator_reliability (
+                annotator VARCHAR(255) PRIMARY KEY,
+                overlaps_compared INTEGER NOT NULL DEFAULT 0,
+                boxes_compared BIGINT NOT NULL DEFAULT 0,
+                iou_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS annotator_attribute_reliability (
+                annotator VARCHAR(255) NOT NULL,
+                attribute VARCHAR(255) NOT NULL,
+                overlaps_compared INTEGER NOT NULL DEFAULT 0,
+                kappa_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                flip_rate_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (annotator, attribute)
+            );
+            """,
+            # Last contribution of every scored pair, so a re-score applies only the difference
+            """
+            CREATE TABLE IF NOT EXISTS annotator_reliability_pairs (
+                task_id_1 INTEGER NOT NULL,
+                task_id_2 INTEGER NOT NULL,
+                version_1 CHAR(32),
+                version_2 CHAR(32),
+                contribution JSONB NOT NULL,
+                scored_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (task_id_1, task_id_2)
+            );
+            """,
+        ],
+    },
+]
+
+LATEST_VERSION = MIGRATIONS[-1]["version"]
+
+
+def _ensure_version_table(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+
+
+def applied_versions(conn) -> List[int]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+        if not cur.fetchone()[0]:
+            return []
+        cur.execute("SELECT version FROM schema_migrations ORDER BY version;")
+        return [row[0] for row in cur.fetchall()]
+
+
+def pending_migrations(conn) -> List[Dict[str, Any]]:
+    done = set(applied_versions(conn))
+    return [m for m in MIGRATIONS if m["version"] not in done]
+
+
+_CONCURRENT_INDEX = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+
+def _invalid_index(cur, name: str) -> bool:
+    cur.execute(
+        """
+        SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid);
+        """,
+        (name,)
+    )
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def _create_index_concurrently(cur, statement: str, name: str):
+    """
+    A failed or cancelled CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which
+    IF NOT EXISTS would then skip. Drop such a leftover first and check the build before the
+    migration is recorded.
+    """
+    if _invalid_index(cur, name):
+        logger.warning(f"Dropping invalid index {name} left by an interrupted build.")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    cur.execute(statement)
+    if _invalid_index(cur, name):
+        raise RuntimeError(f"Index {name} is still invalid after CREATE INDEX CONCURRENTLY.")
+
+
+def apply_migrations(conn) -> List[int]:
+    """
+    Applies every pending migration in version order. Safe to call concurrently from
+    several processes. Must be called outside an open transaction on `conn`.
+    """
+    if not conn.autocommit:
+        conn.rollback()
+    previous_autocommit = conn.autocommit
+    conn.autocommit = True
+    applied = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+        try:
+            _ensure_version_table(conn)
+            for migration in pending_migrations(conn):
+                logger.info(f"Applying schema migration {migration['version']} ({migration['name']})...")
+                if migration["transactional"]:
+                    conn.autocommit = False
+                with conn.cursor() as cur:
+                    for statement in migration["statements"]:
+                        index = None if migration["transactional"] else _CONCURRENT_INDEX.search(statement)
+                        if index:
+                            _create_index_concurrently(cur, statement, index.group(1))
+                        else:
+                            cur.execute(statement)
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                        (migration["version"], migration["name"])
+                    )
+                if migration["transactional"]:
+                    conn.commit()
+                    conn.autocommit = True
+                applied.append(migration["version"])
+        except Exception:
+            if not conn.autocommit:
+                conn.rollback()
+                conn.autocommit = True
+            raise
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+    finally:
+        conn.autocommit = previous_autocommit
+    if applied:
+        logger.info(f"✓ Schema migrated to version {LATEST_VERSION}.")
+    return applied
+
+
+def check_schema(db_params: Dict[str, Any], auto_migrate: bool = AUTO_MIGRATE):
+    """
+    Startup check for services that read or write the annotation database.
+    Applies pending migrations, or raises RuntimeError if auto-migration is disabled.
+    """
+    conn = psycopg2.connect(**db_params)
+    conn.autocommit = True
+    try:
+        pending = pending_migrations(conn)
+        if not pending:
+            return
+        if not auto_migrate:
+            names = ", ".join(f"{m['version']}:{m['name']}" for m in pending)
+            raise RuntimeError(f"Database schema is behind ({names}); run services/migrations.py.")
+        apply_migrations(conn)
+    finally:
+        conn.close()
+
+
+# --------------------- CLI ---------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="Apply or check annotation database schema migrations.")
+    parser.add_argument("--check", action="store_true", help="List pending migrations without applying them.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    from processing_pipeline.services.post_annotation_service import DB_PARAMS
+
+    args = parse_args()
+    conn = psycopg2.connect(**DB_PARAMS)
+    conn.autocommit = True
+    try:
+        if args.check:
+            pending = pending_migrations(conn)
+            for m in pending:
+                print(f"pending: {m['version']} {m['name']}")
+            sys.exit(1 if pending else 0)
+        applied = apply_migrations(conn)
+        print(f"applied: {applied}" if applied else f"schema already at version {LATEST_VERSION}")
+    finally:
+        conn.close()
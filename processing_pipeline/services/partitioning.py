@@ -0,0 +1,165 @@
+# services/partitioning.py
+import argparse
+import logging
+import os
+import sys
+from typing import Dict, Any
+import psycopg2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Lock key for creating partitions; the second key is the project id.
+PARTITION_LOCK_ID = 727_032
+
+ARCHIVE_SCHEMA = "annotations_archive"
+
+
+def partition_name(project_id: int) -> str:
+    return f"annotations_p{int(project_id)}"
+
+
+def is_partitioned(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('annotations');")
+        row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def ensure_project_partition(conn, project_id: int) -> bool:
+    """
+    Creates the LIST partition for `project_id` if it does not exist yet. Runs inside the
+    caller's transaction, so it must happen before any of the project's rows are written.
+    Returns True if a partition was created.
+    """
+    name = partition_name(project_id)
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+        if cur.fetchone()[0]:
+            return False
+        cur.execute("SELECT pg_advisory_xact_lock(%s, %s);", (PARTITION_LOCK_ID, int(project_id)))
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF annotations FOR VALUES IN ({int(project_id)});")
+    logger.info(f"✓ Created annotations partition {name}.")
+    return True
+
+
+def migrate_to_partitioned(conn, drop_legacy: bool = False):
+    """
+    Rebuilds `annotations` as a table partitioned BY LIST (project_id), one partition per project
+    plus a default partition. Runs in one transaction holding an EXCLUSIVE lock, so syncs wait
+    rather than write into the old table. The old table is kept as `annotations_legacy` unless
+    `drop_legacy` is set.
+    """
+    if is_partitioned(conn):
+        logger.info("annotations is already partitioned; nothing to do.")
+        return
+
+    with conn.cursor() as cur:
+        cur.execute("LOCK TABLE annotations IN EXCLUSIVE MODE;")
+        cur.execute("UPDATE annotations a SET project_id = t.project_id FROM tasks t WHERE a.task_id = t.task_id AND a.project_id IS NULL;")
+        cur.execute("SELECT COUNT(*) FROM annotations WHERE project_id IS NULL;")
+        orphans = cur.fetchone()[0]
+        if orphans:
+            conn.rollback()
+            raise RuntimeError(f"{orphans} annotations have no project (task missing from tasks); fix them before partitioning.")
+
+        cur.execute("SELECT pg_get_serial_sequence('annotations', 'annotation_id');")
+        sequence = cur.fetchone()[0]
+
+        cur.execute("ALTER TABLE annotations RENAME TO annotations_legacy;")
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'annotations_legacy';")
+        for (index_name,) in cur.fetchall():
+            cur.execute(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_legacy";')
+
+        cur.execute(
+            """
+            CREATE TABLE annotations (
+                LIKE annotations_legacy INCLUDING DEFAULTS,
+                PRIMARY KEY (annotation_id, project_id),
+                FOREIGN KEY (task_id) REFERENCES tasks(task_id)
+            ) PARTITION BY LIST (project_id);
+            """
+        )
+        cur.execute("CREATE TABLE annotations_default PARTITION OF annotations DEFAULT;")
+        cur.execute("SELECT DISTINCT project_id FROM annotations_legacy ORDER BY project_id;")
+        project_ids = [row[0] for row in cur.fetchall()]
+        for project_id in project_ids:
+            cur.execute(f"CREATE TABLE {partition_name(project_id)} PARTITION OF annotations FOR VALUES IN ({int(project_id)});")
+            cur.execute("INSERT INTO annotations SELECT * FROM annotations_legacy WHERE project_id = %s;", (project_id,))
+            logger.info(f"  moved {cur.rowcount} rows of project {project_id}")
+
+        # Partitioned indexes cascade to every current and future partition
+        cur.execute("CREATE INDEX annotations_task_track_frame_idx ON annotations (task_id, track_id, frame);")
+        cur.execute("CREATE INDEX annotations_task_person_frame_idx ON annotations (task_id, person_id, frame) WHERE track_id IS NULL;")
+
+        if sequence:
+            cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY annotations.annotation_id;")
+        if drop_legacy:
+            cur.execute("DROP TABLE annotations_legacy;")
+    conn.commit()
+    logger.info(f"✓ Partitioned annotations into {len(project_ids)} project partition(s).")
+
+
+def detach_project(conn, project_id: int, archive: bool = True):
+    """
+    Removes a project's boxes from `annotations` by detaching its partition, which is a
+    catalog change rather than a bulk DELETE. The detached table is moved to the archive
+    schema, or dropped when `archive` is False.
+    """
+    name = partition_name(project_id)
+    with conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE annotations DETACH PARTITION {name};")
+        if archive:
+            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA};")
+            cur.execute(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA};")
+        else:
+            cur.execute(f"DROP TABLE {name};")
+    conn.commit()
+    logger.info(f"✓ Detached {name}" + (f" into schema {ARCHIVE_SCHEMA}." if archive else " and dropped it."))
+
+
+def partition_sizes(conn) -> Dict[str, Any]:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT c.relname, c.reltuples::BIGINT, pg_total_relation_size(c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('annotations')
+            ORDER BY c.relname;
+            """
+        )
+        return {name: {"approx_rows": rows, "bytes": size} for name, rows, size in cur.fetchall()}
+
+
+# --------------------- CLI ---------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="Partition the annotations table by project.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--migrate", action="store_true", help="Convert annotations to a project-partitioned table.")
+    group.add_argument("--detach", type=int, metavar="PROJECT_ID", help="Detach a project's partition.")
+    group.add_argument("--status", action="store_true", help="List partitions and their sizes.")
+    parser.add_argument("--drop-legacy", action="store_true", help="With --migrate: drop the old table afterwards.")
+    parser.add_argument("--drop", action="store_true", help="With --detach: drop instead of archiving.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    from processing_pipeline.services.post_annotation_service import DB_PARAMS
+    from processing_pipeline.services.migrations import check_schema
+
+    args = parse_args()
+    check_schema(DB_PARAMS)
+    conn = psycopg2.connect(**DB_PARAMS)
+    try:
+        if args.migrate:
+            migrate_to_partitioned(conn, drop_legacy=args.drop_legacy)
+        elif args.detach is not None:
+            detach_project(conn, args.detach, archive=not args.drop)
+        else:
+            if not is_partitioned(conn):
+                print("annotations is not partitioned.")
+            for name, info in partition_sizes(conn).items():
+                print(f"{name}: ~{info['approx_rows']} rows, {info['bytes']} bytes")
+    finally:
+        conn.close()
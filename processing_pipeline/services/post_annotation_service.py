@@ -1,19 +1,23 @@
 import argparse
-import logging
 import json
-import xml.etree.ElementTree as ET
-import io
+import logging
+import tempfile
 import zipfile
 import os
 import sys
 from typing import Dict
 import psycopg2
-import psycopg2.extras
 from dotenv import load_dotenv
 
 # Ensure CVAT client can be imported
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from processing_pipeline.services.cvat_integration import CVATClient
+from processing_pipeline.services.annotation_loader import AnnotationLoader
+from processing_pipeline.services.migrations import check_schema
+from processing_pipeline.services.partitioning import is_partitioned, ensure_project_partition
+from processing_pipeline.services.annotation_parser import (
+    attribute_names_by_spec_id, rows_from_job_annotations, track_numbering, iter_xml_rows, batched
+)
 
 # --------------------- Logging ---------------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -36,6 +40,14 @@ CVAT_HOST = os.getenv("CVAT_HOST")
 CVAT_USERNAME = os.getenv("CVAT_USERNAME")  # match .env
 CVAT_PASSWORD = os.getenv("CVAT_PASSWORD")  # match .env
 
+# "api" reads the JSON annotations endpoint and falls back to the dataset export;
+# "export" always goes through the export + zip round trip.
+INGEST_MODE = os.getenv("CVAT_INGEST_MODE", "api")
+EXPORT_SPOOL_BYTES = 64 * 1024 * 1024
+# Interpolation tasks export as <track>/<box frame=...> so track_id and frame survive the export path;
+# annotation-mode tasks keep the per-image layout (the video format would turn each shape into a track)
+EXPORT_FORMATS = {"interpolation": "CVAT for video 1.1", "annotation": "CVAT for images 1.1"}
+
 
 # --------------------- PostAnnotationService ---------------------
 class PostAnnotationService:
@@ -43,6 +55,8 @@ class PostAnnotationService:
         self.db_params = db_params
         self.cvat_client = cvat_client
         self.conn = None
+        # Row counts of the most recent successful sync
+        self.last_sync_counts = None
 
     def connect_db(self):
         try:
@@ -69,10 +83,14 @@ class PostAnnotationService:
         logger.error(f"✗ Job {rq_id} timed out.")
         return None
 
-    def export_annotations_from_task(self, task_id: int):
+    def export_annotations_from_task(self, task_id: int, mode: str = "annotation"):
+        """
+        Runs a dataset export and returns the downloaded ZIP as a file object, or None on failure.
+        `mode` is the CVAT task mode and picks the export layout (see EXPORT_FORMATS).
+        """
         try:
             url = f"{self.cvat_client.host}/api/tasks/{task_id}/dataset/export"
-            params = {"format": "CVAT for images 1.1", "save_images": False}
+            params = {"format": EXPORT_FORMATS.get(mode, EXPORT_FORMATS["annotation"]), "save_images": False}
             resp = self.cvat_client._make_authenticated_request("POST", url, params=params)
             if resp.status_code != 202:
                 logger.error(f"Failed to start export for task {task_id}: {resp.status_code} - {resp.text}")
@@ -90,22 +108,77 @@ class PostAnnotationService:
             download_resp = self.cvat_client._make_authenticated_request("GET", result_url, stream=True)
             download_resp.raise_for_status()
 
-            with zipfile.ZipFile(io.BytesIO(download_resp.content)) as z:
-                for filename in z.namelist():
-                    if filename.lower().endswith('.xml'):
-                        xml_data = z.read(filename).decode('utf-8')
-                        logger.info(f"✓ Successfully extracted '{filename}' for task {task_id}.")
-                        return xml_data
+            # Spool the archive to disk past EXPORT_SPOOL_BYTES instead of holding it in memory
+            export_file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+            for chunk in download_resp.iter_content(chunk_size=1024 * 1024):
+                export_file.write(chunk)
+            export_file.seek(0)
+            logger.info(f"✓ Downloaded annotation export for task {task_id}.")
+            return export_file
 
-            logger.error("Could not find annotations.xml in the exported zip file.")
+        except Exception as e:
+            logger.error(f"Failed to export annotations for task {task_id}: {e}")
             return None
 
+    def _get_frame_names(self, task_id: int):
+        try:
+            return self.cvat_client.get_task_frame_names(task_id)
         except Exception as e:
-            logger.error(f"Failed to export annotations for task {task_id}: {e}")
+            logger.warning(f"Could not read frame names for task {task_id}: {e}")
+            return None
+
+    def fetch_annotation_batches_from_api(self, task_id: int, mode: str = "annotation"):
+        """
+        Reads annotations job by job from CVAT's JSON endpoint. Returns None if the API path failed.
+
+        Track ids follow the export's task-wide numbering, so every job is read once up front to
+        collect them; the raw JSON is spooled to disk, one line per job, and parsed back one job
+        at a time while rows are streamed.
+        """
+        try:
+            jobs = sorted(self.cvat_client.list_task_jobs(task_id), key=lambda job: job.get("start_frame", 0))
+            frame_names = self.cvat_client.get_task_frame_names(task_id)
+            spec_names = attribute_names_by_spec_id(self.cvat_client.list_task_labels(task_id))
+            spool = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+            track_ids, shape_ids = set(), set()
+            for job in jobs:
+                annotations = self.cvat_client.get_job_annotations(job["id"])
+                track_ids.update(track["id"] for track in annotations.get("tracks", []))
+                shape_ids.update(shape["id"] for shape in annotations.get("shapes", []))
+                spool.write(json.dumps(annotations) + "\n")
+            numbering = track_numbering(track_ids, shape_ids, mode)
+            logger.info(f"✓ Read annotations for task {task_id} from {len(jobs)} job(s) via the annotations API.")
+            return batched(rows_from_job_annotations(task_id, self._iter_spooled_jobs(jobs, spool),
+                                                     frame_names, spec_names, numbering))
+        except Exception as e:
+            logger.warning(f"Annotations API read failed for task {task_id}, falling back to export: {e}")
             return None
 
-    def process_and_store_task(self, task_id: int, provided_assignee: str):
-        if not self.connect_db(): return
+    @staticmethod
+    def _iter_spooled_jobs(jobs, spool):
+        with spool:
+            spool.seek(0)
+            for job, line in zip(jobs, spool):
+                yield job, json.loads(line)
+
+    def fetch_annotation_batches_from_export(self, task_id: int, mode: str = "annotation"):
+        export_file = self.export_annotations_from_task(task_id, mode)
+        if export_file is None: return None
+        return self._iter_export_batches(task_id, export_file, self._get_frame_names(task_id))
+
+    def _iter_export_batches(self, task_id: int, export_file, frame_names):
+        with export_file, zipfile.ZipFile(export_file) as z:
+            xml_name = next((name for name in z.namelist() if name.lower().endswith('.xml')), None)
+            if xml_name is None:
+                raise ValueError("Could not find annotations.xml in the exported zip file.")
+            logger.info(f"✓ Streaming '{xml_name}' for task {task_id}.")
+            with z.open(xml_name) as xml_stream:
+                yield from batched(iter_xml_rows(xml_stream, task_id, frame_names))
+
+    def process_and_store_task(self, task_id: int, provided_assignee: str) -> bool:
+        """Syncs one task into PostgreSQL. Returns False when the sync should be retried."""
+        if not self.connect_db(): return False
+        self.last_sync_counts = None
 
         try:
             logger.info(f"Processing completed task {task_id}...")
@@ -130,36 +203,32 @@ class PostAnnotationService:
                     (task_id, project_id, task_details["name"], 'completed', assignee, 'pending')
                 )
 
-            xml_data = self.export_annotations_from_task(task_id)
-            if not xml_data: return
-            root = ET.fromstring(xml_data)
-            data_to_insert = []
-
-            for image_tag in root.findall("image"):
-                keyframe_name = image_tag.get("name")
-                for person_id_counter, box_tag in enumerate(image_tag.findall("box")):
-                    attributes = {attr.get("name"): attr.text for attr in box_tag.findall("attribute")}
-                    data_to_insert.append((
-                        task_id, keyframe_name, person_id_counter + 1,
-                        float(box_tag.get("xtl")), float(box_tag.get("ytl")),
-                        float(box_tag.get("xbr")), float(box_tag.get("ybr")),
-                        json.dumps(attributes)
-                    ))
-
-            if not data_to_insert:
-                logger.warning(f"No annotations found to parse for task {task_id}.")
-                return
-
-            with self.conn.cursor() as cur:
-                cur.execute("DELETE FROM annotations WHERE task_id = %s;", (task_id,))
-                insert_query = "INSERT INTO annotations (task_id, keyframe_name, person_id, xtl, ytl, xbr, ybr, attributes) VALUES %s;"
-                psycopg2.extras.execute_values(cur, insert_query, data_to_insert)
-                logger.info(f"✓ Stored {cur.rowcount} annotations for task {task_id}.")
+            mode = task_details.get("mode", "annotation")
+            row_batches = self.fetch_annotation_batches_from_api(task_id, mode) if INGEST_MODE == "api" else None
+            if row_batches is None:
+                row_batches = self.fetch_annotation_batches_from_export(task_id, mode)
+            if row_batches is None: return False
+
+            if is_partitioned(self.conn):
+                ensure_project_partition(self.conn, project_id)
+            loader = AnnotationLoader(self.conn)
+            counts = loader.sync_task_annotations(task_id, project_id, row_batches)
+            if not counts["total"]:
+                logger.warning(f"No annotations found to parse for task {task_id}; removed {counts['deleted']} stored row(s).")
+            # New version invalidates cached QC results for this task
+            loader.stamp_annotation_version(task_id, project_id)
             self.conn.commit()
+            self.last_sync_counts = counts
+            logger.info(
+                f"✓ Synced {counts['total']} annotations for task {task_id}: {counts['inserted']} inserted, "
+                f"{counts['updated']} updated, {counts['deleted']} deleted, {counts['unchanged']} unchanged ({counts['renumbered']} renumbered)."
+            )
+            return True
 
         except Exception as e:
             logger.error(f"Database transaction failed for task {task_id}: {e}")
             if self.conn: self.conn.rollback()
+            return False
         finally:
             self.close_db()
 
@@ -174,5 +243,6 @@ if __name__ == "__main__":
     args = parse_args()
     cvat_client = CVATClient(host=CVAT_HOST, username=CVAT_USERNAME, password=CVAT_PASSWORD)
     if cvat_client.authenticated:
+        check_schema(DB_PARAMS)
         service = PostAnnotationService(db_params=DB_PARAMS, cvat_client=cvat_client)
         service.process_and_store_task(task_id=args.task_id, provided_assignee=args.assignee)
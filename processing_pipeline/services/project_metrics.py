@@ -0,0 +1,250 @@
+# services/project_metrics.py
+
+# Project-level agreement summarised in constant memory: annotations are streamed through a
+# server-side cursor one clip at a time and folded into mergeable accumulators, so partitions
+# of a project can be scored by separate workers and combined afterwards.
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from typing import Dict, Any, List, Optional, Iterator, Tuple
+import numpy as np
+import psycopg2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.agreement_metrics import (
+    IOU_THRESHOLDS, IOU_HISTOGRAM_BINS, MISSING_CODE, track_frame_keys, last_per_key, align_by_key,
+    aligned_iou, iou_summary_from_counts, confusion_matrices, agreement_weights, kappa_from_confusion,
+    flip_statistics
+)
+from processing_pipeline.services.qc_data_loader import attribute_code_row
+from processing_pipeline.services.quality_service import ANNOTATION_DTYPE, VOCABULARY
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --------------------- Settings ---------------------
+# Rows per round trip of the server-side cursor; with one clip buffered this bounds memory
+STREAM_CHUNK_ROWS = int(os.getenv("PROJECT_METRICS_CHUNK_ROWS", "20000"))
+PROJECT_METRICS_WORKERS = int(os.getenv("PROJECT_METRICS_WORKERS", "1"))
+
+# Clip = task name minus its annotator prefix, as in batch_qc. Rows of a clip arrive together,
+# each task's boxes in insertion order so later duplicates of a (track, frame) win. The hash is
+# shifted into [0, 2^32) in bigint; abs() overflows for hashtext = -2^31.
+_STREAM_SQL = """
+    SELECT regexp_replace(t.name, '^[^_]*_', '') AS clip, a.task_id, t.assignee, a.track_id, a.frame,
+           a.xtl, a.ytl, a.xbr, a.ybr, a.attributes, a.attribute_codes
+    FROM annotations a JOIN tasks t ON t.task_id = a.task_id
+    WHERE t.project_id = %(project_id)s AND a.project_id = %(project_id)s
+      AND mod(hashtext(regexp_replace(t.name, '^[^_]*_', ''))::bigint + 2147483648, %(partitions)s) = %(partition)s
+    ORDER BY clip, a.task_id, a.annotation_id;
+"""
+
+
+# --------------------- Accumulator ---------------------
+class ProjectMetricsAccumulator:
+    """
+    Running project totals that never hold boxes: IoU count/mean/M2 (Welford, merged with Chan's
+    formula), an IoU histogram and threshold counts, per-attribute confusion matrices over every
+    annotator pair of a clip, label counts, and per-annotator flip counts. `merge` combines the
+    partials of different workers; every field is a number or a NumPy array, so it pickles.
+    """
+
+    def __init__(self, sizes: List[int], bins: int = IOU_HISTOGRAM_BINS, thresholds=IOU_THRESHOLDS):
+        self.sizes = list(sizes)
+        self.thresholds = tuple(thresholds)
+        n_attrs, k = len(self.sizes), max(self.sizes, default=1)
+        self.clips = 0
+        self.tasks = 0
+        self.boxes = 0
+        self.iou_count = 0
+        self.iou_mean = 0.0
+        self.iou_m2 = 0.0
+        self.iou_histogram = np.zeros(bins, dtype=np.int64)
+        self.iou_threshold_counts = np.zeros(len(self.thresholds), dtype=np.int64)
+        self.confusion = np.zeros((n_attrs, k, k))
+        # Last column counts missing / unknown labels
+        self.label_counts = np.zeros((n_attrs, k + 1), dtype=np.int64)
+        self.annotator_transitions: Dict[str, int] = {}
+        self.annotator_flips: Dict[str, np.ndarray] = {}
+
+    def _add_moments(self, count: int, mean: float, m2: float):
+        total = self.iou_count + count
+        if not total:
+            return
+        delta = mean - self.iou_mean
+        self.iou_m2 += m2 + delta ** 2 * self.iou_count * count / total
+        self.iou_mean += delta * count / total
+        self.iou_count = total
+
+    def add_pair(self, ious: np.ndarray, codes_a: np.ndarray, codes_b: np.ndarray):
+        """IoUs and aligned codes of one annotator pair; a pair with no shared (track, frame) adds nothing."""
+        if not ious.size:
+            return
+        mean = float(ious.mean())
+        self._add_moments(ious.size, mean, float(((ious - mean) ** 2).sum()))
+        self.iou_histogram += np.histogram(ious, bins=self.iou_histogram.size, range=(0.0, 1.0))[0]
+        self.iou_threshold_counts += [int((ious >= t).sum()) for t in self.thresholds]
+        self.confusion += confusion_matrices(codes_a, codes_b, self.confusion.shape[-1], self.confusion.shape[0])
+
+    def add_task(self, annotator: str, records: np.ndarray):
+        """Label counts and flip counts of one task's deduplicated records."""
+        codes = records["codes"].astype(np.int64)
+        n_attrs, k = self.label_counts.shape[0], self.label_counts.shape[1] - 1
+        codes = np.where(codes == MISSING_CODE, k, codes)
+        flat = np.arange(n_attrs) * (k + 1) + codes
+        self.label_counts += np.bincount(flat.ravel(), minlength=n_attrs * (k + 1)).reshape(n_attrs, k + 1)
+
+        stats = flip_statistics(records["track_id"], records["frame"], records["codes"])
+        self.annotator_transitions[annotator] = self.annotator_transitions.get(annotator, 0) + stats["transitions"]
+        self.annotator_flips[annotator] = self.annotator_flips.get(annotator, 0) + stats["flips"].astype(np.int64)
+        self.tasks += 1
+        self.boxes += records.size
+
+    def add_clip(self, tasks: List[Tuple[str, np.ndarray]]):
+        """Every task of one clip, as (annotator, records); all task pairs are compared."""
+        keys = [track_frame_keys(records["track_id"], records["frame"]) for _, records in tasks]
+        for annotator, records in tasks:
+            self.add_task(annotator, records)
+        for i, j in itertools.combinations(range(len(tasks)), 2):
+            idx_a, idx_b = align_by_key(keys[i], keys[j])
+            if not idx_a.size:
+                continue
+            records_a, records_b = tasks[i][1][idx_a], tasks[j][1][idx_b]
+            self.add_pair(aligned_iou(records_a["box"], records_b["box"]), records_a["codes"], records_b["codes"])
+        self.clips += 1
+
+    def merge(self, other: "ProjectMetricsAccumulator") -> "ProjectMetricsAccumulator":
+        self.clips += other.clips
+        self.tasks += other.tasks
+        self.boxes += other.boxes
+        self._add_moments(other.iou_count, other.iou_mean, other.iou_m2)
+        self.iou_histogram += other.iou_histogram
+        self.iou_threshold_counts += other.iou_threshold_counts
+        self.confusion += other.confusion
+        self.label_counts += other.label_counts
+        for annotator, transitions in other.annotator_transitions.items():
+            self.annotator_transitions[annotator] = self.annotator_transitions.get(annotator, 0) + transitions
+            self.annotator_flips[annotator] = self.annotator_flips.get(annotator, 0) + other.annotator_flips[annotator]
+        return self
+
+    def summary(self, kappa_weights: Optional[str] = None) -> Dict[str, Any]:
+        iou = iou_summary_from_counts(self.iou_count, self.iou_mean * self.iou_count,
+                                      self.iou_threshold_counts, self.iou_histogram, self.thresholds,
+                                      self.iou_histogram.size)
+        iou["iou_std"] = float(np.sqrt(self.iou_m2 / self.iou_count)) if self.iou_count else 0.0
+        # No aligned boxes anywhere scores 0.0, as for a single pair (cohen_kappa)
+        kappas = kappa_from_confusion(self.confusion, agreement_weights(self.sizes, kappa_weights)) \
+            if self.iou_count else np.zeros(len(self.sizes))
+        kappa_scores = {attr_name: float(k) for attr_name, k in zip(VOCABULARY, kappas)}
+
+        label_distributions = {}
+        for j, (attr_name, options) in enumerate(VOCABULARY.items()):
+            counts = self.label_counts[j]
+            total = counts.sum()
+            shares = {option: float(counts[i] / total) if total else 0.0 for i, option in enumerate(options)}
+            shares["missing"] = float(counts[-1] / total) if total else 0.0
+            label_distributions[attr_name] = shares
+
+        flip_rates = {
+            annotator: {attr_name: float(flips / transitions) if transitions else 0.0
+                        for attr_name, flips in zip(VOCABULARY, self.annotator_flips[annotator])}
+            for annotator, transitions in self.annotator_transitions.items()
+        }
+        return {
+            "clips": self.clips,
+            "tasks": self.tasks,
+            "boxes": self.boxes,
+            "compared_annotations": self.iou_count,
+            **iou,
+            "kappa_scores": kappa_scores,
+            "macro_avg_kappa": float(np.mean(kappas)) if kappas.size else 0.0,
+            "label_distributions": label_distributions,
+            "flip_rates": flip_rates,
+        }
+
+
+# --------------------- Streaming ---------------------
+def _records(rows: List[Tuple]) -> np.ndarray:
+    records = np.empty(len(rows), dtype=ANNOTATION_DTYPE)
+    for i, (track_id, frame, xtl, ytl, xbr, ybr, attributes, codes) in enumerate(rows):
+        records[i] = (-1 if track_id is None else track_id, -1 if frame is None else frame,
+                      (xtl, ytl, xbr, ybr), attribute_code_row(attributes, codes))
+    return records
+
+
+def stream_clips(conn, project_id: int, partition: int = 0, partitions: int = 1,
+                 chunk_rows: int = STREAM_CHUNK_ROWS) -> Iterator[Tuple[str, List[Tuple[str, np.ndarray]]]]:
+    """
+    Yields (clip, [(annotator, records), ...]) for every clip of the project whose hash falls in
+    `partition`, reading through a named (server-side) cursor so only one clip is held at a time.
+    Each task's records are deduplicated per (track_id, frame), keeping the latest box.
+    """
+    def finish(task_rows):
+        records = _records(task_rows)
+        return records[last_per_key(track_frame_keys(records["track_id"], records["frame"]))]
+
+    with conn.cursor(name=f"project_metrics_{project_id}_{partition}") as cur:
+        cur.itersize = chunk_rows
+        cur.execute(_STREAM_SQL, {"project_id": project_id, "partition": partition, "partitions": partitions})
+        clip, task_id, annotator, task_rows, tasks = None, None, None, [], []
+        for row in cur:
+            if row[1] != task_id and task_rows:
+                tasks.append((annotator, finish(task_rows)))
+                task_rows = []
+            if row[0] != clip and tasks:
+                yield clip, tasks
+                tasks = []
+            clip, task_id, annotator = row[0], row[1], row[2] or "unassigned"
+            task_rows.append(row[3:])
+        if task_rows:
+            tasks.append((annotator, finish(task_rows)))
+        if tasks:
+            yield clip, tasks
+
+
+def project_partial(db_params: Dict[str, Any], project_id: int, partition: int = 0,
+                    partitions: int = 1) -> ProjectMetricsAccumulator:
+    """Accumulator for one hash partition of a project's clips. Module-level so it can run in a worker process."""
+    accumulator = ProjectMetricsAccumulator([len(options) for options in VOCABULARY.values()])
+    conn = psycopg2.connect(**db_params)
+    try:
+        for _, tasks in stream_clips(conn, project_id, partition, partitions):
+            accumulator.add_clip(tasks)
+    finally:
+        conn.close()
+    return accumulator
+
+
+def project_metrics(db_params: Dict[str, Any], project_id: int, workers: int = PROJECT_METRICS_WORKERS,
+                    kappa_weights: Optional[str] = None) -> Dict[str, Any]:
+    """Project summary from `workers` streamed partitions merged together."""
+    if workers <= 1:
+        accumulator = project_partial(db_params, project_id)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(project_partial, db_params, project_id, p, workers) for p in range(workers)]
+            accumulator = reduce(lambda a, b: a.merge(b), (f.result() for f in futures))
+    logger.info(f"✓ Streamed {accumulator.boxes} boxes of {accumulator.clips} clip(s) in project {project_id}.")
+    return {"project_id": project_id, **accumulator.summary(kappa_weights)}
+
+
+# --------------------- CLI ---------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="Summarise a project's agreement metrics in constant memory.")
+    parser.add_argument("--project-id", type=int, required=True, help="Project to summarise.")
+    parser.add_argument("--workers", type=int, default=PROJECT_METRICS_WORKERS, help="Partitions streamed in parallel.")
+    parser.add_argument("--kappa-weights", choices=["linear", "quadratic"], help="Weighted Cohen's kappa.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    from processing_pipeline.services.post_annotation_service import DB_PARAMS
+    from processing_pipeline.services.migrations import check_schema
+
+    args = parse_args()
+    check_schema(DB_PARAMS)
+    print(json.dumps(project_metrics(DB_PARAMS, args.project_id, args.workers, args.kappa_weights), indent=2))
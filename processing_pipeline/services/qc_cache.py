@@ -0,0 +1,64 @@
+# services/qc_cache.py
+
+# Persisted QC results keyed by task pair, metric options and each task's annotation_version.
+# A sync rewrites tasks.annotation_version, so entries go stale as soon as either task changes
+# and no explicit invalidation is needed.
+import logging
+from typing import Dict, Any, Optional
+import psycopg2.extras
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def options_key(kappa_weights: Optional[str] = None) -> str:
+    """Metric options that change the results; part of the cache key."""
+    return f"kappa={kappa_weights or 'none'}"
+
+
+class QCResultsCache:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, task_id_1: int, task_id_2: int, options: str) -> Optional[Dict[str, Any]]:
+        """Cached results, or None when absent or when either task has been re-synced since."""
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT c.results, c.computed_at
+                FROM qc_results c
+                JOIN tasks t1 ON t1.task_id = c.task_id_1
+                JOIN tasks t2 ON t2.task_id = c.task_id_2
+                WHERE c.task_id_1 = %s AND c.task_id_2 = %s AND c.options = %s
+                  AND c.version_1 = t1.annotation_version AND c.version_2 = t2.annotation_version;
+                """,
+                (task_id_1, task_id_2, options)
+            )
+            row = cur.fetchone()
+        if not row:
+            return None
+        results, computed_at = row
+        return {**results, "cached": True, "computed_at": computed_at.isoformat()}
+
+    def put(self, task_id_1: int, task_id_2: int, options: str, version_1: Optional[str], version_2: Optional[str],
+            results: Dict[str, Any]) -> bool:
+        """
+        Stores results computed from the given annotation versions. Tasks without a version
+        (never synced since versioning was added) are not cached.
+        """
+        if not version_1 or not version_2:
+            return False
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO qc_results (task_id_1, task_id_2, options, version_1, version_2, results)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (task_id_1, task_id_2, options) DO UPDATE
+                SET version_1 = EXCLUDED.version_1, version_2 = EXCLUDED.version_2,
+                    results = EXCLUDED.results, computed_at = CURRENT_TIMESTAMP;
+                """,
+                (task_id_1, task_id_2, options, version_1, version_2, psycopg2.extras.Json(results))
+            )
+        self.conn.commit()
+        logger.info(f"✓ Cached QC results for tasks {task_id_1}/{task_id_2} ({options}).")
+        return True
@@ -0,0 +1,105 @@
+# services/qc_data_loader.py
+
+# Loads everything a QC comparison needs in one round trip per table, so frame-level
+# and tube-level metrics are computed from the same in-memory bundle.
+import json
+import logging
+import os
+import sys
+from typing import Dict, Any, List
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.shared_config import attribute_codes, attributes_from_codes
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Stand-in for NULL track_id / frame in the integer arrays
+NO_TRACK = -1
+
+
+def decode_attributes(value: Any, codes: List[int] = None) -> Dict[str, Any]:
+    """
+    JSONB attributes arrive as dicts from psycopg2; older rows may hold a JSON string.
+    Rows ingested in codes-only mode have NULL attributes and are rebuilt from `attribute_codes`.
+    """
+    if value is None and codes is not None:
+        return attributes_from_codes(codes)
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, str) and value:
+        try:
+            return json.loads(value)
+        except ValueError:
+            return {}
+    return {}
+
+
+def attribute_code_row(value: Any, codes: List[int] = None) -> List[int]:
+    """
+    Option codes of one box in shared_config.ATTRIBUTE_NAMES order: the stored attribute_codes
+    as-is, otherwise the encoded JSON attributes.
+    """
+    return codes if codes is not None else attribute_codes(decode_attributes(value))
+
+
+def _empty_bundle(task_id: int, name: str = None, assignee: str = None,
+                  annotation_version: str = None) -> Dict[str, Any]:
+    return {
+        "task_id": task_id,
+        "name": name,
+        "assignee": assignee,
+        "annotation_version": annotation_version,
+        "frame": np.empty(0, dtype=np.int64),
+        "track_id": np.empty(0, dtype=np.int64),
+        "boxes": np.empty((0, 4), dtype=np.float64),
+        "attributes": [],
+    }
+
+
+def load_qc_bundles(conn, task_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    Fetches task info and the annotations of every task in `task_ids` with one query each.
+    Returns {task_id: bundle}; a bundle holds `name`, `assignee`, `annotation_version`, frame-sorted
+    `frame` and `track_id` int arrays (NULL -> NO_TRACK), an (n, 4) `boxes` array and decoded `attributes`.
+    Tasks missing from the tasks table are left out.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT task_id, name, assignee, annotation_version FROM tasks WHERE task_id = ANY(%s);",
+            (list(task_ids),)
+        )
+        bundles = {row[0]: _empty_bundle(*row) for row in cur.fetchall()}
+        cur.execute(
+            """
+            SELECT task_id, frame, track_id, xtl, ytl, xbr, ybr, attributes, attribute_codes
+            FROM annotations WHERE task_id = ANY(%s)
+            ORDER BY task_id, frame, track_id;
+            """,
+            (list(task_ids),)
+        )
+        rows = cur.fetchall()
+
+    if not rows:
+        return bundles
+    task_col, frames, tracks, xtl, ytl, xbr, ybr, attributes, codes = zip(*rows)
+    task_col = np.array(task_col, dtype=np.int64)
+    frames = np.array([NO_TRACK if f is None else f for f in frames], dtype=np.int64)
+    tracks = np.array([NO_TRACK if t is None else t for t in tracks], dtype=np.int64)
+    boxes = np.column_stack([xtl, ytl, xbr, ybr]).astype(np.float64)
+
+    # Rows are ordered by task, so each task is one contiguous slice
+    uniq, starts = np.unique(task_col, return_index=True)
+    ends = np.append(starts[1:], len(task_col))
+    for task_id, start, end in zip(uniq.tolist(), starts, ends):
+        if task_id not in bundles:
+            continue
+        bundles[task_id].update({
+            "frame": frames[start:end],
+            "track_id": tracks[start:end],
+            "boxes": boxes[start:end],
+            "attributes": [decode_attributes(a, c) for a, c in zip(attributes[start:end], codes[start:end])],
+        })
+    logger.info(f"✓ Loaded {len(rows)} annotations for {len(bundles)} task(s) in one pass.")
+    return bundles
@@ -0,0 +1,339 @@
+# services/qc_metrics.py
+import logging
+import os
+import sys
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+import psycopg2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.qc_data_loader import load_qc_bundles
+from processing_pipeline.services.qc_cache import QCResultsCache, options_key
+from processing_pipeline.services.reliability import AnnotatorReliability, pair_contribution
+from processing_pipeline.services.agreement_metrics import (
+    match_boxes_pruned, iou_summary, build_vocabulary, encode_attributes, cohen_kappa, confusion_matrices,
+    flip_statistics, unstable_tracks, track_frame_keys, untracked_unit_keys, multi_rater_agreement
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class EnhancedQualityMetrics:
+    """Enhanced quality metrics calculator for E2 Agreement & Quality requirements"""
+
+    def __init__(self, db_params: Dict[str, Any]):
+        self.db_params = db_params
+
+    def get_connection(self):
+        """Get database connection"""
+        return psycopg2.connect(**self.db_params)
+
+    def calculate_frame_level_metrics(self, data1: Dict[str, Any], data2: Dict[str, Any]) -> Dict[str, Any]:
+        """Calculate frame-level box agreement metrics"""
+        try:
+            # Rows arrive ordered by frame, so each task splits into contiguous per-frame blocks
+            blocks1, boxes1, tracks1 = self._frame_blocks(data1)
+            blocks2, boxes2, tracks2 = self._frame_blocks(data2)
+
+            pair_ious, pairs = [], []
+            total_matched_frames = 0
+            unmatched1 = sum(e - s for f, (s, e) in blocks1.items() if f not in blocks2)
+            unmatched2 = sum(e - s for f, (s, e) in blocks2.items() if f not in blocks1)
+
+            for frame in sorted(blocks1.keys() & blocks2.keys()):
+                s1, e1 = blocks1[frame]
+                s2, e2 = blocks2[frame]
+                # One-to-one assignment so a box is never credited twice; crowded frames only score
+                # box pairs that can overlap
+                rows, cols, matched = match_boxes_pruned(boxes1[s1:e1], boxes2[s2:e2])
+                unmatched1 += (e1 - s1) - len(rows)
+                unmatched2 += (e2 - s2) - len(cols)
+                if len(rows) == 0:
+                    continue
+                total_matched_frames += 1
+                pair_ious.append(matched)
+                pairs.extend(
+                    {"frame": int(frame), "track_id_1": int(tracks1[s1 + r]), "track_id_2": int(tracks2[s2 + c]),
+                     "iou": float(v)}
+                    for r, c, v in zip(rows, cols, matched)
+                )
+
+            ious = np.concatenate(pair_ious) if pair_ious else np.empty(0)
+            summary = iou_summary(ious)
+
+            return {
+                "mean_iou": summary["average_iou"],
+                "percent_iou_gte_05": summary["percent_iou_gte_05"],
+                "total_matched_frames": total_matched_frames,
+                "matched_pairs": int(ious.size),
+                "unmatched_task1": int(unmatched1),
+                "unmatched_task2": int(unmatched2),
+                "pairs": pairs,
+                "ious": ious.tolist()
+            }
+
+        except Exception as e:
+            logger.error(f"Error calculating frame-level metrics: {e}")
+            return {"error": str(e)}
+
+    def calculate_tube_level_metrics(self, data1: Dict[str, Any], data2: Dict[str, Any],
+                                     kappa_weights: Optional[str] = None) -> Dict[str, Any]:
+        """Calculate tube-level action agreement metrics (Cohen's κ and flip-rates)"""
+        try:
+            # Get all unique action attributes
+            all_actions = set().union(*data1['attributes'], *data2['attributes'])
+
+            # Remove non-action attributes (like person_id, etc.)
+            action_attributes = sorted(attr for attr in all_actions if not attr.startswith('person'))
+
+            # Encode every action label once; a missing label counts as 'unknown'
+            vocabulary = build_vocabulary(data1['attributes'] + data2['attributes'], action_attributes, default='unknown')
+            codes1 = encode_attributes(data1['attributes'], vocabulary, default='unknown')
+            codes2 = encode_attributes(data2['attributes'], vocabulary, default='unknown')
+
+            # One join on (frame, track_id) aligns the label columns of every action at once
+            aligned = self._align_rows(data1, data2)
+            aligned1, aligned2 = codes1[aligned['row1'].to_numpy()], codes2[aligned['row2'].to_numpy()]
+
+            # Calculate Cohen's κ for all actions at once; no agreement signal (single label) scores 0
+            sizes = [len(v) for v in vocabulary.values()]
+            kappas = cohen_kappa(aligned1, aligned2, sizes, weights=kappa_weights, degenerate=0.0)
+            kappa_scores = {action: float(k) for action, k in zip(action_attributes, kappas)}
+
+            # Label confusion per action, from the same aligned columns
+            matrices = confusion_matrices(aligned1, aligned2, max(sizes, default=1), len(sizes))
+            confusion = {
+                action: {"labels": [str(v) for v in vocabulary[action]],
+                         "matrix": matrices[j, :sizes[j], :sizes[j]].astype(int).tolist()}
+                for j, action in enumerate(action_attributes)
+            }
+
+            # Calculate flip-rates for each annotator
+            flip_rates, unstable = {}, {}
+            for annotator, data, codes in (("annotator_1", data1, codes1), ("annotator_2", data2, codes2)):
+                flip_rates[annotator], unstable[annotator] = self._calculate_flip_rates(
+                    data, codes, action_attributes, vocabulary
+                )
+
+            # Calculate macro-average kappa
+            macro_avg_kappa = np.mean(list(kappa_scores.values())) if kappa_scores else 0.0
+
+            return {
+                "kappa_scores": kappa_scores,
+                "macro_avg_kappa": macro_avg_kappa,
+                "flip_rates": flip_rates,
+                "action_attributes": action_attributes,
+                "confusion": confusion,
+                "unstable_tracks": unstable
+            }
+
+        except Exception as e:
+            logger.error(f"Error calculating tube-level metrics: {e}")
+            return {"error": str(e)}
+
+    def calculate_multi_rater_metrics(self, bundles: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Fleiss' κ, Krippendorff's α and mean pairwise IoU across all annotators of one clip"""
+        try:
+            all_attributes = [attrs for data in bundles for attrs in data['attributes']]
+            action_attributes = sorted(attr for attr in set().union(*all_attributes) if not attr.startswith('person'))
+            vocabulary = build_vocabulary(all_attributes, action_attributes, default='unknown')
+            codes = [encode_attributes(data['attributes'], vocabulary, default='unknown') for data in bundles]
+
+            # Raters are stacked on their (track_id, frame) keys; labels and boxes are scored in one pass
+            agreement = multi_rater_agreement(
+                [track_frame_keys(data['track_id'], data['frame']) for data in bundles], codes,
+                [data['boxes'] for data in bundles], [len(v) for v in vocabulary.values()], degenerate=0.0
+            )
+            fleiss = dict(zip(action_attributes, agreement['fleiss_kappa'].tolist()))
+            alpha = dict(zip(action_attributes, agreement['krippendorff_alpha'].tolist()))
+
+            return {
+                "task_ids": [data['task_id'] for data in bundles],
+                "assignees": [data['assignee'] for data in bundles],
+                "fleiss_kappa": fleiss,
+                "krippendorff_alpha": alpha,
+                "macro_fleiss_kappa": float(np.mean(list(fleiss.values()))) if fleiss else 0.0,
+                "macro_krippendorff_alpha": float(np.mean(list(alpha.values()))) if alpha else 0.0,
+                "mean_pairwise_iou": agreement['mean_pairwise_iou'],
+                "pairwise_iou": agreement['pairwise_iou'].tolist(),
+                "units": agreement['units'],
+                "units_all_raters": agreement['units_all_raters'],
+                "flip_rates": {
+                    data['task_id']: self._calculate_flip_rates(data, c, action_attributes, vocabulary)[0]
+                    for data, c in zip(bundles, codes)
+                },
+                "action_attributes": action_attributes
+            }
+
+        except Exception as e:
+            logger.error(f"Error calculating multi-rater metrics: {e}")
+            return {"error": str(e)}
+
+    def run_multi_annotator_check(self, task_ids: List[int]) -> Dict[str, Any]:
+        """Agreement across every task of an overlap clip, however many annotators it has"""
+        try:
+            conn = self.get_connection()
+            try:
+                bundles = load_qc_bundles(conn, task_ids)
+            finally:
+                conn.close()
+        except Exception as e:
+            return {"error": f"Failed to load tasks: {e}"}
+
+        if len(bundles) != len(task_ids):
+            return {"error": "Could not find all tasks in database"}
+        return self.calculate_multi_rater_metrics([bundles[t] for t in task_ids])
+
+    def get_cached_results(self, task1_id: int, task2_id: int,
+                           kappa_weights: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Results of an earlier run, if neither task has been re-synced since"""
+        try:
+            conn = self.get_connection()
+            try:
+                return QCResultsCache(conn).get(task1_id, task2_id, options_key(kappa_weights))
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"QC cache lookup failed: {e}")
+            return None
+
+    def run_comprehensive_quality_check(self, task1_id: int, task2_id: int, kappa_weights: Optional[str] = None,
+                                        use_cache: bool = True) -> Dict[str, Any]:
+        """Run comprehensive quality check combining frame and tube level metrics"""
+        options = options_key(kappa_weights)
+        try:
+            conn = self.get_connection()
+        except Exception as e:
+            return {"error": f"Failed to load tasks: {e}"}
+
+        try:
+            cache = QCResultsCache(conn)
+            if use_cache:
+                # A missing or unreadable cache only costs a recompute
+                try:
+                    cached = cache.get(task1_id, task2_id, options)
+                except Exception as e:
+                    conn.rollback()
+                    logger.warning(f"QC cache lookup failed, recomputing: {e}")
+                    cached = None
+                if cached:
+                    return cached
+
+            # Fetch task info and both tasks' annotations once; every metric reads from these bundles
+            try:
+                bundles = load_qc_bundles(conn, [task1_id, task2_id])
+            except Exception as e:
+                return {"error": f"Failed to load tasks: {e}"}
+
+            if len(bundles) != 2:
+                return {"error": "Could not find both tasks in database"}
+            data1, data2 = bundles[task1_id], bundles[task2_id]
+            if not data1['attributes'] and not data2['attributes']:
+                return {"error": "No annotations found for the specified tasks"}
+
+            results = self._compute_quality_check(data1, data2, kappa_weights)
+            if "error" not in results:
+                try:
+                    cache.put(task1_id, task2_id, options, data1['annotation_version'], data2['annotation_version'],
+                              results)
+                except Exception as e:
+                    conn.rollback()
+                    logger.warning(f"Could not cache QC results: {e}")
+                # The scoreboard sums plain kappa only, so weighted runs are not recorded
+                if kappa_weights is None:
+                    try:
+                        AnnotatorReliability(conn).record_pair(
+                            task1_id, task2_id, data1['annotation_version'], data2['annotation_version'],
+                            pair_contribution(data1['assignee'], data2['assignee'], results['matched_pairs'],
+                                              results['average_iou'], results['kappa_scores'],
+                                              results['flip_rates']['annotator_1'], results['flip_rates']['annotator_2'])
+                        )
+                    except Exception as e:
+                        conn.rollback()
+                        logger.warning(f"Could not update annotator reliability: {e}")
+            return results
+        finally:
+            conn.close()
+
+    def _compute_quality_check(self, data1: Dict[str, Any], data2: Dict[str, Any],
+                               kappa_weights: Optional[str] = None) -> Dict[str, Any]:
+        """Frame and tube level metrics for two loaded task bundles"""
+        # Calculate frame-level metrics
+        frame_metrics = self.calculate_frame_level_metrics(data1, data2)
+        if "error" in frame_metrics:
+            return frame_metrics
+
+        # Calculate tube-level metrics
+        tube_metrics = self.calculate_tube_level_metrics(data1, data2, kappa_weights)
+        if "error" in tube_metrics:
+            return tube_metrics
+
+        # Combine results
+        results = {
+            "task_info": {
+                "task1": {"id": data1['task_id'], "name": data1['name'], "assignee": data1['assignee']},
+                "task2": {"id": data2['task_id'], "name": data2['name'], "assignee": data2['assignee']}
+            },
+            # Frame-level metrics
+            "average_iou": frame_metrics["mean_iou"],
+            "percent_iou_gte_05": frame_metrics["percent_iou_gte_05"],
+            "total_matched_frames": frame_metrics["total_matched_frames"],
+            "matched_pairs": frame_metrics["matched_pairs"],
+            "unmatched_task1": frame_metrics["unmatched_task1"],
+            "unmatched_task2": frame_metrics["unmatched_task2"],
+            "pairs": frame_metrics["pairs"],
+
+            # Tube-level metrics
+            "kappa_scores": tube_metrics["kappa_scores"],
+            "macro_avg_kappa": tube_metrics["macro_avg_kappa"],
+            "flip_rates": tube_metrics["flip_rates"],
+            "action_attributes": tube_metrics["action_attributes"],
+            "confusion": tube_metrics["confusion"],
+            "unstable_tracks": tube_metrics["unstable_tracks"],
+            "cached": False
+        }
+
+        return results
+
+    @staticmethod
+    def _frame_blocks(data: Dict[str, Any]) -> Tuple[Dict[int, Tuple[int, int]], np.ndarray, np.ndarray]:
+        """Splits frame-sorted rows into {frame: (start, end)} slices over a box array."""
+        frames = data['frame']
+        uniq, starts = np.unique(frames, return_index=True)
+        ends = np.append(starts[1:], len(frames))
+        return dict(zip(uniq.tolist(), zip(starts, ends))), data['boxes'], data['track_id']
+
+    @staticmethod
+    def _align_rows(data1: Dict[str, Any], data2: Dict[str, Any]) -> pd.DataFrame:
+        """
+        Joins both tasks on (frame, track_id); `row1`/`row2` are positional row indices into each task.
+        Untracked boxes share one key per frame, so they are paired by IoU within the frame instead.
+        """
+        keys1, keys2 = untracked_unit_keys(
+            [track_frame_keys(data['track_id'], data['frame']) for data in (data1, data2)],
+            [data1['boxes'], data2['boxes']]
+        )
+        left = pd.DataFrame({'key': keys1, 'row1': np.arange(len(keys1))}).drop_duplicates('key')
+        right = pd.DataFrame({'key': keys2, 'row2': np.arange(len(keys2))}).drop_duplicates('key')
+        return left.merge(right, on='key', how='inner', sort=True)
+
+    def _calculate_flip_rates(self, data: Dict[str, Any], codes: np.ndarray, action_attributes: List[str],
+                              vocabulary: Dict[str, List[Any]]) -> Tuple[Dict[str, float], List[Dict[str, Any]]]:
+        """Calculate flip rates for temporal stability, plus the tracks that flip and where"""
+        stats = flip_statistics(data['track_id'], data['frame'], codes)
+        flip_rates = {action: float(rate) for action, rate in zip(action_attributes, stats['rates'])}
+
+        # Flip locations, grouped under the unstable track they belong to
+        locations = defaultdict(list)
+        for track, frame, j, old, new in zip(stats['flip_track'], stats['flip_frame'], stats['flip_attribute'],
+                                             stats['flip_from'], stats['flip_to']):
+            options = vocabulary[action_attributes[j]]
+            locations[int(track)].append({"frame": int(frame), "action": action_attributes[j],
+                                          "from": str(options[old]), "to": str(options[new])})
+        tracks = unstable_tracks(stats)
+        for track in tracks:
+            track['locations'] = locations[track['track_id']]
+        return flip_rates, tracks
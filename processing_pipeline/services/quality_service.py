@@ -1,19 +1,108 @@
-import json
 import psycopg2
+import psycopg2.extras
 import logging
-from typing import List, Dict, Any, Tuple
-from collections import defaultdict
+from typing import List, Dict, Any, Optional, Tuple
 import numpy as np
 import os
 import sys
 
 # Ensure the parent directory is in the path to find the shared_config
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from processing_pipeline.services.shared_config import ATTRIBUTE_DEFINITIONS
+from processing_pipeline.services.shared_config import (
+    ATTRIBUTE_DEFINITIONS, ATTRIBUTE_NAMES, OPTION_CODES
+)
+from processing_pipeline.services.qc_data_loader import attribute_code_row
+from processing_pipeline.services.agreement_metrics import (
+    IOU_THRESHOLDS, IOU_HISTOGRAM_BINS, track_frame_keys, last_per_key, align_by_key, aligned_iou, iou_summary,
+    iou_summary_from_counts, cohen_kappa, agreement_weights, kappa_from_confusion,
+    flip_statistics, unstable_tracks, multi_rater_agreement, cluster_bootstrap
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Tracks reported per annotator as most in need of review
+UNSTABLE_TRACK_LIMIT = 10
+
+VOCABULARY = {attr_name: attr_info['options'] for attr_name, attr_info in ATTRIBUTE_DEFINITIONS.items()}
+
+# One box as held in memory: 32 bytes with the current attribute set. NULL track_id / frame and
+# missing or unknown labels are stored as -1 (agreement_metrics.MISSING_CODE).
+ANNOTATION_DTYPE = np.dtype([
+    ("track_id", np.int32),
+    ("frame", np.int32),
+    ("box", np.float32, (4,)),
+    ("codes", np.int8, (len(VOCABULARY),)),
+])
+EMPTY_ANNOTATIONS = np.empty(0, dtype=ANNOTATION_DTYPE)
+# Rows converted per cursor round trip
+FETCH_BATCH_SIZE = 10000
+
+# Aggregate IoU, label agreement and flips in Postgres and fetch only summary rows
+AGGREGATE_IN_DB = os.getenv("QC_AGGREGATE_IN_DB", "false").lower() in ("1", "true", "yes")
+
+# One box per (task, track, frame) like the Python dicts (NULL track/frame -> -1), and one row per
+# box and attribute holding the option code: the JSON label when it is a known option, else the
+# stored attribute_codes entry, else -1.
+_CODED_BOXES_CTE = """
+    boxes AS (
+        SELECT DISTINCT ON (task_id, COALESCE(track_id, -1), COALESCE(frame, -1))
+               task_id, COALESCE(track_id, -1) AS track_id, COALESCE(frame, -1) AS frame,
+               xtl::float8 AS xtl, ytl::float8 AS ytl, xbr::float8 AS xbr, ybr::float8 AS ybr,
+               attributes, attribute_codes
+        FROM annotations WHERE task_id IN (%(task_1)s, %(task_2)s)
+        ORDER BY task_id, COALESCE(track_id, -1), COALESCE(frame, -1), annotation_id DESC
+    ),
+    coded AS (
+        SELECT b.task_id, b.track_id, b.frame, attr.idx::int - 1 AS attr_idx,
+               COALESCE((%(option_codes)s::jsonb -> attr.name ->> (b.attributes ->> attr.name))::int,
+                        b.attribute_codes[attr.idx], -1) AS code
+        FROM boxes b CROSS JOIN unnest(%(names)s::text[]) WITH ORDINALITY AS attr(name, idx)
+    )
+"""
+
+_BOX_COUNTS_SQL = "SELECT task_id, COUNT(*) FROM annotations WHERE task_id IN (%(task_1)s, %(task_2)s) GROUP BY task_id;"
+
+_IOU_BINS_SQL = """
+    WITH {boxes},
+    pairs AS (
+        SELECT inter / NULLIF(area_a + area_b - inter, 0) AS raw_iou
+        FROM (
+            SELECT GREATEST(LEAST(a.xbr, b.xbr) - GREATEST(a.xtl, b.xtl), 0)
+                   * GREATEST(LEAST(a.ybr, b.ybr) - GREATEST(a.ytl, b.ytl), 0) AS inter,
+                   (a.xbr - a.xtl) * (a.ybr - a.ytl) AS area_a,
+                   (b.xbr - b.xtl) * (b.ybr - b.ytl) AS area_b
+            FROM boxes a JOIN boxes b ON a.track_id = b.track_id AND a.frame = b.frame
+            WHERE a.task_id = %(task_1)s AND b.task_id = %(task_2)s
+        ) overlap
+    ),
+    ious AS (
+        SELECT CASE WHEN raw_iou > 0 THEN raw_iou ELSE 0 END AS iou FROM pairs
+    )
+    SELECT CASE WHEN iou = 1 THEN %(bins)s ELSE width_bucket(iou, 0, 1, %(bins)s) END - 1 AS bin,
+           COUNT(*), SUM(iou), {threshold_counts}
+    FROM ious GROUP BY bin;
+"""
+
+_CONFUSION_SQL = """
+    WITH {boxes}
+    SELECT a.attr_idx, a.code, b.code, COUNT(*)
+    FROM coded a JOIN coded b ON a.track_id = b.track_id AND a.frame = b.frame AND a.attr_idx = b.attr_idx
+    WHERE a.task_id = %(task_1)s AND b.task_id = %(task_2)s AND a.code >= 0 AND b.code >= 0
+    GROUP BY 1, 2, 3;
+"""
+
+_TRACK_FLIPS_SQL = """
+    WITH {boxes},
+    steps AS (
+        SELECT task_id, track_id, attr_idx, code,
+               LAG(code) OVER (PARTITION BY task_id, track_id, attr_idx ORDER BY frame) AS previous
+        FROM coded WHERE track_id >= 0
+    )
+    SELECT task_id, track_id, attr_idx, COUNT(previous), COUNT(*) FILTER (WHERE code <> previous)
+    FROM steps GROUP BY 1, 2, 3 ORDER BY 1, 2, 3;
+"""
+
 class QualityService:
     def __init__(self, db_params: Dict[str, Any]):
         self.db_params = db_params
@@ -32,123 +121,224 @@ class QualityService:
             self.conn.close()
             self.conn = None
 
-    def _fetch_annotations_for_tasks(self, task_ids: List[int]) -> Dict[int, Dict[Tuple[int, int], Dict]]:
+    def _fetch_annotations_for_tasks(self, task_ids: List[int]) -> Dict[int, np.ndarray]:
+        """
+        One ANNOTATION_DTYPE record array per task, one record per (track_id, frame) with NULLs as -1;
+        when a key repeats, the most recently inserted box wins. Rows are converted batch by batch,
+        so no per-box Python objects outlive a fetch.
+        """
         if not self.conn:
             raise ConnectionError("Database is not connected.")
 
-        annotations_by_task = defaultdict(dict)
+        chunks = []
         with self.conn.cursor() as cur:
             cur.execute(
-                "SELECT task_id, track_id, frame, xtl, ytl, xbr, ybr, attributes FROM annotations WHERE task_id = ANY(%s)",
+                "SELECT task_id, track_id, frame, xtl, ytl, xbr, ybr, attributes, attribute_codes "
+                "FROM annotations WHERE task_id = ANY(%s) ORDER BY task_id, annotation_id",
                 (task_ids,)
             )
-            for row in cur.fetchall():
-                task_id, track_id, frame, xtl, ytl, xbr, ybr, attributes = row
-                key = (track_id, frame)
-                # ✅ Parse JSON attributes
-                try:
-                    attr_dict = json.loads(attributes) if attributes else {}
-                except Exception:
-                    attr_dict = {}
-                annotations_by_task[task_id][key] = {
-                    "box": [xtl, ytl, xbr, ybr],
-                    "attributes": attr_dict
-                }
+            while True:
+                rows = cur.fetchmany(FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+                batch = np.empty(len(rows), dtype=ANNOTATION_DTYPE)
+                task_col = np.empty(len(rows), dtype=np.int64)
+                for i, (task_id, track_id, frame, xtl, ytl, xbr, ybr, attributes, codes) in enumerate(rows):
+                    task_col[i] = task_id
+                    batch[i] = (-1 if track_id is None else track_id, -1 if frame is None else frame,
+                                (xtl, ytl, xbr, ybr), attribute_code_row(attributes, codes))
+                chunks.append((task_col, batch))
+
+        if not chunks:
+            return {}
+        task_col = np.concatenate([c[0] for c in chunks])
+        records = np.concatenate([c[1] for c in chunks])
+        annotations_by_task = {}
+        for task_id in np.unique(task_col).tolist():
+            task_records = records[task_col == task_id]
+            keys = track_frame_keys(task_records["track_id"], task_records["frame"])
+            annotations_by_task[task_id] = task_records[last_per_key(keys)]
         return annotations_by_task
 
-    def _calculate_iou(self, boxA: List[float], boxB: List[float]) -> float:
-        xA = max(boxA[0], boxB[0])
-        yA = max(boxA[1], boxB[1])
-        xB = min(boxA[2], boxB[2])
-        yB = min(boxA[3], boxB[3])
-        interArea = max(0, xB - xA) * max(0, yB - yA)
-        boxAArea = (boxA[2] - boxA[0]) * (boxA[3] - boxA[1])
-        boxBArea = (boxB[2] - boxB[0]) * (boxB[3] - boxB[1])
-        return interArea / float(boxAArea + boxBArea - interArea) if (boxAArea + boxBArea - interArea) > 0 else 0.0
-
-    def _calculate_cohens_kappa(self, annotations1: Dict, annotations2: Dict, attr_name: str, categories: List[str]):
-        num_categories = len(categories)
-        cat_map = {cat: i for i, cat in enumerate(categories)}
-        matrix = np.zeros((num_categories, num_categories))
-        common_keys = set(annotations1.keys()) & set(annotations2.keys())
-        if not common_keys: return 0.0
-
-        for key in common_keys:
-            val1 = annotations1[key]['attributes'].get(attr_name)
-            val2 = annotations2[key]['attributes'].get(attr_name)
-            if val1 in cat_map and val2 in cat_map:
-                matrix[cat_map[val1], cat_map[val2]] += 1
-
-        total = np.sum(matrix)
-        if total == 0: return 1.0
-        p_observed = np.trace(matrix) / total
-        p_expected = np.sum(np.sum(matrix, axis=1) * np.sum(matrix, axis=0)) / (total ** 2)
-        if p_expected == 1: return 1.0
-        return (p_observed - p_expected) / (1 - p_expected)
-
-    def _calculate_flip_rate(self, annotations: Dict) -> Dict[str, float]:
-        tracks = defaultdict(list)
-        for (track_id, frame), data in annotations.items():
-            tracks[track_id].append({'frame': frame, 'attributes': data['attributes']})
-
-        avg_flip_rates = {}
-        for attr_name in ATTRIBUTE_DEFINITIONS.keys():
-            total_flips = 0
-            total_opportunities = 0
-            for track_id, frames in tracks.items():
-                if len(frames) < 2:
-                    continue
-                sorted_frames = sorted(frames, key=lambda x: x['frame'])
-                num_flips = 0
-                for i in range(1, len(sorted_frames)):
-                    prev_val = sorted_frames[i - 1]['attributes'].get(attr_name)
-                    curr_val = sorted_frames[i]['attributes'].get(attr_name)
-                    if prev_val != curr_val:
-                        num_flips += 1
-                total_flips += num_flips
-                total_opportunities += len(sorted_frames) - 1
-            avg_flip_rates[attr_name] = total_flips / total_opportunities if total_opportunities > 0 else 0.0
-        return avg_flip_rates
-
-    def run_quality_check(self, task_id1: int, task_id2: int) -> Dict[str, Any]:
+    @staticmethod
+    def _to_arrays(records: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Packs one task's records into int64 (track, frame) keys and an (n, 4) box array."""
+        return track_frame_keys(records["track_id"], records["frame"]), records["box"]
+
+    @staticmethod
+    def _calculate_cohens_kappa(codes1: np.ndarray, codes2: np.ndarray, weights: Optional[str] = None) -> Dict[str, float]:
+        """Kappa for every attribute from aligned code arrays; labels outside the options are ignored."""
+        sizes = [len(info['options']) for info in ATTRIBUTE_DEFINITIONS.values()]
+        kappas = cohen_kappa(codes1, codes2, sizes, weights=weights)
+        return {attr_name: float(k) for attr_name, k in zip(ATTRIBUTE_DEFINITIONS, kappas)}
+
+    @staticmethod
+    def _calculate_flip_rate(records: np.ndarray) -> Tuple[Dict[str, float], List[Dict[str, Any]]]:
+        """Per-attribute flip rate along tracks, plus the tracks with the most flips."""
+        stats = flip_statistics(records["track_id"], records["frame"], records["codes"])
+        rates = {attr_name: float(rate) for attr_name, rate in zip(ATTRIBUTE_DEFINITIONS, stats["rates"])}
+        return rates, unstable_tracks(stats, limit=UNSTABLE_TRACK_LIMIT)
+
+    def _aggregate_in_db(self, task_id1: int, task_id2: int, kappa_weights: Optional[str] = None) -> Dict[str, Any]:
+        """
+        `run_quality_check` with the per-box work done by Postgres: the two tasks are self-joined on
+        (track_id, frame) and only IoU histogram bins, per-attribute confusion counts and per-track
+        flip counts come back. Results match the in-memory path.
+        """
+        params = {
+            "task_1": task_id1, "task_2": task_id2, "bins": IOU_HISTOGRAM_BINS,
+            "names": ATTRIBUTE_NAMES, "option_codes": psycopg2.extras.Json(OPTION_CODES),
+        }
+        threshold_counts = ", ".join(f"COUNT(*) FILTER (WHERE iou >= {float(t)})" for t in IOU_THRESHOLDS)
+        with self.conn.cursor() as cur:
+            cur.execute(_BOX_COUNTS_SQL, params)
+            if len(cur.fetchall()) < len({task_id1, task_id2}):
+                return {"error": "One or both tasks have no annotations in the database."}
+            cur.execute(_IOU_BINS_SQL.format(boxes=_CODED_BOXES_CTE, threshold_counts=threshold_counts), params)
+            bins = cur.fetchall()
+            cur.execute(_CONFUSION_SQL.format(boxes=_CODED_BOXES_CTE), params)
+            confusion_rows = cur.fetchall()
+            cur.execute(_TRACK_FLIPS_SQL.format(boxes=_CODED_BOXES_CTE), params)
+            flip_rows = cur.fetchall()
+
+        n_pairs = sum(row[1] for row in bins)
+        histogram = np.zeros(IOU_HISTOGRAM_BINS, dtype=np.int64)
+        for row in bins:
+            if 0 <= row[0] < IOU_HISTOGRAM_BINS:
+                histogram[row[0]] = row[1]
+        iou_stats = iou_summary_from_counts(
+            n_pairs, float(sum(row[2] for row in bins)),
+            [sum(row[3 + i] for row in bins) for i in range(len(IOU_THRESHOLDS))], histogram
+        )
+
+        sizes = [len(options) for options in VOCABULARY.values()]
+        matrices = np.zeros((len(sizes), max(sizes), max(sizes)))
+        for attr_idx, code_a, code_b, count in confusion_rows:
+            matrices[attr_idx, code_a, code_b] = count
+        # No aligned boxes scores 0.0, as on the in-memory path (cohen_kappa)
+        kappas = kappa_from_confusion(matrices, agreement_weights(sizes, kappa_weights)) if n_pairs else np.zeros(len(sizes))
+        kappa_scores = {attr_name: float(k) for attr_name, k in zip(VOCABULARY, kappas)}
+
+        flip_rates, unstable = {}, {}
+        for task_id, annotator in ((task_id1, "annotator_1"), (task_id2, "annotator_2")):
+            rows = [row[1:] for row in flip_rows if row[0] == task_id]
+            track_ids = np.array(sorted({row[0] for row in rows}), dtype=np.int64)
+            track_transitions = np.zeros(track_ids.size, dtype=np.int64)
+            track_flips = np.zeros((track_ids.size, len(sizes)), dtype=np.int64)
+            for track_id, attr_idx, transitions, flips in rows:
+                i = np.searchsorted(track_ids, track_id)
+                track_transitions[i] = transitions
+                track_flips[i, attr_idx] = flips
+            transitions = track_transitions.sum()
+            rates = track_flips.sum(axis=0) / transitions if transitions else np.zeros(len(sizes))
+            flip_rates[annotator] = {attr_name: float(rate) for attr_name, rate in zip(VOCABULARY, rates)}
+            stats = {"track_ids": track_ids, "track_transitions": track_transitions, "track_flips": track_flips}
+            unstable[annotator] = unstable_tracks(stats, limit=UNSTABLE_TRACK_LIMIT)
+
+        return {
+            **iou_stats,
+            "kappa_scores": kappa_scores,
+            "macro_avg_kappa": np.mean(list(kappa_scores.values())) if kappa_scores else 0.0,
+            "flip_rates": flip_rates,
+            "unstable_tracks": unstable,
+            "compared_annotations": int(n_pairs)
+        }
+
+    def run_quality_check(self, task_id1: int, task_id2: int, kappa_weights: Optional[str] = None,
+                          aggregate_in_db: bool = AGGREGATE_IN_DB, bootstrap_resamples: int = 0,
+                          bootstrap_seed: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Compares two annotators' tasks. `kappa_weights` may be "linear" or "quadratic" for ordinal attributes.
+        With `aggregate_in_db` the boxes stay in Postgres and only summary rows are fetched.
+        With `bootstrap_resamples` > 0 the result adds 95% track-cluster bootstrap intervals for
+        mean IoU and kappa (in-memory path only, as the intervals need the aligned boxes).
+        """
         self.connect_db()
         if not self.conn:
             return {"error": "Could not connect to the database."}
 
         try:
+            if aggregate_in_db:
+                return self._aggregate_in_db(task_id1, task_id2, kappa_weights)
             annotations = self._fetch_annotations_for_tasks([task_id1, task_id2])
-            annotations1 = annotations.get(task_id1, {})
-            annotations2 = annotations.get(task_id2, {})
+            annotations1 = annotations.get(task_id1, EMPTY_ANNOTATIONS)
+            annotations2 = annotations.get(task_id2, EMPTY_ANNOTATIONS)
 
-            if not annotations1 or not annotations2:
+            if not annotations1.size or not annotations2.size:
                 return {"error": "One or both tasks have no annotations in the database."}
 
-            # --- IoU Calculation ---
-            iou_scores = []
-            common_keys = set(annotations1.keys()) & set(annotations2.keys())
-            for key in common_keys:
-                iou_scores.append(self._calculate_iou(annotations1[key]['box'], annotations2[key]['box']))
-
-            avg_iou = np.mean(iou_scores) if iou_scores else 0.0
-            percent_iou_gte_05 = np.mean([1 if s >= 0.5 else 0 for s in iou_scores]) if iou_scores else 0.0
+            # --- IoU Calculation (one vectorized pass over the aligned boxes) ---
+            keys1, boxes1 = self._to_arrays(annotations1)
+            keys2, boxes2 = self._to_arrays(annotations2)
+            idx1, idx2 = align_by_key(keys1, keys2)
+            ious = aligned_iou(boxes1[idx1], boxes2[idx2])
+            iou_stats = iou_summary(ious)
 
-            # --- Kappa Calculation ---
-            kappa_scores = {}
-            for attr_name, attr_info in ATTRIBUTE_DEFINITIONS.items():
-                kappa_scores[attr_name] = self._calculate_cohens_kappa(annotations1, annotations2, attr_name, attr_info['options'])
+            # --- Kappa Calculation (labels encoded once, all attributes in one bincount) ---
+            codes1, codes2 = annotations1["codes"], annotations2["codes"]
+            kappa_scores = self._calculate_cohens_kappa(codes1[idx1], codes2[idx2], weights=kappa_weights)
             macro_avg_kappa = np.mean(list(kappa_scores.values())) if kappa_scores else 0.0
 
             # --- Flip Rate Calculation ---
-            flip_rate1 = self._calculate_flip_rate(annotations1)
-            flip_rate2 = self._calculate_flip_rate(annotations2)
+            flip_rate1, unstable1 = self._calculate_flip_rate(annotations1)
+            flip_rate2, unstable2 = self._calculate_flip_rate(annotations2)
 
-            return {
-                "average_iou": avg_iou,
-                "percent_iou_gte_05": percent_iou_gte_05,
+            results = {
+                **iou_stats,
                 "kappa_scores": kappa_scores,
                 "macro_avg_kappa": macro_avg_kappa,
                 "flip_rates": {"annotator_1": flip_rate1, "annotator_2": flip_rate2},
-                "compared_annotations": len(common_keys)
+                "unstable_tracks": {"annotator_1": unstable1, "annotator_2": unstable2},
+                "compared_annotations": int(idx1.size)
+            }
+
+            # --- Bootstrap Confidence Intervals (tracks resampled as clusters) ---
+            if bootstrap_resamples > 0:
+                sizes = [len(options) for options in VOCABULARY.values()]
+                intervals = cluster_bootstrap(annotations1["track_id"][idx1], ious, codes1[idx1], codes2[idx2], sizes,
+                                              kappa_weights, bootstrap_resamples, bootstrap_seed)
+                results["confidence_intervals"] = {
+                    "average_iou": intervals["average_iou"],
+                    "kappa_scores": {attr_name: tuple(ci.tolist()) for attr_name, ci in zip(VOCABULARY, intervals["kappa"])},
+                    "macro_avg_kappa": intervals["macro_avg_kappa"],
+                    "n_resamples": intervals["n_resamples"],
+                    "clusters": intervals["clusters"],
+                }
+            return results
+        finally:
+            self.close_db()
+
+    def run_multi_rater_check(self, task_ids: List[int]) -> Dict[str, Any]:
+        """Fleiss' kappa, Krippendorff's alpha and mean pairwise IoU across any number of annotators."""
+        self.connect_db()
+        if not self.conn:
+            return {"error": "Could not connect to the database."}
+
+        try:
+            annotations = self._fetch_annotations_for_tasks(task_ids)
+            if any(t not in annotations for t in task_ids):
+                return {"error": "One or more tasks have no annotations in the database."}
+
+            keys, codes, boxes = [], [], []
+            for task_id in task_ids:
+                task_keys, task_boxes = self._to_arrays(annotations[task_id])
+                keys.append(task_keys)
+                boxes.append(task_boxes)
+                codes.append(annotations[task_id]["codes"])
+            agreement = multi_rater_agreement(keys, codes, boxes, [len(options) for options in VOCABULARY.values()])
+
+            fleiss = dict(zip(VOCABULARY, agreement["fleiss_kappa"].tolist()))
+            alpha = dict(zip(VOCABULARY, agreement["krippendorff_alpha"].tolist()))
+            return {
+                "task_ids": list(task_ids),
+                "fleiss_kappa": fleiss,
+                "krippendorff_alpha": alpha,
+                "macro_fleiss_kappa": float(np.mean(list(fleiss.values()))),
+                "macro_krippendorff_alpha": float(np.mean(list(alpha.values()))),
+                "mean_pairwise_iou": agreement["mean_pairwise_iou"],
+                "pairwise_iou": agreement["pairwise_iou"].tolist(),
+                "compared_annotations": agreement["units"],
+                "annotations_all_raters": agreement["units_all_raters"],
             }
         finally:
             self.close_db()
@@ -0,0 +1,176 @@
+# services/reliability.py
+
+# Per-annotator reliability maintained incrementally: every scored overlap pair adds its
+# contribution to running sums with an additive UPSERT, so no QC history is ever rescanned and
+# an annotator's standing is a primary-key lookup. Each pair's last contribution is kept in a
+# ledger; re-scoring a pair applies only the difference.
+import logging
+from typing import Dict, Any, List, Optional
+import psycopg2.extras
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# First key of the per-pair advisory lock (see partitioning.PARTITION_LOCK_ID)
+RELIABILITY_LOCK_ID = 727_048
+
+
+def pair_contribution(assignee1: Optional[str], assignee2: Optional[str], matched_pairs: int, mean_iou: float,
+                      kappa_scores: Dict[str, float], flip_rates1: Dict[str, float],
+                      flip_rates2: Dict[str, float]) -> Dict[str, Any]:
+    """
+    What one scored pair adds for each of its annotators: one overlap, the matched boxes and their
+    IoU sum against the peer, and per attribute the pair's kappa and the annotator's own flip rate.
+    Unassigned tasks contribute nothing, and neither do two tasks of the same annotator: that is
+    not an inter-annotator comparison and would credit one overlap twice.
+    """
+    contribution = {}
+    if assignee1 == assignee2:
+        return contribution
+    for annotator, flip_rates in ((assignee1, flip_rates1), (assignee2, flip_rates2)):
+        if not annotator:
+            continue
+        entry = contribution.setdefault(annotator, {"overlaps": 0, "boxes": 0, "iou_sum": 0.0, "attributes": {}})
+        entry["overlaps"] += 1
+        entry["boxes"] += int(matched_pairs)
+        entry["iou_sum"] += float(mean_iou) * int(matched_pairs)
+        for attribute in kappa_scores.keys() | flip_rates.keys():
+            stats = entry["attributes"].setdefault(attribute, {"overlaps": 0, "kappa_sum": 0.0, "flip_rate_sum": 0.0})
+            stats["overlaps"] += 1
+            stats["kappa_sum"] += float(kappa_scores.get(attribute, 0.0))
+            stats["flip_rate_sum"] += float(flip_rates.get(attribute, 0.0))
+    return contribution
+
+
+def _difference(new: Dict[str, Any], old: Dict[str, Any]) -> Dict[str, Any]:
+    """new - old, field by field, over the union of annotators and attributes."""
+    delta = {}
+    for annotator in new.keys() | old.keys():
+        a, b = new.get(annotator, {}), old.get(annotator, {})
+        attributes = {}
+        for attribute in a.get("attributes", {}).keys() | b.get("attributes", {}).keys():
+            x, y = a.get("attributes", {}).get(attribute, {}), b.get("attributes", {}).get(attribute, {})
+            attributes[attribute] = {k: x.get(k, 0) - y.get(k, 0) for k in ("overlaps", "kappa_sum", "flip_rate_sum")}
+        delta[annotator] = {k: a.get(k, 0) - b.get(k, 0) for k in ("overlaps", "boxes", "iou_sum")}
+        delta[annotator]["attributes"] = attributes
+    return delta
+
+
+class AnnotatorReliability:
+    """Reads and updates `annotator_reliability` and `annotator_attribute_reliability` on the caller's connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def record_pair(self, task_id1: int, task_id2: int, version1: Optional[str], version2: Optional[str],
+                    contribution: Dict[str, Any]) -> bool:
+        """
+        Adds a scored pair's contribution, or the change since the pair was last recorded, and commits.
+        Returns False when the pair was already recorded at these annotation versions with the same
+        contribution.
+        """
+        t1, t2 = sorted((task_id1, task_id2))
+        if (t1, t2) != (task_id1, task_id2):
+            version1, version2 = version2, version1
+        with self.conn.cursor() as cur:
+            # Serialises concurrent scorings of the same pair so each delta is taken against the latest ledger row
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (RELIABILITY_LOCK_ID, f"{t1}:{t2}"))
+            cur.execute(
+                "SELECT version_1, version_2, contribution FROM annotator_reliability_pairs "
+                "WHERE task_id_1 = %s AND task_id_2 = %s;",
+                (t1, t2)
+            )
+            previous = cur.fetchone()
+            if previous and previous[0] is not None and (previous[0], previous[1]) == (version1, version2) \
+                    and previous[2] == contribution:
+                self.conn.rollback()
+                return False
+            delta = _difference(contribution, previous[2] if previous else {})
+
+            cur.execute(
+                """
+                INSERT INTO annotator_reliability_pairs (task_id_1, task_id_2, version_1, version_2, contribution)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (task_id_1, task_id_2) DO UPDATE SET
+                    version_1 = EXCLUDED.version_1, version_2 = EXCLUDED.version_2,
+                    contribution = EXCLUDED.contribution, scored_at = CURRENT_TIMESTAMP;
+                """,
+                (t1, t2, version1, version2, psycopg2.extras.Json(contribution))
+            )
+            if delta:
+                psycopg2.extras.execute_values(
+                    cur,
+                    """
+                    INSERT INTO annotator_reliability (annotator, overlaps_compared, boxes_compared, iou_sum) VALUES %s
+                    ON CONFLICT (annotator) DO UPDATE SET
+                        overlaps_compared = annotator_reliability.overlaps_compared + EXCLUDED.overlaps_compared,
+                        boxes_compared = annotator_reliability.boxes_compared + EXCLUDED.boxes_compared,
+                        iou_sum = annotator_reliability.iou_sum + EXCLUDED.iou_sum,
+                        updated_at = CURRENT_TIMESTAMP;
+                    """,
+                    [(annotator, d["overlaps"], d["boxes"], d["iou_sum"]) for annotator, d in delta.items()]
+                )
+            attribute_rows = [
+                (annotator, attribute, s["overlaps"], s["kappa_sum"], s["flip_rate_sum"])
+                for annotator, d in delta.items() for attribute, s in d["attributes"].items()
+            ]
+            if attribute_rows:
+                psycopg2.extras.execute_values(
+                    cur,
+                    """
+                    INSERT INTO annotator_attribute_reliability (annotator, attribute, overlaps_compared, kappa_sum, flip_rate_sum)
+                    VALUES %s
+                    ON CONFLICT (annotator, attribute) DO UPDATE SET
+                        overlaps_compared = annotator_attribute_reliability.overlaps_compared + EXCLUDED.overlaps_compared,
+                        kappa_sum = annotator_attribute_reliability.kappa_sum + EXCLUDED.kappa_sum,
+                        flip_rate_sum = annotator_attribute_reliability.flip_rate_sum + EXCLUDED.flip_rate_sum;
+                    """,
+                    attribute_rows
+                )
+        self.conn.commit()
+        return True
+
+    def get(self, annotator: str) -> Optional[Dict[str, Any]]:
+        """One annotator's reliability: overlaps, mean IoU against peers, and mean kappa and flip rate per attribute."""
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "SELECT overlaps_compared, boxes_compared, iou_sum FROM annotator_reliability WHERE annotator = %s;",
+                (annotator,)
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+            cur.execute(
+                "SELECT attribute, overlaps_compared, kappa_sum, flip_rate_sum FROM annotator_attribute_reliability "
+                "WHERE annotator = %s AND overlaps_compared > 0 ORDER BY attribute;",
+                (annotator,)
+            )
+            attributes = cur.fetchall()
+        overlaps, boxes, iou_sum = row
+        return {
+            "annotator": annotator,
+            "overlaps_compared": overlaps,
+            "boxes_compared": boxes,
+            "mean_iou": iou_sum / boxes if boxes else 0.0,
+            "kappa": {attribute: kappa_sum / n for attribute, n, kappa_sum, _ in attributes},
+            "flip_rate": {attribute: flip_sum / n for attribute, n, _, flip_sum in attributes},
+        }
+
+    def scoreboard(self) -> List[Dict[str, Any]]:
+        """Every annotator with at least one overlap, lowest mean IoU first."""
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT r.annotator, r.overlaps_compared, r.boxes_compared,
+                       r.iou_sum / NULLIF(r.boxes_compared, 0) AS mean_iou,
+                       SUM(a.kappa_sum) / NULLIF(SUM(a.overlaps_compared), 0) AS mean_kappa,
+                       SUM(a.flip_rate_sum) / NULLIF(SUM(a.overlaps_compared), 0) AS mean_flip_rate
+                FROM annotator_reliability r
+                LEFT JOIN annotator_attribute_reliability a ON a.annotator = r.annotator
+                WHERE r.overlaps_compared > 0
+                GROUP BY r.annotator, r.overlaps_compared, r.boxes_compared, r.iou_sum
+                ORDER BY mean_iou NULLS FIRST, r.annotator;
+                """
+            )
+            columns = [c[0] for c in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
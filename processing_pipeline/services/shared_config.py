@@ -27,4 +27,22 @@ ATTRIBUTE_DEFINITIONS = {
     'time_context': {
         'options': ['unknown', 'rush_hour', 'leisure_time', 'shopping_time', 'tourist_hours', 'lunch_break', 'evening_stroll']
     }
-}
\ No newline at end of file
+}
+
+# Compiled option index, derived once from ATTRIBUTE_DEFINITIONS. Attribute code arrays follow
+# ATTRIBUTE_NAMES order and hold each value's option index; MISSING_OPTION_CODE marks an attribute
+# that is absent or whose value is not one of its options.
+ATTRIBUTE_NAMES = list(ATTRIBUTE_DEFINITIONS)
+OPTION_CODES = {name: {option: i for i, option in enumerate(info['options'])} for name, info in ATTRIBUTE_DEFINITIONS.items()}
+MISSING_OPTION_CODE = -1
+
+
+def attribute_codes(attributes: dict) -> list:
+    return [OPTION_CODES[name].get(attributes.get(name), MISSING_OPTION_CODE) for name in ATTRIBUTE_NAMES]
+
+
+def attributes_from_codes(codes) -> dict:
+    return {
+        name: ATTRIBUTE_DEFINITIONS[name]['options'][code]
+        for name, code in zip(ATTRIBUTE_NAMES, codes) if code is not None and code >= 0
+    }
@@ -0,0 +1,338 @@
+import argparse
+import logging
+import os
+import random
+import socket
+import sys
+import time
+from typing import Dict, Any, Optional
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from processing_pipeline.services.cvat_integration import CVATClient
+from processing_pipeline.services.migrations import check_schema
+from processing_pipeline.services.post_annotation_service import (
+    PostAnnotationService, DB_PARAMS, CVAT_HOST, CVAT_USERNAME, CVAT_PASSWORD
+)
+
+# --------------------- Logging ---------------------
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# --------------------- Queue Settings ---------------------
+MAX_ATTEMPTS = int(os.getenv("SYNC_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE_SECONDS = float(os.getenv("SYNC_BACKOFF_BASE_SECONDS", "10"))
+BACKOFF_MAX_SECONDS = float(os.getenv("SYNC_BACKOFF_MAX_SECONDS", "900"))
+LEASE_SECONDS = int(os.getenv("SYNC_LEASE_SECONDS", "1800"))
+POLL_INTERVAL_SECONDS = float(os.getenv("SYNC_POLL_INTERVAL_SECONDS", "2"))
+
+# --------------------- SyncJobQueue ---------------------
+class SyncJobQueue:
+    """
+    Durable queue of CVAT task syncs stored in the `sync_jobs` table.
+
+    Jobs move pending -> running -> done. A failed job goes back to pending with an
+    exponential backoff until it runs out of attempts, after which it is parked as 'dead'.
+    A task has at most one pending job: when a webhook re-enqueued the task while its job was
+    running, a failed or stale job is folded into that pending job and marked 'superseded'.
+    Workers claim jobs with FOR UPDATE SKIP LOCKED, so any number of processes or nodes
+    can drain the queue without processing the same job twice.
+    """
+
+    def __init__(self, db_params: Dict[str, Any], max_attempts: int = MAX_ATTEMPTS):
+        self.db_params = db_params
+        self.max_attempts = max_attempts
+        self.conn = None
+
+    def connect_db(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.db_params)
+            # Each queue operation is its own short transaction.
+            self.conn.autocommit = True
+        return self.conn
+
+    def close_db(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def enqueue(self, task_id: int, assignee: str = "N/A") -> int:
+        """Adds a sync for `task_id`. A task already waiting in the queue is coalesced into one job."""
+        with self.connect_db().cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO sync_jobs (task_id, assignee, max_attempts)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (task_id) WHERE status = 'pending'
+                DO UPDATE SET assignee = EXCLUDED.assignee, run_after = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                RETURNING job_id;
+                """,
+                (task_id, assignee, self.max_attempts)
+            )
+            job_id = cur.fetchone()[0]
+        logger.info(f"✓ Enqueued sync job {job_id} for task {task_id}.")
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Claims the next runnable job, skipping rows other workers have locked and tasks already being synced."""
+        with self.connect_db().cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                WITH next_job AS (
+                    SELECT j.job_id FROM sync_jobs j
+                    WHERE j.status = 'pending' AND j.run_after <= CURRENT_TIMESTAMP
+                      AND NOT EXISTS (
+                          SELECT 1 FROM sync_jobs r WHERE r.task_id = j.task_id AND r.status = 'running'
+                      )
+                    ORDER BY j.run_after, j.job_id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                UPDATE sync_jobs s
+                SET status = 'running', attempts = s.attempts + 1, locked_by = %s,
+                    locked_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                FROM next_job WHERE s.job_id = next_job.job_id
+                RETURNING s.job_id, s.task_id, s.assignee, s.attempts, s.max_attempts;
+                """,
+                (worker_id,)
+            )
+            row = cur.fetchone()
+        return dict(row) if row else None
+
+    def complete(self, job_id: int, result: Optional[Dict[str, Any]] = None):
+        with self.connect_db().cursor() as cur:
+            cur.execute(
+                """
+                UPDATE sync_jobs SET status = 'done', locked_by = NULL, locked_at = NULL, last_error = NULL,
+                    result = %s, finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = %s;
+                """,
+                (psycopg2.extras.Json(result) if result is not None else None, job_id)
+            )
+
+    def _execute_merging(self, sql: str, params: Dict[str, Any]):
+        """
+        Runs a statement that either returns a job to pending or merges it into the task's pending
+        job. A webhook enqueueing the task between the statement's snapshot and its write hits the
+        one-pending-per-task index; the retry then sees that job and merges.
+        """
+        for attempt in range(3):
+            try:
+                with self.connect_db().cursor() as cur:
+                    cur.execute(sql, params)
+                    return cur.fetchall()
+            except psycopg2.errors.UniqueViolation:
+                if attempt == 2:
+                    raise
+                logger.info("Task re-enqueued concurrently; merging into its pending sync job.")
+
+    def fail(self, job: Dict[str, Any], error: str) -> str:
+        """
+        Schedules a retry with exponential backoff, or dead-letters the job once attempts are exhausted.
+        A retry for a task that already has a pending job is merged into it (attempts and backoff carried
+        over) and this job is marked 'superseded'.
+        """
+        if job["attempts"] >= job["max_attempts"]:
+            status, delay = "dead", 0.0
+        else:
+            status = "pending"
+            delay = min(BACKOFF_BASE_SECONDS * (2 ** (job["attempts"] - 1)), BACKOFF_MAX_SECONDS)
+            delay *= random.uniform(0.8, 1.2)
+
+        rows = self._execute_merging(
+            """
+            WITH merged AS (
+                UPDATE sync_jobs SET attempts = GREATEST(attempts, %(attempts)s),
+                    run_after = GREATEST(run_after, CURRENT_TIMESTAMP + make_interval(secs => %(delay)s)),
+                    last_error = %(error)s, updated_at = CURRENT_TIMESTAMP
+                WHERE task_id = %(task_id)s AND status = 'pending' AND %(status)s = 'pending'
+                RETURNING job_id
+            )
+            UPDATE sync_jobs
+            SET status = CASE WHEN EXISTS (SELECT 1 FROM merged) THEN 'superseded' ELSE %(status)s END,
+                locked_by = NULL, locked_at = NULL, last_error = %(error)s,
+                run_after = CURRENT_TIMESTAMP + make_interval(secs => %(delay)s), updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN %(status)s = 'pending' AND NOT EXISTS (SELECT 1 FROM merged)
+                                   THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE job_id = %(job_id)s
+            RETURNING status;
+            """,
+            {"status": status, "error": error, "delay": delay, "attempts": job["attempts"],
+             "task_id": job["task_id"], "job_id": job["job_id"]}
+        )
+        status = rows[0][0] if rows else status
+        if status == "dead":
+            logger.error(f"✗ Sync job {job['job_id']} for task {job['task_id']} moved to dead-letter: {error}")
+        elif status == "superseded":
+            logger.warning(f"Sync job {job['job_id']} for task {job['task_id']} failed (attempt {job['attempts']}); "
+                           f"merged into the task's pending job.")
+        else:
+            logger.warning(f"Sync job {job['job_id']} for task {job['task_id']} failed (attempt {job['attempts']}), retrying in {delay:.0f}s.")
+        return status
+
+    def requeue_stale(self, lease_seconds: int = LEASE_SECONDS) -> int:
+        """
+        Returns jobs whose worker died mid-sync to the queue. A stale job whose task already has a
+        pending job is merged into it and marked 'superseded', like a failed retry.
+        """
+        rows = self._execute_merging(
+            """
+            WITH stale AS (
+                SELECT job_id, task_id, attempts FROM sync_jobs
+                WHERE status = 'running' AND locked_at < CURRENT_TIMESTAMP - make_interval(secs => %(lease)s)
+                FOR UPDATE SKIP LOCKED
+            ),
+            ranked AS (
+                SELECT job_id, task_id, row_number() OVER (PARTITION BY task_id ORDER BY job_id DESC) AS rn FROM stale
+            ),
+            merged AS (
+                UPDATE sync_jobs p SET attempts = GREATEST(p.attempts, s.attempts), updated_at = CURRENT_TIMESTAMP
+                FROM (SELECT task_id, MAX(attempts) AS attempts FROM stale GROUP BY task_id) s
+                WHERE p.task_id = s.task_id AND p.status = 'pending'
+                RETURNING p.task_id
+            )
+            UPDATE sync_jobs j
+            SET status = CASE WHEN r.rn > 1 OR r.task_id IN (SELECT task_id FROM merged) THEN 'superseded'
+                              ELSE 'pending' END,
+                locked_by = NULL, locked_at = NULL, last_error = 'lease expired', updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN r.rn > 1 OR r.task_id IN (SELECT task_id FROM merged)
+                                   THEN CURRENT_TIMESTAMP ELSE NULL END
+            FROM ranked r
+            WHERE j.job_id = r.job_id
+            RETURNING j.job_id;
+            """,
+            {"lease": lease_seconds}
+        )
+        return len(rows)
+
+    def retry_dead(self, job_id: int) -> bool:
+        """
+        Moves a dead-lettered job back to pending with a fresh attempt budget. If its task already has
+        a pending job, that job gets the fresh budget instead and the dead job is marked 'superseded'.
+        """
+        rows = self._execute_merging(
+            """
+            WITH dead AS (
+                SELECT job_id, task_id FROM sync_jobs WHERE job_id = %(job_id)s AND status = 'dead' FOR UPDATE
+            ),
+            merged AS (
+                UPDATE sync_jobs p SET attempts = 0, run_after = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                FROM dead d WHERE p.task_id = d.task_id AND p.status = 'pending'
+                RETURNING p.job_id
+            )
+            UPDATE sync_jobs j
+            SET status = CASE WHEN EXISTS (SELECT 1 FROM merged) THEN 'superseded' ELSE 'pending' END,
+                attempts = CASE WHEN EXISTS (SELECT 1 FROM merged) THEN j.attempts ELSE 0 END,
+                run_after = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN EXISTS (SELECT 1 FROM merged) THEN CURRENT_TIMESTAMP ELSE NULL END
+            FROM dead d
+            WHERE j.job_id = d.job_id
+            RETURNING j.job_id;
+            """,
+            {"job_id": job_id}
+        )
+        return len(rows) == 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.connect_db().cursor() as cur:
+            cur.execute("SELECT status, COUNT(*) FROM sync_jobs GROUP BY status;")
+            counts = {status: count for status, count in cur.fetchall()}
+            cur.execute(
+                """
+                SELECT
+                    EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(created_at) FILTER (WHERE status = 'pending')),
+                    AVG(EXTRACT(EPOCH FROM finished_at - created_at)) FILTER (
+                        WHERE status = 'done' AND finished_at > CURRENT_TIMESTAMP - INTERVAL '1 hour'
+                    ),
+                    COUNT(*) FILTER (WHERE status = 'done' AND finished_at > CURRENT_TIMESTAMP - INTERVAL '1 hour')
+                FROM sync_jobs;
+                """
+            )
+            oldest_pending, avg_latency, done_last_hour = cur.fetchone()
+        return {
+            "counts": {s: counts.get(s, 0) for s in ("pending", "running", "done", "dead", "superseded")},
+            "oldest_pending_seconds": float(oldest_pending) if oldest_pending is not None else None,
+            "avg_sync_latency_seconds_1h": float(avg_latency) if avg_latency is not None else None,
+            "done_last_hour": done_last_hour,
+        }
+
+
+# --------------------- Worker ---------------------
+class SyncWorker:
+    def __init__(self, queue: SyncJobQueue, service: PostAnnotationService, worker_id: Optional[str] = None):
+        self.queue = queue
+        self.service = service
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.stats = {"processed": 0, "succeeded": 0, "retried": 0, "dead": 0}
+
+    def run_once(self) -> bool:
+        """Processes a single job. Returns False when the queue had nothing runnable."""
+        job = self.queue.claim(self.worker_id)
+        if not job:
+            return False
+
+        logger.info(f"[{self.worker_id}] Claimed sync job {job['job_id']} for task {job['task_id']} (attempt {job['attempts']}).")
+        start = time.time()
+        try:
+            ok = self.service.process_and_store_task(task_id=job["task_id"], provided_assignee=job["assignee"] or "N/A")
+            error = None if ok else "sync returned failure"
+        except Exception as e:
+            ok, error = False, str(e)
+
+        self.stats["processed"] += 1
+        if ok:
+            self.queue.complete(job["job_id"], self.service.last_sync_counts)
+            self.stats["succeeded"] += 1
+            logger.info(f"✓ Sync job {job['job_id']} finished in {time.time() - start:.1f}s.")
+        else:
+            status = self.queue.fail(job, error)
+            # A superseded job's retry lives on in the task's pending job
+            self.stats["dead" if status == "dead" else "retried"] += 1
+        return True
+
+    def run_forever(self, poll_interval: float = POLL_INTERVAL_SECONDS):
+        logger.info(f"Sync worker {self.worker_id} started.")
+        last_reap = 0.0
+        while True:
+            try:
+                if time.time() - last_reap > 60:
+                    reaped = self.queue.requeue_stale()
+                    if reaped:
+                        logger.warning(f"Requeued {reaped} stale sync job(s).")
+                    last_reap = time.time()
+                if not self.run_once():
+                    time.sleep(poll_interval)
+            except psycopg2.Error as e:
+                logger.error(f"Queue database error: {e}")
+                self.queue.close_db()
+                time.sleep(poll_interval)
+
+
+# --------------------- CLI ---------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run or inspect the durable CVAT sync job queue.")
+    parser.add_argument("--metrics", action="store_true", help="Print queue metrics and exit.")
+    parser.add_argument("--retry-dead", type=int, metavar="JOB_ID", help="Move a dead-lettered job back to pending.")
+    parser.add_argument("--once", action="store_true", help="Process at most one job and exit.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    check_schema(DB_PARAMS)
+    queue = SyncJobQueue(DB_PARAMS)
+
+    if args.metrics:
+        print(queue.metrics())
+    elif args.retry_dead is not None:
+        print("requeued" if queue.retry_dead(args.retry_dead) else "not found or not dead")
+    else:
+        cvat_client = CVATClient(host=CVAT_HOST, username=CVAT_USERNAME, password=CVAT_PASSWORD)
+        if not cvat_client.authenticated:
+            sys.exit("CVAT authentication failed; worker not started.")
+        worker = SyncWorker(queue, PostAnnotationService(db_params=DB_PARAMS, cvat_client=cvat_client))
+        if args.once:
+            worker.run_once()
+        else:
+            worker.run_forever()
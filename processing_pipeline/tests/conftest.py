@@ -0,0 +1,6 @@
+# tests/conftest.py
+import os
+import sys
+
+# Same import root as the services: `processing_pipeline.services.<module>`
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
@@ -0,0 +1,261 @@
+# tests/test_agreement_metrics.py
+import numpy as np
+import pytest
+
+from processing_pipeline.services.agreement_metrics import (
+    confusion_matrices, cohen_kappa, pairwise_kappa, kappa_from_confusion, agreement_weights,
+    fleiss_kappa, krippendorff_alpha, stack_raters, multi_rater_agreement, track_frame_keys,
+    iou_matrix, match_boxes, overlap_candidates, match_boxes_pruned, SWEEP_MIN_PAIRS, cluster_bootstrap
+)
+
+SIZES = [2, 3, 4]
+
+
+def test_confusion_matrices_empty_overlap():
+    empty = np.empty((0, len(SIZES)), dtype=np.int64)
+    matrices = confusion_matrices(empty, empty, max(SIZES))
+    assert matrices.shape == (3, 4, 4)
+    assert not matrices.any()
+
+
+def test_confusion_matrices_empty_1d_with_explicit_attribute_count():
+    empty = np.empty(0, dtype=np.int64)
+    assert confusion_matrices(empty, empty, 4, n_attrs=3).shape == (3, 4, 4)
+
+
+def test_confusion_matrices_skips_missing_labels():
+    a = np.array([[0, 1], [1, -1], [1, 2]])
+    b = np.array([[0, 1], [0, 2], [-1, 2]])
+    matrices = confusion_matrices(a, b, 3)
+    assert matrices[0].tolist() == [[1, 0, 0], [1, 0, 0], [0, 0, 0]]
+    assert matrices[1].tolist() == [[0, 0, 0], [0, 1, 0], [0, 0, 1]]
+
+
+def test_cohen_kappa_empty_overlap_scores_zero():
+    empty = np.empty((0, len(SIZES)), dtype=np.int64)
+    assert cohen_kappa(empty, empty, SIZES).tolist() == [0.0, 0.0, 0.0]
+    assert cohen_kappa(empty, empty, SIZES, weights="quadratic").tolist() == [0.0, 0.0, 0.0]
+
+
+def test_cohen_kappa_matches_hand_computed_value():
+    # p_o = 0.75; marginals (0.5, 0.5) and (0.25, 0.75) give p_e = 0.5
+    a = np.array([[0], [0], [1], [1]])
+    b = np.array([[0], [1], [1], [1]])
+    assert cohen_kappa(a, b, [2]) == pytest.approx([0.5])
+
+
+def test_cohen_kappa_perfect_and_degenerate():
+    a = np.array([[0, 1], [1, 1], [2, 1]])
+    kappas = cohen_kappa(a, a, [3, 2])
+    # Attribute 0 agrees perfectly; attribute 1 has a single label, so chance agreement is 1
+    assert kappas[0] == pytest.approx(1.0)
+    assert kappas[1] == 1.0
+    assert cohen_kappa(a, a, [3, 2], degenerate=0.0)[1] == 0.0
+
+
+def test_cohen_kappa_rows_without_valid_labels_are_degenerate():
+    a = np.full((3, 1), -1)
+    assert cohen_kappa(a, a, [2]).tolist() == [1.0]
+    assert cohen_kappa(a, a, [2], degenerate=0.0).tolist() == [0.0]
+
+
+def test_weighted_kappa_credits_near_misses():
+    a = np.array([[0], [1], [2], [3], [0], [3]])
+    b = np.array([[1], [2], [3], [3], [0], [2]])
+    plain, linear, quadratic = (cohen_kappa(a, b, [4], weights=w)[0] for w in (None, "linear", "quadratic"))
+    assert plain < linear < quadratic
+
+
+def test_kappa_from_confusion_empty_table_is_degenerate():
+    matrices = np.zeros((2, 3, 3))
+    assert kappa_from_confusion(matrices, agreement_weights([3, 3]), degenerate=0.5).tolist() == [0.5, 0.5]
+
+
+def test_pairwise_kappa_is_mean_of_pairs_and_handles_empty_rows():
+    rng = np.random.default_rng(0)
+    raters = [rng.integers(0, 3, size=(50, 2)) for _ in range(3)]
+    expected = np.mean([cohen_kappa(raters[i], raters[j], [3, 3]) for i, j in ((0, 1), (0, 2), (1, 2))], axis=0)
+    assert pairwise_kappa(raters, [3, 3]) == pytest.approx(expected)
+
+    empty = [np.empty((0, 2), dtype=np.int64)] * 3
+    assert pairwise_kappa(empty, [3, 3], degenerate=0.0).tolist() == [0.0, 0.0]
+
+
+# Fleiss (1971) as tabulated on Wikipedia: 10 subjects, 14 raters, 5 categories, kappa = 0.210
+FLEISS_TABLE = [[0, 0, 0, 0, 14], [0, 2, 6, 4, 2], [0, 0, 3, 5, 6], [0, 3, 9, 2, 0], [2, 2, 8, 1, 1],
+                [7, 7, 0, 0, 0], [3, 2, 6, 3, 0], [2, 5, 3, 2, 2], [6, 5, 2, 1, 0], [0, 2, 2, 3, 7]]
+# Krippendorff (2011), 4 coders x 12 units with missing values, nominal alpha = 0.743
+KRIPPENDORFF_CODERS = [[1, 2, 3, 3, 2, 1, 4, 1, 2, None, None, None],
+                       [1, 2, 3, 3, 2, 2, 4, 1, 2, 5, None, 3],
+                       [None, 3, 3, 3, 2, 3, 4, 2, 2, 5, 1, None],
+                       [1, 2, 3, 3, 2, 4, 4, 1, 2, 5, 1, None]]
+
+
+def reference_fleiss(counts):
+    """Textbook Fleiss' kappa, one unit at a time, over units rated at least twice."""
+    units = [row for row in counts if row.sum() >= 2]
+    if not units:
+        return None
+    observed = np.mean([(row * (row - 1)).sum() / (row.sum() * (row.sum() - 1)) for row in units])
+    shares = np.sum(units, axis=0) / np.sum(units)
+    expected = (shares ** 2).sum()
+    return (observed - expected) / (1 - expected)
+
+
+def reference_alpha(counts):
+    """Nominal alpha from explicitly enumerated pairable value pairs, each weighted 1 / (m_u - 1)."""
+    k = counts.shape[-1]
+    coincidence = np.zeros((k, k))
+    for row in counts:
+        values = np.repeat(np.arange(k), row.astype(int))
+        if values.size < 2:
+            continue
+        for i in range(values.size):
+            for j in range(values.size):
+                if i != j:
+                    coincidence[values[i], values[j]] += 1 / (values.size - 1)
+    n = coincidence.sum()
+    marginals = coincidence.sum(axis=1)
+    disagreement = n - np.trace(coincidence)
+    return 1 - (n - 1) * disagreement / (n ** 2 - (marginals ** 2).sum())
+
+
+def random_counts(rng, n_units=40, n_raters=5, k=4):
+    """Unit x category counts with a shared true label per unit and some raters missing."""
+    truth = rng.integers(0, k, n_units)
+    ratings = np.where(rng.random((n_raters, n_units)) < 0.7, truth, rng.integers(0, k, (n_raters, n_units)))
+    present = rng.random((n_raters, n_units)) < 0.8
+    counts = np.zeros((n_units, k))
+    for r in range(n_raters):
+        np.add.at(counts, (np.flatnonzero(present[r]), ratings[r][present[r]]), 1)
+    return counts
+
+
+def test_fleiss_kappa_matches_published_example():
+    assert fleiss_kappa(np.array(FLEISS_TABLE, dtype=np.float64)[None])[0] == pytest.approx(0.2099, abs=1e-4)
+
+
+def test_krippendorff_alpha_matches_published_example():
+    counts = np.zeros((1, 12, 5))
+    for coder in KRIPPENDORFF_CODERS:
+        for unit, value in enumerate(coder):
+            if value is not None:
+                counts[0, unit, value - 1] += 1
+    assert krippendorff_alpha(counts)[0] == pytest.approx(0.743, abs=1e-3)
+
+
+def test_fleiss_and_alpha_match_unit_by_unit_references():
+    rng = np.random.default_rng(4)
+    counts = np.stack([random_counts(rng) for _ in range(3)])
+    assert fleiss_kappa(counts) == pytest.approx([reference_fleiss(c) for c in counts])
+    assert krippendorff_alpha(counts) == pytest.approx([reference_alpha(c) for c in counts])
+
+
+def test_fleiss_and_alpha_without_pairable_units_are_degenerate():
+    counts = np.zeros((2, 3, 4))
+    counts[:, :, 1] = 1
+    assert fleiss_kappa(counts, degenerate=0.0).tolist() == [0.0, 0.0]
+    assert krippendorff_alpha(counts, degenerate=0.0).tolist() == [0.0, 0.0]
+
+
+def test_stack_raters_keeps_every_untracked_person():
+    # Three untracked people in one frame, listed in a different order by each rater
+    boxes = np.array([[0, 0, 40, 80], [100, 0, 140, 80], [200, 0, 240, 80]], dtype=np.float64)
+    codes = np.array([[0], [1], [2]])
+    orders = [[0, 1, 2], [2, 0, 1], [1, 2, 0]]
+    keys = [track_frame_keys(np.full(3, -1), np.zeros(3)) for _ in orders]
+    stacked = stack_raters(keys, [codes[o] for o in orders], [boxes[o] for o in orders])
+    assert stacked["keys"].size == 3
+    assert (stacked["codes"] == stacked["codes"][0]).all()
+    assert np.array_equal(stacked["boxes"][1], stacked["boxes"][0])
+
+    agreement = multi_rater_agreement(keys, [codes[o] for o in orders], [boxes[o] for o in orders], [3])
+    assert agreement["fleiss_kappa"][0] == pytest.approx(1.0)
+    assert agreement["mean_pairwise_iou"] == pytest.approx(1.0)
+    assert agreement["units_all_raters"] == 3
+
+
+def grid_boxes(rng, n, zero_area=0.1):
+    """Boxes on an integer grid, so shared edges are common, with some zero-width or zero-height boxes."""
+    xy = rng.integers(0, 60, size=(n, 2))
+    wh = rng.integers(1, 15, size=(n, 2))
+    flat = rng.random(n) < zero_area
+    wh[flat, rng.integers(0, 2, flat.sum())] = 0
+    return np.hstack([xy, xy + wh]).astype(np.float64)
+
+
+def test_overlap_candidates_cover_every_overlapping_pair():
+    rng = np.random.default_rng(5)
+    for n_a, n_b in ((40, 35), (1, 30), (25, 1), (0, 10)):
+        boxes_a, boxes_b = grid_boxes(rng, n_a), grid_boxes(rng, n_b)
+        rows, cols = overlap_candidates(boxes_a, boxes_b)
+        candidates = set(zip(rows.tolist(), cols.tolist()))
+        assert len(candidates) == rows.size
+        positive = set(zip(*(i.tolist() for i in np.nonzero(iou_matrix(boxes_a, boxes_b) > 0))))
+        assert positive <= candidates
+
+
+def test_touching_and_zero_area_boxes_are_never_candidates_with_positive_iou():
+    boxes_a = np.array([[0, 0, 10, 10], [20, 0, 20, 10], [30, 0, 40, 0]], dtype=np.float64)
+    boxes_b = np.array([[10, 0, 20, 10], [0, 10, 10, 20], [20, 0, 30, 10], [30, 0, 40, 10]], dtype=np.float64)
+    rows, cols = overlap_candidates(boxes_a, boxes_b)
+    assert rows.size == 0 and cols.size == 0
+
+
+def test_pruned_matching_equals_dense_matching():
+    rng = np.random.default_rng(6)
+    for min_iou in (0.0, 0.3):
+        for _ in range(5):
+            boxes_a, boxes_b = grid_boxes(rng, 30), grid_boxes(rng, 25)
+            assert len(boxes_a) * len(boxes_b) >= SWEEP_MIN_PAIRS
+            dense = iou_matrix(boxes_a, boxes_b)
+            for method in ("hungarian", "greedy"):
+                rows, cols, ious = match_boxes_pruned(boxes_a, boxes_b, min_iou, method)
+                assert len(set(rows.tolist())) == rows.size and len(set(cols.tolist())) == cols.size
+                assert ious == pytest.approx(dense[rows, cols])
+                assert (ious > min_iou).all()
+                dense_rows, dense_cols = match_boxes(dense, min_iou, method)
+                assert ious.sum() == pytest.approx(dense[dense_rows, dense_cols].sum())
+
+
+def clustered_pairs(rng, n_tracks=12, boxes_per_track=25):
+    """Aligned pairs where IoU and label agreement are decided per track, so boxes of a track are not independent."""
+    clusters = np.repeat(np.arange(n_tracks), boxes_per_track)
+    ious = np.repeat(rng.uniform(0.3, 1.0, n_tracks), boxes_per_track)
+    codes_a = rng.integers(0, 3, size=(clusters.size, 2))
+    agrees = np.repeat(rng.random(n_tracks) < 0.6, boxes_per_track)
+    codes_b = np.where(agrees[:, None], codes_a, (codes_a + 1) % 3)
+    return clusters, ious, codes_a, codes_b
+
+
+def test_cluster_bootstrap_is_deterministic_under_a_seed():
+    clusters, ious, codes_a, codes_b = clustered_pairs(np.random.default_rng(7))
+    first = cluster_bootstrap(clusters, ious, codes_a, codes_b, [3, 3], n_resamples=200, seed=11)
+    second = cluster_bootstrap(clusters, ious, codes_a, codes_b, [3, 3], n_resamples=200, seed=11)
+    assert first["average_iou"] == second["average_iou"]
+    assert np.array_equal(first["kappa"], second["kappa"])
+    assert first["macro_avg_kappa"] == second["macro_avg_kappa"]
+    assert first["clusters"] == 12 and first["n_resamples"] == 200
+
+    other = cluster_bootstrap(clusters, ious, codes_a, codes_b, [3, 3], n_resamples=200, seed=12)
+    assert other["average_iou"] != first["average_iou"]
+
+
+def test_cluster_bootstrap_resamples_tracks_not_rows():
+    clusters, ious, codes_a, codes_b = clustered_pairs(np.random.default_rng(8))
+    by_track = cluster_bootstrap(clusters, ious, codes_a, codes_b, [3, 3], n_resamples=500, seed=0)
+    # Negative ids make every row its own cluster, i.e. a plain row bootstrap
+    by_row = cluster_bootstrap(np.full(clusters.size, -1), ious, codes_a, codes_b, [3, 3], n_resamples=500, seed=0)
+    assert by_track["clusters"] == 12 and by_row["clusters"] == clusters.size
+
+    width = lambda interval: interval[1] - interval[0]
+    # 25 identical boxes per track: the honest interval is about sqrt(25) = 5 times wider
+    assert width(by_track["average_iou"]) > 3 * width(by_row["average_iou"])
+    assert width(by_track["macro_avg_kappa"]) > 2 * width(by_row["macro_avg_kappa"])
+    for interval in (by_track["average_iou"], by_row["average_iou"]):
+        assert interval[0] <= ious.mean() <= interval[1]
+
+
+def test_cluster_bootstrap_without_pairs():
+    result = cluster_bootstrap(np.empty(0), np.empty(0), np.empty((0, 2)), np.empty((0, 2)), [3, 3], seed=0)
+    assert result["clusters"] == 0 and result["kappa"].shape == (2, 2)
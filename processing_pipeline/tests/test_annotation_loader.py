@@ -0,0 +1,109 @@
+# tests/test_annotation_loader.py
+import json
+import os
+
+import pytest
+
+# The diff runs in SQL, so these tests need a scratch Postgres database; they migrate it and
+# only touch TASK_ID.
+psycopg2 = pytest.importorskip("psycopg2")
+DSN = os.getenv("TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DSN, reason="TEST_DATABASE_URL is not set")
+
+from processing_pipeline.services.annotation_loader import AnnotationLoader  # noqa: E402
+from processing_pipeline.services.migrations import apply_migrations  # noqa: E402
+
+PROJECT_ID, TASK_ID = 990001, 990001
+
+
+@pytest.fixture
+def conn():
+    conn = psycopg2.connect(DSN)
+    apply_migrations(conn)
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO projects (project_id, name) VALUES (%s, 'loader test') ON CONFLICT DO NOTHING;", (PROJECT_ID,))
+        cur.execute("INSERT INTO tasks (task_id, project_id, name) VALUES (%s, %s, 'loader test') ON CONFLICT DO NOTHING;",
+                    (TASK_ID, PROJECT_ID))
+    conn.commit()
+    yield conn
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM annotations WHERE task_id = %s;", (TASK_ID,))
+        cur.execute("DELETE FROM tasks WHERE task_id = %s;", (TASK_ID,))
+        cur.execute("DELETE FROM projects WHERE project_id = %s;", (PROJECT_ID,))
+    conn.commit()
+    conn.close()
+
+
+def task_rows():
+    """Two tracks over 20 frames plus two untracked boxes per frame, in ANNOTATION_COLUMNS order."""
+    rows = []
+    for frame in range(20):
+        boxes = [(t, 10.0 * t + frame, 5.0) for t in (0, 1)] + [(None, 300.0 + 40 * p, 7.0 + frame) for p in (0, 1)]
+        for person_id, (track_id, x, y) in enumerate(boxes, start=1):
+            rows.append((TASK_ID, f"frame_{frame:06d}.jpg", person_id, track_id, frame, x, y, x + 30, y + 60,
+                         json.dumps({"walking_behavior": "normal_walk"}), None))
+    return rows
+
+
+def sync(conn, rows, copy_threshold):
+    counts = AnnotationLoader(conn, copy_threshold=copy_threshold).sync_task_annotations(TASK_ID, PROJECT_ID, [rows])
+    conn.commit()
+    return counts
+
+
+def row_versions(conn):
+    """{annotation_id: xmin}; xmin changes whenever Postgres writes a new version of the row."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT annotation_id, xmin::text FROM annotations WHERE task_id = %s;", (TASK_ID,))
+        return dict(cur.fetchall())
+
+
+# Both staging paths: execute_values below the threshold, COPY above it
+COPY_THRESHOLDS = [10_000, 1]
+
+
+@pytest.mark.parametrize("copy_threshold", COPY_THRESHOLDS)
+def test_resyncing_unchanged_rows_writes_nothing(conn, copy_threshold):
+    rows = task_rows()
+    assert sync(conn, rows, copy_threshold)["inserted"] == len(rows)
+    before = row_versions(conn)
+
+    counts = sync(conn, rows, copy_threshold)
+
+    assert counts == {"total": len(rows), "inserted": 0, "updated": 0, "deleted": 0,
+                      "unchanged": len(rows), "renumbered": 0}
+    assert row_versions(conn) == before
+
+
+@pytest.mark.parametrize("copy_threshold", COPY_THRESHOLDS)
+@pytest.mark.parametrize("changed", [0, 2], ids=["tracked", "untracked"])
+def test_changing_one_box_updates_exactly_one_row(conn, copy_threshold, changed):
+    rows = task_rows()
+    sync(conn, rows, copy_threshold)
+    before = row_versions(conn)
+
+    i = 4 * 7 + changed
+    rows[i] = rows[i][:5] + (rows[i][5] + 3.0,) + rows[i][6:]
+    counts = sync(conn, rows, copy_threshold)
+
+    assert (counts["updated"], counts["inserted"], counts["deleted"], counts["renumbered"]) == (1, 0, 0, 0)
+    after = row_versions(conn)
+    assert after.keys() == before.keys()
+    assert sum(after[k] != before[k] for k in before) == 1
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM annotations WHERE task_id = %s AND frame = 7 AND xtl = %s;",
+                    (TASK_ID, rows[i][5]))
+        assert cur.fetchone()[0] == 1
+
+
+def test_renumbering_a_tracked_box_only_moves_person_id(conn):
+    rows = task_rows()
+    sync(conn, rows, 10_000)
+
+    # Swap the per-frame numbers of the two tracks in frame 3
+    i = 4 * 3
+    rows[i], rows[i + 1] = rows[i][:2] + (2,) + rows[i][3:], rows[i + 1][:2] + (1,) + rows[i + 1][3:]
+    counts = sync(conn, rows, 10_000)
+
+    assert (counts["updated"], counts["inserted"], counts["deleted"], counts["renumbered"]) == (0, 0, 0, 2)
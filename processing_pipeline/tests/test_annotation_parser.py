@@ -0,0 +1,139 @@
+# tests/test_annotation_parser.py
+import io
+
+from processing_pipeline.services.annotation_parser import (
+    iter_xml_rows, rows_from_job_annotations, track_numbering
+)
+
+FRAME_NAMES = [f"frame_{f:06d}.jpg" for f in range(6)]
+SPEC_NAMES = {1: "action"}
+
+
+def action(value):
+    return [{"spec_id": 1, "value": value}]
+
+
+def rectangle(shape_id, frame, points, value="stand"):
+    return {"id": shape_id, "type": "rectangle", "frame": frame, "points": points, "attributes": action(value)}
+
+
+def keyframe(frame, points, outside=False):
+    return {"type": "rectangle", "frame": frame, "points": points, "outside": outside, "attributes": []}
+
+
+# Two overlapping jobs (frame 3 is in both); CVAT ids are deliberately out of order.
+JOBS = [
+    ({"id": 1, "start_frame": 0, "stop_frame": 3}, {
+        "shapes": [rectangle(99, 1, [50.126, 5.0, 60.0, 15.004])],
+        "tracks": [
+            {"id": 57, "attributes": action("walk"),
+             "shapes": [keyframe(0, [10, 10, 20, 20]), keyframe(2, [12, 10, 22, 20]), keyframe(3, [12, 10, 22, 20], True)]},
+            {"id": 12, "attributes": action("sit"), "shapes": [keyframe(1, [30.333, 30, 40, 40])]},
+        ],
+    }),
+    ({"id": 2, "start_frame": 3, "stop_frame": 5}, {
+        "shapes": [{"id": 7, "type": "polygon", "frame": 4, "points": [0, 0, 1, 1, 2, 0], "attributes": []}],
+        "tracks": [
+            {"id": 12, "attributes": action("sit"), "shapes": [keyframe(1, [30.333, 30, 40, 40])]},
+            {"id": 40, "attributes": action("walk"), "shapes": [keyframe(3, [5, 5, 9, 9]), keyframe(5, [7, 5, 11, 9])]},
+        ],
+    }),
+]
+
+
+def xml_box(box, value, **extra):
+    attrs = " ".join(f'{k}="{v}"' for k, v in extra.items())
+    coords = " ".join(f'{k}="{v:.2f}"' for k, v in zip(("xtl", "ytl", "xbr", "ybr"), box))
+    return f'<box {attrs} {coords}><attribute name="action">{value}</attribute></box>'
+
+
+def video_xml(tracks):
+    """A "CVAT for video" document; `tracks` is [(id, value, [(frame, box, outside)])]."""
+    body = "".join(
+        f'<track id="{track_id}" label="person">'
+        + "".join(xml_box(box, value, frame=frame, outside=int(outside)) for frame, box, outside in boxes)
+        + "</track>"
+        for track_id, value, boxes in tracks
+    )
+    return f'<annotations><version>1.1</version>{body}</annotations>'.encode()
+
+
+def images_xml(images):
+    """A "CVAT for images" document; `images` is {frame: [(box, value)]} with boxes in any order."""
+    body = "".join(
+        f'<image id="{frame}" name="{FRAME_NAMES[frame]}">' + "".join(xml_box(box, value) for box, value in boxes)
+        + "</image>"
+        for frame, boxes in images.items()
+    )
+    return f'<annotations><version>1.1</version>{body}</annotations>'.encode()
+
+
+def api_rows(jobs, mode):
+    track_ids = [t["id"] for _, annotations in jobs for t in annotations["tracks"]]
+    shape_ids = [s["id"] for _, annotations in jobs for s in annotations["shapes"]]
+    return list(rows_from_job_annotations(7, jobs, FRAME_NAMES, SPEC_NAMES, track_numbering(track_ids, shape_ids, mode)))
+
+
+def test_track_numbering_follows_the_video_export():
+    assert track_numbering([57, 12, 40, 12], [99, 7], "interpolation") == {
+        ("track", 12): 0, ("track", 40): 1, ("track", 57): 2, ("shape", 7): 3, ("shape", 99): 4
+    }
+    assert track_numbering([57, 12], [99], "annotation") == {}
+
+
+def test_api_rows_match_the_video_export():
+    # What "CVAT for video" writes for JOBS: tracks 12, 40, 57 become 0-2, shapes 7 and 99 become 3 and 4
+    export = video_xml([
+        (0, "sit", [(1, [30.333, 30, 40, 40], False), (2, [30.333, 30, 40, 40], False), (3, [30.333, 30, 40, 40], False)]),
+        (1, "walk", [(3, [5, 5, 9, 9], False), (4, [6, 5, 10, 9], False), (5, [7, 5, 11, 9], False)]),
+        (2, "walk", [(0, [10, 10, 20, 20], False), (1, [11, 10, 21, 20], False), (2, [12, 10, 22, 20], False),
+                     (3, [12, 10, 22, 20], True)]),
+        (4, "stand", [(1, [50.126, 5.0, 60.0, 15.004], False), (2, [50.126, 5.0, 60.0, 15.004], True)]),
+    ])
+    expected = list(iter_xml_rows(io.BytesIO(export), 7, FRAME_NAMES))
+    rows = api_rows(JOBS, "interpolation")
+
+    assert len(rows) == len(expected) == 10
+    assert sorted(rows, key=str) == sorted(expected, key=str)
+
+
+def test_api_rows_match_the_images_export():
+    # "CVAT for images" flattens tracks into per-image boxes, in whatever order CVAT writes them
+    export = images_xml({
+        0: [([10, 10, 20, 20], "walk")],
+        1: [([50.126, 5.0, 60.0, 15.004], "stand"), ([11, 10, 21, 20], "walk"), ([30.333, 30, 40, 40], "sit")],
+        2: [([30.333, 30, 40, 40], "sit"), ([12, 10, 22, 20], "walk")],
+        3: [([5, 5, 9, 9], "walk"), ([30.333, 30, 40, 40], "sit")],
+        4: [([6, 5, 10, 9], "walk")],
+        5: [([7, 5, 11, 9], "walk")],
+    })
+    expected = list(iter_xml_rows(io.BytesIO(export), 7))
+    rows = api_rows(JOBS, "annotation")
+
+    assert all(row[3] is None for row in rows)
+    assert sorted(rows, key=str) == sorted(expected, key=str)
+
+
+def test_person_ids_are_dense_per_frame():
+    for mode in ("interpolation", "annotation"):
+        by_frame = {}
+        for row in api_rows(JOBS, mode):
+            by_frame.setdefault(row[4], []).append(row[2])
+        assert all(sorted(ids) == list(range(1, len(ids) + 1)) for ids in by_frame.values())
+
+
+def test_jobs_are_read_lazily():
+    read = []
+
+    def jobs():
+        for start in (0, 2, 4):
+            read.append(start)
+            yield {"id": start, "start_frame": start, "stop_frame": start + 1}, {
+                "shapes": [rectangle(start, start, [0, 0, 5, 5])], "tracks": []
+            }
+
+    rows = rows_from_job_annotations(7, jobs(), FRAME_NAMES, SPEC_NAMES, {})
+    assert next(rows)[4] == 0
+    # Frame 0 is complete once the job starting at frame 2 is read; the third job is still unread
+    assert read == [0, 2]
+    assert [row[4] for row in rows] == [2, 4]
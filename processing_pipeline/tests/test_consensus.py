@@ -0,0 +1,115 @@
+# tests/test_consensus.py
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing_pipeline.services.consensus import build_consensus, assign_clusters
+
+DEFINITIONS = {
+    "helmet": {"options": ["on", "off", "incorrect"]},
+    "vest": {"options": ["on", "off"]},
+}
+
+
+def row(task_id, assignee, track_id, x, attributes, clip="clip1", frame=0, person_id=1):
+    return {
+        "clip": clip, "task_id": task_id, "assignee": assignee, "keyframe_name": f"frames/{frame:04d}.jpg",
+        "person_id": person_id, "track_id": track_id, "frame": frame,
+        "xtl": x, "ytl": 10.0, "xbr": x + 40.0, "ybr": 90.0, "attributes": attributes,
+    }
+
+
+def frame(rows):
+    return pd.DataFrame(rows)
+
+
+def test_cluster_needs_half_of_the_clip_tasks():
+    df = frame([
+        row(1, "a", 7, 0.0, {"helmet": "on"}), row(2, "b", 7, 2.0, {"helmet": "on"}),
+        row(3, "c", 8, 200.0, {"helmet": "off"}),
+        # Every clip task must be counted even when it boxed nothing the others did
+        row(3, "c", 9, 400.0, {"helmet": "off"}),
+    ])
+    result = build_consensus(df, DEFINITIONS)
+    assert result["track_id"].tolist() == [7]
+    assert result["support"].tolist() == [2]
+
+
+def test_two_task_clip_keeps_single_annotator_boxes():
+    df = frame([row(1, "a", 7, 0.0, {"helmet": "on"}), row(2, "b", 8, 300.0, {"helmet": "off"})])
+    assert sorted(build_consensus(df, DEFINITIONS)["track_id"].tolist()) == [7, 8]
+
+
+def test_vote_tie_goes_to_the_earlier_option():
+    df = frame([row(1, "a", 7, 0.0, {"helmet": "incorrect", "vest": "off"}),
+                row(2, "b", 7, 0.0, {"helmet": "off", "vest": "on"})])
+    assert build_consensus(df, DEFINITIONS)["attributes"].tolist() == [{"helmet": "off", "vest": "on"}]
+
+
+def test_majority_and_reliability_votes():
+    df = frame([row(1, "a", 7, 0.0, {"helmet": "on"}), row(2, "b", 7, 0.0, {"helmet": "off"}),
+                row(3, "c", 7, 0.0, {"helmet": "off"})])
+    assert build_consensus(df, DEFINITIONS)["attributes"].tolist() == [{"helmet": "off"}]
+
+    weights = {"a": {"box": 1.0, "attributes": {"helmet": 0.9}},
+               "b": {"box": 1.0, "attributes": {"helmet": 0.3}},
+               "c": {"box": 1.0, "attributes": {"helmet": 0.3}}}
+    assert build_consensus(df, DEFINITIONS, weights)["attributes"].tolist() == [{"helmet": "on"}]
+
+
+def test_missing_and_unknown_labels_do_not_vote():
+    df = frame([row(1, "a", 7, 0.0, {"helmet": "bogus"}), row(2, "b", 7, 0.0, {"vest": "off"})])
+    assert build_consensus(df, DEFINITIONS)["attributes"].tolist() == [{"vest": "off"}]
+
+
+def test_boxes_are_weighted_means():
+    df = frame([row(1, "a", 7, 0.0, {}), row(2, "b", 7, 10.0, {})])
+    assert build_consensus(df, DEFINITIONS)["xtl"].tolist() == [pytest.approx(5.0)]
+
+    weights = {"a": {"box": 3.0, "attributes": {}}, "b": {"box": 1.0, "attributes": {}}}
+    fused = build_consensus(df, DEFINITIONS, weights)
+    assert fused["xtl"].tolist() == [pytest.approx(2.5)]
+    assert fused["xbr"].tolist() == [pytest.approx(42.5)]
+
+
+def test_identity_columns_come_from_the_lowest_task():
+    df = frame([row(2, "b", 7, 0.0, {}, person_id=5), row(1, "a", 7, 0.0, {}, person_id=3)])
+    assert build_consensus(df, DEFINITIONS)["person_id"].tolist() == [3]
+
+
+def test_untracked_boxes_match_by_iou():
+    df = frame([
+        row(1, "a", None, 0.0, {}), row(1, "a", None, 100.0, {}, person_id=2),
+        row(2, "b", None, 2.0, {}), row(2, "b", None, 300.0, {}, person_id=2),
+    ])
+    clusters = assign_clusters(df, min_iou=0.3)
+    assert clusters[0] == clusters[2]
+    assert len(set(clusters.tolist())) == 3
+    # With two tasks every cluster has enough support
+    assert len(build_consensus(df, DEFINITIONS)) == 3
+
+
+def test_clips_are_kept_apart():
+    df = frame([row(1, "a", 7, 0.0, {}, clip="c1"), row(2, "b", 7, 0.0, {}, clip="c2")])
+    result = build_consensus(df, DEFINITIONS)
+    assert sorted(result["clip"].tolist()) == ["c1", "c2"]
+    assert result["support"].tolist() == [1, 1]
+
+
+def test_empty_input():
+    result = build_consensus(frame([row(1, "a", 7, 0.0, {})]).iloc[:0], DEFINITIONS)
+    assert result.empty and "support" in result
+    assert np.issubdtype(result["support"].dtype, np.integer)
+
+
+def test_person_ids_are_unique_per_frame():
+    df = frame([
+        # Two people whose first rows both say person 1, plus a third untracked box
+        row(1, "a", 7, 0.0, {}, person_id=1), row(2, "b", 7, 0.0, {}, person_id=1),
+        row(1, "a", 8, 200.0, {}, person_id=1), row(2, "b", 8, 200.0, {}, person_id=2),
+        row(1, "a", None, 400.0, {}, person_id=1), row(2, "b", None, 400.0, {}, person_id=1),
+        # Another frame keeps its own ids
+        row(1, "a", 8, 200.0, {}, frame=1, person_id=1), row(2, "b", 8, 200.0, {}, frame=1, person_id=1),
+    ])
+    result = build_consensus(df, DEFINITIONS).sort_values(["frame", "xtl"])
+    assert result["person_id"].tolist() == [1, 2, 3, 1]
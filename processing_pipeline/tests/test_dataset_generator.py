@@ -0,0 +1,109 @@
+# tests/test_dataset_generator.py
+import os
+import numpy as np
+import pandas as pd
+
+from processing_pipeline.services.dataset_generator import (
+    ATTRIBUTE_DEFINITIONS, AVA_COLUMNS, calculate_action_mapping, calculate_action_values,
+    manifest_frame, build_ava_rows
+)
+
+
+def old_rows(df, manifest_data, action_id_map, image_width=1280, image_height=720):
+    """The per-row loop generate_ava_csv used before the columnar builder."""
+    matched, missing, rows = 0, 0, []
+    for _, row in df.iterrows():
+        origin = manifest_data.get(row["keyframe_name"]) or manifest_data.get(os.path.basename(row["keyframe_name"]))
+        if not origin:
+            missing += 1
+            continue
+        matched += 1
+        video_id = origin.get("source_video", "").replace(".mp4", "")
+        timestamp = origin.get("source_frame", 0)
+        coords = [f"{row[c] / size:.6f}" for c, size in
+                  (("xtl", image_width), ("ytl", image_height), ("xbr", image_width), ("ybr", image_height))]
+        for attr_name, attr_value in row["attributes"].items():
+            base_id = action_id_map.get(attr_name)
+            if base_id is None:
+                continue
+            try:
+                action_id = base_id + ATTRIBUTE_DEFINITIONS[attr_name]["options"].index(attr_value) + 1
+            except ValueError:
+                continue
+            rows.append([video_id, timestamp, *coords, action_id, row["person_id"]])
+    return pd.DataFrame(rows, columns=AVA_COLUMNS), matched, missing
+
+
+def random_boxes(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    names = list(ATTRIBUTE_DEFINITIONS)
+    attributes = []
+    for _ in range(n):
+        chosen = rng.choice(names + ["unknown_attr"], size=rng.integers(0, 5), replace=False)
+        attributes.append({
+            name: ("bogus" if name == "unknown_attr" or rng.random() < 0.1
+                   else str(rng.choice(ATTRIBUTE_DEFINITIONS[name]["options"])))
+            for name in chosen
+        })
+    xtl = rng.uniform(0, 1200, n)
+    ytl = rng.uniform(0, 650, n)
+    return pd.DataFrame({
+        "keyframe_name": [f"task_{rng.integers(3)}/{f:04d}.jpg" if rng.random() < 0.5 else f"frames/{f:04d}.jpg"
+                          for f in rng.integers(0, 20, n)],
+        "person_id": rng.integers(1, 6, n),
+        "xtl": xtl, "ytl": ytl, "xbr": xtl + rng.uniform(1, 80, n), "ybr": ytl + rng.uniform(1, 70, n),
+        "attributes": attributes,
+    })
+
+
+MANIFEST = {
+    **{f"frames/{f:04d}.jpg": {"source_video": "vid.mp4", "source_frame": f} for f in range(8)},
+    **{f"{f:04d}.jpg": {"source_video": "v2.mp4", "source_frame": f * 0.5} for f in range(5, 15)},
+    "0016.jpg": {},
+}
+
+
+def as_sorted_strings(frame):
+    frame = frame.astype(str)
+    return frame.sort_values(list(frame.columns)).reset_index(drop=True)
+
+
+def test_action_values_match_the_option_index_lookup():
+    action_id_map = calculate_action_mapping()
+    values = calculate_action_values(action_id_map)
+    for name, definition in ATTRIBUTE_DEFINITIONS.items():
+        options = definition["options"]
+        for option in options:
+            assert values[name][option] == action_id_map[name] + options.index(option) + 1
+
+
+def test_action_ids_are_unique_and_contiguous():
+    ids = [i for values in calculate_action_values(calculate_action_mapping()).values() for i in values.values()]
+    assert sorted(ids) == list(range(1, sum(len(d["options"]) for d in ATTRIBUTE_DEFINITIONS.values()) + 1))
+
+
+def test_rows_match_the_per_row_loop():
+    df = random_boxes()
+    action_id_map = calculate_action_mapping()
+    expected, expected_matched, expected_missing = old_rows(df, MANIFEST, action_id_map)
+    rows, matched, missing = build_ava_rows(df, manifest_frame(MANIFEST), calculate_action_values(action_id_map))
+
+    assert (matched, missing) == (expected_matched, expected_missing)
+    assert len(rows) == len(expected) > 0
+    assert as_sorted_strings(rows).equals(as_sorted_strings(expected))
+    # Mixed int / half-second timestamps are written the same way as before
+    assert rows["frame_timestamp"].dtype == expected["frame_timestamp"].dtype
+
+
+def test_rows_are_sorted_for_output():
+    rows, _, _ = build_ava_rows(random_boxes(seed=1), manifest_frame(MANIFEST),
+                                calculate_action_values(calculate_action_mapping()))
+    keys = ["video_id", "frame_timestamp", "person_id", "action_id"]
+    assert rows.equals(rows.sort_values(keys, kind="stable").reset_index(drop=True))
+
+
+def test_boxes_without_known_attributes_give_no_rows():
+    df = random_boxes(10).assign(attributes=[{"unknown_attr": "x"}] * 10)
+    rows, matched, _ = build_ava_rows(df, manifest_frame(MANIFEST), calculate_action_values(calculate_action_mapping()))
+    assert rows.empty and list(rows.columns) == AVA_COLUMNS
+    assert matched > 0
@@ -0,0 +1,100 @@
+# tests/test_project_metrics.py
+import itertools
+import numpy as np
+import pytest
+
+from processing_pipeline.services.agreement_metrics import track_frame_keys, align_by_key, aligned_iou
+from processing_pipeline.services.project_metrics import ProjectMetricsAccumulator
+from processing_pipeline.services.quality_service import ANNOTATION_DTYPE, VOCABULARY
+
+SIZES = [len(options) for options in VOCABULARY.values()]
+
+
+def make_records(rng, tracks, frames, jitter=5.0):
+    records = np.empty(len(tracks) * len(frames), dtype=ANNOTATION_DTYPE)
+    records["track_id"] = np.repeat(tracks, len(frames))
+    records["frame"] = np.tile(frames, len(tracks))
+    x = records["track_id"] * 100.0 + rng.uniform(0, jitter, records.size)
+    records["box"] = np.column_stack([x, np.full(x.size, 10.0), x + 50, np.full(x.size, 90.0)])
+    codes = np.column_stack([rng.integers(-1, size, records.size) for size in SIZES])
+    records["codes"] = codes
+    return records
+
+
+def make_clips(n_clips=12, seed=0):
+    rng = np.random.default_rng(seed)
+    clips = []
+    for c in range(n_clips):
+        n_tasks = 2 + c % 3
+        tasks = []
+        for t in range(n_tasks):
+            tracks = rng.choice(6, size=rng.integers(1, 5), replace=False)
+            tasks.append((f"annotator_{t}", make_records(rng, tracks, np.arange(rng.integers(3, 10)))))
+        clips.append(tasks)
+    return clips
+
+
+def assert_summaries_equal(a, b):
+    assert a.keys() == b.keys()
+    for key in a:
+        if isinstance(a[key], dict):
+            assert_summaries_equal(a[key], b[key])
+        elif isinstance(a[key], (float, np.floating)):
+            assert a[key] == pytest.approx(b[key], abs=1e-9)
+        else:
+            assert np.array_equal(a[key], b[key]), key
+
+
+def test_clip_with_disjoint_tasks_adds_no_comparison():
+    rng = np.random.default_rng(1)
+    accumulator = ProjectMetricsAccumulator(SIZES)
+    accumulator.add_clip([("x", make_records(rng, [0, 1], [0, 1])), ("y", make_records(rng, [2, 3], [0, 1]))])
+    summary = accumulator.summary()
+    assert summary["tasks"] == 2 and summary["boxes"] == 8
+    assert summary["compared_annotations"] == 0
+    assert not accumulator.confusion.any()
+    assert set(summary["kappa_scores"].values()) == {0.0}
+    assert summary["macro_avg_kappa"] == 0.0
+
+
+def test_merged_partitions_match_a_single_pass():
+    clips = make_clips()
+    single = ProjectMetricsAccumulator(SIZES)
+    for tasks in clips:
+        single.add_clip(tasks)
+
+    partials = [ProjectMetricsAccumulator(SIZES) for _ in range(3)]
+    for i, tasks in enumerate(clips):
+        partials[i % 3].add_clip(tasks)
+    merged = partials[0].merge(partials[1]).merge(partials[2])
+
+    assert single.iou_count > 0
+    for weights in (None, "quadratic"):
+        assert_summaries_equal(single.summary(weights), merged.summary(weights))
+
+
+def test_merge_with_empty_accumulator_is_identity():
+    clips = make_clips(4, seed=2)
+    accumulator = ProjectMetricsAccumulator(SIZES)
+    for tasks in clips:
+        accumulator.add_clip(tasks)
+    before = accumulator.summary()
+    assert_summaries_equal(before, accumulator.merge(ProjectMetricsAccumulator(SIZES)).summary())
+    assert_summaries_equal(before, ProjectMetricsAccumulator(SIZES).merge(accumulator).summary())
+
+
+def test_iou_moments_match_numpy():
+    clips = make_clips(6, seed=3)
+    accumulator = ProjectMetricsAccumulator(SIZES)
+    ious = []
+    for tasks in clips:
+        accumulator.add_clip(tasks)
+    for tasks in clips:
+        for (_, a), (_, b) in itertools.combinations(tasks, 2):
+            keys_a, keys_b = track_frame_keys(a["track_id"], a["frame"]), track_frame_keys(b["track_id"], b["frame"])
+            idx_a, idx_b = align_by_key(keys_a, keys_b)
+            ious.append(aligned_iou(a["box"][idx_a], b["box"][idx_b]))
+    ious = np.concatenate(ious)
+    summary = accumulator.summary()
+    assert summary["compared_annotations"] == ious.size
+    assert summary["iou_std"] == pytest.approx(ious.std(), abs=1e-9)
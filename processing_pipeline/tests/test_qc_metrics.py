@@ -0,0 +1,46 @@
+# tests/test_qc_metrics.py
+import numpy as np
+import pytest
+
+from processing_pipeline.services.qc_metrics import EnhancedQualityMetrics
+from processing_pipeline.services.qc_data_loader import NO_TRACK
+
+
+def bundle(task_id, rows):
+    """A load_qc_bundles-style bundle from (frame, track_id, x, attributes) rows."""
+    return {
+        "task_id": task_id, "name": f"task {task_id}", "assignee": f"annotator_{task_id}",
+        "frame": np.array([r[0] for r in rows], dtype=np.int64),
+        "track_id": np.array([r[1] for r in rows], dtype=np.int64),
+        "boxes": np.array([[r[2], 10.0, r[2] + 40.0, 90.0] for r in rows], dtype=np.float64),
+        "attributes": [r[3] for r in rows],
+    }
+
+
+@pytest.fixture
+def metrics():
+    return EnhancedQualityMetrics({})
+
+
+def test_untracked_people_in_one_frame_are_paired_by_box(metrics):
+    people = [(0.0, {"helmet": "on"}), (100.0, {"helmet": "off"}), (200.0, {"helmet": "incorrect"})]
+    rows = [(frame, NO_TRACK, x, attrs) for frame in range(3) for x, attrs in people]
+    # Same people in reverse order: joining on (frame, NO_TRACK) alone would pair different people
+    data1, data2 = bundle(1, rows), bundle(2, rows[::-1])
+
+    aligned = metrics._align_rows(data1, data2)
+    assert len(aligned) == len(rows)
+    assert np.array_equal(data1["boxes"][aligned["row1"]], data2["boxes"][aligned["row2"]])
+
+    tube = metrics.calculate_tube_level_metrics(data1, data2)
+    assert tube["kappa_scores"]["helmet"] == pytest.approx(1.0)
+    matrix = np.array(tube["confusion"]["helmet"]["matrix"])
+    assert matrix.sum() == len(rows) and np.trace(matrix) == len(rows)
+
+
+def test_tracked_and_untracked_boxes_align_together(metrics):
+    data1 = bundle(1, [(0, 5, 0.0, {"vest": "on"}), (0, NO_TRACK, 100.0, {"vest": "off"}),
+                       (0, NO_TRACK, 300.0, {"vest": "on"})])
+    data2 = bundle(2, [(0, NO_TRACK, 102.0, {"vest": "off"}), (0, 5, 0.0, {"vest": "on"})])
+    aligned = metrics._align_rows(data1, data2)
+    assert sorted(zip(aligned["row1"], aligned["row2"])) == [(0, 1), (1, 0)]
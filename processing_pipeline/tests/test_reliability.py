@@ -0,0 +1,24 @@
+# tests/test_reliability.py
+import pytest
+
+from processing_pipeline.services.reliability import pair_contribution, _difference
+
+
+def test_pair_credits_each_annotator_once():
+    contribution = pair_contribution("a", "b", 10, 0.8, {"k": 0.5}, {"k": 0.1}, {"k": 0.2})
+    assert contribution["a"]["overlaps"] == contribution["b"]["overlaps"] == 1
+    assert contribution["a"]["iou_sum"] == pytest.approx(8.0)
+    assert contribution["a"]["attributes"]["k"]["flip_rate_sum"] == 0.1
+    assert contribution["b"]["attributes"]["k"]["flip_rate_sum"] == 0.2
+
+
+def test_self_pairs_and_unassigned_tasks_contribute_nothing():
+    assert pair_contribution("a", "a", 10, 0.8, {"k": 0.5}, {"k": 0.1}, {"k": 0.2}) == {}
+    assert list(pair_contribution("a", None, 10, 0.8, {"k": 0.5}, {}, {})) == ["a"]
+
+
+def test_difference_removes_an_earlier_contribution():
+    old = pair_contribution("a", "b", 10, 0.8, {"k": 0.5}, {"k": 0.1}, {"k": 0.2})
+    delta = _difference({}, old)
+    assert delta["a"]["overlaps"] == -1 and delta["a"]["boxes"] == -10
+    assert delta["b"]["attributes"]["k"]["kappa_sum"] == -0.5
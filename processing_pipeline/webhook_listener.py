@@ -1,8 +1,7 @@
 from flask import Flask, request, jsonify
-import subprocess
 import json
 import logging
-import os
+import sys
 from pathlib import Path # Use Path for robust, cross-platform path handling
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,15 +16,20 @@ CURRENT_DIR = Path(__file__).resolve().parent
 PROJECT_ROOT = str(CURRENT_DIR) 
 logger.info(f"Dynamically determined PROJECT_ROOT: {PROJECT_ROOT}")
 
+# Make 'processing_pipeline.services' importable when run as a script
+sys.path.append(str(CURRENT_DIR.parent))
+from processing_pipeline.services.post_annotation_service import DB_PARAMS
+from processing_pipeline.services.sync_queue import SyncJobQueue
+from processing_pipeline.services.migrations import check_schema
 
-# Define the path to the post_annotation_service.py script
-SCRIPT_RELATIVE_PATH = "services/post_annotation_service.py"
-SCRIPT_PATH = os.path.join(PROJECT_ROOT, SCRIPT_RELATIVE_PATH)
+# Completed tasks are written to the durable `sync_jobs` queue and drained by
+# `services/sync_queue.py` workers, so no sync is lost on a restart.
+sync_queue = SyncJobQueue(DB_PARAMS)
 
 
 @app.route('/webhook', methods=['POST'])
 def cvat_webhook():
-    """ This endpoint listens for 'update:task' or 'update:job' events and triggers post-annotation service on completion. """
+    """ This endpoint listens for 'update:task' or 'update:job' events and queues a post-annotation sync on completion. """
     if not request.is_json:
         return jsonify({"status": "error", "message": "Request must be JSON."}), 400
 
@@ -53,35 +57,28 @@ def cvat_webhook():
     # --- End Logic ---
 
     if task_id:
-        logger.info(f"✅ Job/Task {task_id} completed by {assignee}. Triggering post-annotation service...")
+        logger.info(f"✅ Job/Task {task_id} completed by {assignee}. Queueing post-annotation sync...")
 
         try:
-            # Trigger the post_annotation_service.py script as a background process
-            subprocess.Popen(
-                [
-                    "python", 
-                    # Use the relative path combined with the correct working directory
-                    SCRIPT_RELATIVE_PATH, 
-                    "--task-id", str(task_id),
-                    "--assignee", assignee 
-                ],
-                # CRITICAL: Setting cwd ensures the 'python' executable finds the script 
-                # and the script can resolve its own relative imports (e.g., from processing_pipeline)
-                cwd=PROJECT_ROOT, 
-                
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-            return jsonify({"status": "success", "message": "Post-annotation service triggered."}), 200
+            job_id = sync_queue.enqueue(task_id, assignee)
+            return jsonify({"status": "success", "message": "Sync job queued.", "job_id": job_id}), 200
         except Exception as e:
-            logger.error(f"Failed to trigger post-annotation service: {e}")
-            return jsonify({"status": "error", "message": "Failed to trigger service."}), 500
+            logger.error(f"Failed to enqueue sync job: {e}")
+            sync_queue.close_db()
+            return jsonify({"status": "error", "message": "Failed to queue sync job."}), 500
 
     return jsonify({"status": "ignored", "message": f"Event was not a completion event (received: {event})."}), 200
 
+@app.route('/metrics', methods=['GET'])
+def queue_metrics():
+    """ Reports sync queue depth, dead-letter count and recent sync latency. """
+    try:
+        return jsonify(sync_queue.metrics()), 200
+    except Exception as e:
+        logger.error(f"Failed to read queue metrics: {e}")
+        sync_queue.close_db()
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 if __name__ == '__main__':
-    # Final check on paths before starting
-    if not os.path.exists(SCRIPT_PATH):
-         logger.error(f"ERROR: Post-annotation script not found at: {SCRIPT_PATH}. Check your project structure.")
-    
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    check_schema(DB_PARAMS)
+    app.run(host='0.0.0.0', port=5001, debug=True)